@@ -4,32 +4,35 @@ Charles P. Martin, 2018
 University of Oslo, Norway.
 """
 import numpy as np
-import tensorflow.compat.v1 as tf
-import keras_mdn_layer as mdn
-import time
 
-tf.logging.set_verbosity(tf.logging.INFO)  # set logging.
 NET_MODE_TRAIN = 'train'
 NET_MODE_RUN = 'run'
 MODEL_DIR = "./models/"
 LOG_PATH = "./logs/"
 SCALE_FACTOR = 10  # scales input and output from the model. Should be the same between training and inference.
+# High-level model sizes: (hidden units, mixtures, layers)
+MODEL_SIZES = {
+    'xs': (32, 5, 2),
+    's': (64, 5, 2),
+    'm': (128, 5, 2),
+    'l': (256, 5, 2),
+    'xl': (512, 5, 3),
+}
 
 
 # Functions for slicing up data
 def slice_sequence_examples(sequence, num_steps, step_size=1):
     """ Slices a sequence into examples of length
-        num_steps with step size step_size."""
-    xs = []
-    for i in range((len(sequence) - num_steps) // step_size + 1):
-        example = sequence[(i * step_size): (i * step_size) + num_steps]
-        xs.append(example)
-    return xs
+        num_steps with step size step_size.
+        Returns an array of shape (examples, num_steps, dim) that is a view into the sequence."""
+    return sequence_windows(sequence, num_steps, step_size)
 
 
 def seq_to_overlapping_format(examples):
     """Takes sequences of seq_len+1 and returns overlapping
-    sequences of seq_len."""
+    sequences of seq_len (views if examples is an array)."""
+    if isinstance(examples, np.ndarray):
+        return (examples[:, :-1], examples[:, 1:])
     xs = []
     ys = []
     for ex in examples:
@@ -41,6 +44,8 @@ def seq_to_overlapping_format(examples):
 def seq_to_singleton_format(examples):
     """Return the examples in seq to singleton format.
     """
+    if isinstance(examples, np.ndarray):
+        return (examples[:, :-1], examples[:, -1])
     xs = []
     ys = []
     for ex in examples:
@@ -49,69 +54,6 @@ def seq_to_singleton_format(examples):
     return (xs, ys)
 
 
-def build_model(seq_len=30, hidden_units=256, num_mixtures=5, layers=2,
-                out_dim=2, time_dist=True, inference=False, compile_model=True,
-                print_summary=True):
-    """Builds a EMPI MDRNN model for training or inference.
-
-    Keyword Arguments:
-    seq_len : sequence length to unroll
-    hidden_units : number of LSTM units in each layer
-    num_mixtures : number of mixture components (5-10 is good)
-    layers : number of layers (2 is good)
-    out_dim : number of dimensions for the model = number of degrees of freedom + 1 (time)
-    time_dist : time distributed or not (default True)
-    inference : inference network or training (default False)
-    compile_model : compiles the model (default True)
-    print_summary : print summary after creating mdoe (default True)
-    """
-    print("Building EMPI Model...")
-    # Set up training mode
-    stateful = False
-    # batch_shape = None
-    batch_size = None
-    # Set up inference mode.
-    if inference:
-        stateful = True
-        batch_size = 1
-        #batch_shape = (1, 1, out_dim)
-    inputs = tf.keras.layers.Input(shape=(seq_len, out_dim), name='inputs',
-                                   batch_size=batch_size)
-                                # batch_shape=batch_shape)
-    lstm_in = inputs  # starter input for lstm
-    for layer_i in range(layers):
-        ret_seq = True
-        if (layer_i == layers - 1) and not time_dist:
-            # return sequences false if last layer, and not time distributed.
-            ret_seq = False
-        lstm_out = tf.keras.layers.LSTM(hidden_units, name='lstm'+str(layer_i),
-                                     return_sequences=ret_seq,
-                                     stateful=stateful)(lstm_in)
-        lstm_in = lstm_out
-
-    mdn_layer = mdn.MDN(out_dim, num_mixtures, name='mdn_outputs')
-    if time_dist:
-        mdn_layer = tf.keras.layers.TimeDistributed(mdn_layer, name='td_mdn')
-    mdn_out = mdn_layer(lstm_out)  # apply mdn
-    model = tf.keras.models.Model(inputs=inputs, outputs=mdn_out)
-
-    if compile_model:
-        loss_func = mdn.get_mixture_loss_func(out_dim, num_mixtures)
-        optimizer = tf.keras.optimizers.Adam()
-        model.compile(loss=loss_func, optimizer=optimizer)
-
-    model.summary()
-    return model
-
-
-def load_inference_model(model_file="", layers=2, units=512, mixtures=5, predict_moving=False):
-    """Returns an IMPS model loaded from a file"""
-    # TODO: make this parse the name to get the hyperparameters.
-    decoder = decoder = build_model(seq_len=1, hidden_units=units, num_mixtures=mixtures, layers=layers, time_dist=False, inference=True, compile_model=False, print_summary=True, predict_moving=predict_moving)
-    decoder.load_weights(model_file)
-    return decoder
-
-
 def random_sample(out_dim=2):
     """ Generate a random sample in format (dt, x_1, ..., x_n), where dt is positive
     and the x_i are between 0 and 1."""
@@ -128,140 +70,36 @@ def proc_generated_touch(x_input, out_dim=2):
     return np.concatenate([np.array([dt]), x_output])
 
 
-def generate_sample(model, n_mixtures, prev_sample, pi_temp=1.0, sigma_temp=0.0, out_dim=2):
-    """Generate one forward prediction from a previous sample in format
-    (dt, x_1,...,x_n). Pi and Sigma temperature are adjustable."""
-    params = model.predict(prev_sample.reshape(1, 1, out_dim) * SCALE_FACTOR)
-    new_sample = mdn.sample_from_output(params[0], out_dim, n_mixtures, temp=pi_temp, sigma_temp=sigma_temp) / SCALE_FACTOR
-    new_sample = new_sample.reshape(out_dim,)
-    return new_sample
-
-
-def generate_performance(model, n_mixtures, first_sample, time_limit=None, steps_limit=1000, pi_temp=1.0, sigma_temp=0.0, out_dim=2):
-    """Generates a performance of (dt, x) pairs, up to a step_limit.
-    Time limit is not presently implemented.
-    """
-    time = 0
-    steps = 0
-    prev_sample = first_sample
-    print(prev_sample)
-    performance = [prev_sample.reshape((out_dim,))]
-    while (steps < steps_limit):  # and time < time_limit
-        params = model.predict(prev_sample.reshape(1, 1, out_dim) * SCALE_FACTOR)
-        prev_sample = mdn.sample_from_output(params[0], out_dim, n_mixtures,
-                                             temp=pi_temp,
-                                             sigma_temp=sigma_temp)
-        prev_sample = prev_sample / SCALE_FACTOR
-        output_touch = prev_sample.reshape(out_dim,)
-        output_touch = proc_generated_touch(output_touch)
-        performance.append(output_touch.reshape((out_dim,)))
-        steps += 1
-        time += output_touch[0]
-    return np.array(performance)
-
-
-class PredictiveMusicMDRNN(object):
-    """EMPI MDRNN object for convenience in the run script."""
-
-    def __init__(self, mode=NET_MODE_TRAIN, dimension=2, n_hidden_units=128, n_mixtures=5, batch_size=100, sequence_length=120, layers=2):
-        """Initialise the MDRNN model. Use mode='run' for evaluation graph and
-        mode='train' for training graph."""
-        # network parameters
-        self.dimension = dimension
-        self.mode = mode
-        self.n_hidden_units = n_hidden_units
-        self.n_rnn_layers = layers
-        self.n_mixtures = n_mixtures  # number of mixtures
-        # Training parameters
-        self.batch_size = batch_size
-        self.sequence_length = sequence_length
-        self.val_split = 0.10
-        # Sampling hyperparameters
-        self.pi_temp = 1.5
-        self.sigma_temp = 0.01
-
-        if self.mode is NET_MODE_TRAIN:
-            self.model = build_model(seq_len=self.sequence_length,
-                                     hidden_units=self.n_hidden_units,
-                                     num_mixtures=self.n_mixtures,
-                                     layers=self.n_rnn_layers,
-                                     out_dim=self.dimension,
-                                     time_dist=True,
-                                     inference=False,
-                                     compile_model=True,
-                                     print_summary=True)
-        else:
-            self.model = build_model(seq_len=1,
-                                     hidden_units=self.n_hidden_units,
-                                     num_mixtures=self.n_mixtures,
-                                     layers=self.n_rnn_layers,
-                                     out_dim=self.dimension,
-                                     time_dist=False,
-                                     inference=True,
-                                     compile_model=False,
-                                     print_summary=True)
-
-        self.run_name = self.get_run_name()
-
-    def model_name(self):
-        """Returns the name of the present model for saving to disk"""
-        return "musicMDRNN" + "-dim" + str(self.dimension) + "-layers" + str(self.n_rnn_layers) + "-units" + str(self.n_hidden_units) + "-mixtures" + str(self.n_mixtures) + "-scale" + str(SCALE_FACTOR)
+# The Keras model needs TensorFlow, which takes seconds to import, so it is only loaded when first used.
+KERAS_NAMES = ["build_model", "load_inference_model", "generate_sample", "generate_samples",
+               "generate_performance", "PredictiveMusicMDRNN", "KerasMDRNN"]
 
-    def load_model(self, model_file=None):
-        if model_file is None:
-            model_file = MODEL_DIR + self.model_name() + ".h5"
-        try:
-            self.model.load_weights(model_file)
-        except OSError as err:
-            print("OS error: {0}".format(err))
-            print("MDRNN could not be loaded from file:", model_file)
-            print("MDRNN is untrained.")
 
-    def get_run_name(self):
-        out = self.model_name() + "-"
-        out += time.strftime("%Y%m%d-%H%M%S")
-        return out
+INFERENCE_BACKENDS = ["keras", "numpy", "tflite"]
 
-    def train(self, X, y, num_epochs=10, saving=True):
-        """Train the network for the a number of epochs."""
-        # Setup callbacks
-        filepath = MODEL_DIR + self.model_name() + "-E{epoch:02d}-VL{val_loss:.2f}.hdf5"
-        checkpoint = tf.keras.callbacks.ModelCheckpoint(filepath, monitor='val_loss', verbose=1, save_best_only=True, mode='min')
-        terminateOnNaN = tf.keras.callbacks.TerminateOnNaN()
-        tboard = tf.keras.callbacks.TensorBoard(log_dir=LOG_PATH+self.run_name, histogram_freq=2, batch_size=32, write_graph=True, update_freq='epoch')
-        callbacks = [terminateOnNaN, tboard]
-        if saving:
-            callbacks.append(checkpoint)
 
-        # Do the data scaling in here.
-        X = np.array(X) * SCALE_FACTOR
-        y = np.array(y) * SCALE_FACTOR
-        print("Training corpus has shape:")
-        print("X:", X.shape)
-        print("y:", y.shape)
+def build_inference_model(backend, dimension=2, n_hidden_units=128, n_mixtures=5, layers=2, voices=1):
+    """Returns a running MDRNN using one of the INFERENCE_BACKENDS. They all have the same interface:
+    load_model, prepare_model_for_running, generate_touch, generate_touches, pi_temp and sigma_temp
+    (and load_weights_for_swap and swap_weights to replace the weights while running, get_state and
+    set_state to snapshot the LSTM state, and warm_up to run a sequence through it in one call)."""
+    if backend == "keras":
+        from .keras_mdrnn import KerasMDRNN as backend_class
+    elif backend == "numpy":
+        from .numpy_mdrnn import NumpyMDRNN as backend_class
+    elif backend == "tflite":
+        from .tflite_mdrnn import TFLiteMDRNN as backend_class
+    else:
+        raise ValueError(f"Unknown MDRNN backend {backend!r}, should be one of {INFERENCE_BACKENDS}.")
+    return backend_class(dimension=dimension, n_hidden_units=n_hidden_units, n_mixtures=n_mixtures, layers=layers, voices=voices)
 
-        # Train
-        history = self.model.fit(X, y, batch_size=self.batch_size,
-                                 epochs=num_epochs,
-                                 validation_split=self.val_split,
-                                 callbacks=callbacks)
-        return history
 
-    def prepare_model_for_running(self):
-        """Reset RNN state."""
-        self.model.reset_states()  # reset LSTM state.
+def __getattr__(name):
+    if name in KERAS_NAMES:
+        from . import keras_mdrnn
+        return getattr(keras_mdrnn, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-    def generate_touch(self, prev_sample):
-        # TODO - do something with the session.
-        output = generate_sample(self.model, self.n_mixtures, prev_sample,
-                                 pi_temp=self.pi_temp,
-                                 sigma_temp=self.sigma_temp,
-                                 out_dim=self.dimension)
-        return output
 
-    def generate_performance(self, first_sample, number):
-        return generate_performance(self.model, self.n_mixtures,
-                                    first_sample, time_limit=None,
-                                    steps_limit=number, pi_temp=self.pi_temp,
-                                    sigma_temp=self.sigma_temp,
-                                    out_dim=self.dimension)
\ No newline at end of file
+from .numpy_mdrnn import NumpyMDRNN  # noqa: E402
+from .windowed_data import WindowedCorpus, sequence_windows  # noqa: E402
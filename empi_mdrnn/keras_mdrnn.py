@@ -0,0 +1,339 @@
+"""
+Keras (TensorFlow) version of the EMPI MDRNN, for training and inference.
+Imported the first time one of its names is used from empi_mdrnn, so that
+TensorFlow is only loaded when it is needed.
+"""
+import time
+import numpy as np
+import tensorflow.compat.v1 as tf
+import keras_mdn_layer as mdn
+import empi_mdrnn
+from empi_mdrnn import NET_MODE_TRAIN, proc_generated_touch
+from empi_mdrnn.mdn_sampler import MDNSampler
+from empi_mdrnn.windowed_data import WindowedCorpus
+
+tf.logging.set_verbosity(tf.logging.INFO)  # set logging.
+
+
+def build_model(seq_len=30, hidden_units=256, num_mixtures=5, layers=2,
+                out_dim=2, time_dist=True, inference=False, compile_model=True,
+                print_summary=True, inference_batch_size=1):
+    """Builds a EMPI MDRNN model for training or inference.
+
+    Keyword Arguments:
+    seq_len : sequence length to unroll
+    hidden_units : number of LSTM units in each layer
+    num_mixtures : number of mixture components (5-10 is good)
+    layers : number of layers (2 is good)
+    out_dim : number of dimensions for the model = number of degrees of freedom + 1 (time)
+    time_dist : time distributed or not (default True)
+    inference : inference network or training (default False)
+    compile_model : compiles the model (default True)
+    print_summary : print summary after creating mdoe (default True)
+    inference_batch_size : number of independent sequences (each with its own state) run by an inference network (default 1)
+    """
+    print("Building EMPI Model...")
+    # Set up training mode
+    stateful = False
+    # batch_shape = None
+    batch_size = None
+    # Set up inference mode.
+    if inference:
+        stateful = True
+        batch_size = inference_batch_size
+        #batch_shape = (1, 1, out_dim)
+    inputs = tf.keras.layers.Input(shape=(seq_len, out_dim), name='inputs',
+                                   batch_size=batch_size)
+                                # batch_shape=batch_shape)
+    lstm_in = inputs  # starter input for lstm
+    for layer_i in range(layers):
+        ret_seq = True
+        if (layer_i == layers - 1) and not time_dist:
+            # return sequences false if last layer, and not time distributed.
+            ret_seq = False
+        lstm_out = tf.keras.layers.LSTM(hidden_units, name='lstm'+str(layer_i),
+                                     return_sequences=ret_seq,
+                                     stateful=stateful)(lstm_in)
+        lstm_in = lstm_out
+
+    mdn_layer = mdn.MDN(out_dim, num_mixtures, name='mdn_outputs')
+    if time_dist:
+        mdn_layer = tf.keras.layers.TimeDistributed(mdn_layer, name='td_mdn')
+    mdn_out = mdn_layer(lstm_out)  # apply mdn
+    model = tf.keras.models.Model(inputs=inputs, outputs=mdn_out)
+
+    if compile_model:
+        loss_func = mdn.get_mixture_loss_func(out_dim, num_mixtures)
+        optimizer = tf.keras.optimizers.Adam()
+        model.compile(loss=loss_func, optimizer=optimizer)
+
+    if print_summary:
+        model.summary()
+    return model
+
+
+def load_inference_model(model_file="", layers=2, units=512, mixtures=5, predict_moving=False):
+    """Returns an IMPS model loaded from a file"""
+    # TODO: make this parse the name to get the hyperparameters.
+    decoder = decoder = build_model(seq_len=1, hidden_units=units, num_mixtures=mixtures, layers=layers, time_dist=False, inference=True, compile_model=False, print_summary=True, predict_moving=predict_moving)
+    decoder.load_weights(model_file)
+    return decoder
+
+
+def generate_sample(model, n_mixtures, prev_sample, pi_temp=1.0, sigma_temp=0.0, out_dim=2):
+    """Generate one forward prediction from a previous sample in format
+    (dt, x_1,...,x_n). Pi and Sigma temperature are adjustable."""
+    params = model.predict(prev_sample.reshape(1, 1, out_dim) * empi_mdrnn.SCALE_FACTOR)
+    new_sample = mdn.sample_from_output(params[0], out_dim, n_mixtures, temp=pi_temp, sigma_temp=sigma_temp) / empi_mdrnn.SCALE_FACTOR
+    new_sample = new_sample.reshape(out_dim,)
+    return new_sample
+
+
+def generate_samples(model, n_mixtures, prev_samples, pi_temp=1.0, sigma_temp=0.0, out_dim=2):
+    """Generate one forward prediction for each row of a batch of previous samples,
+    shape (batch, out_dim), with a single call to the (stateful, batched) model."""
+    params = model.predict(prev_samples.reshape(-1, 1, out_dim) * empi_mdrnn.SCALE_FACTOR, batch_size=len(prev_samples))
+    new_samples = [mdn.sample_from_output(p, out_dim, n_mixtures, temp=pi_temp, sigma_temp=sigma_temp) for p in params]
+    return np.array(new_samples).reshape(-1, out_dim) / empi_mdrnn.SCALE_FACTOR
+
+
+def generate_performance(model, n_mixtures, first_sample, time_limit=None, steps_limit=1000, pi_temp=1.0, sigma_temp=0.0, out_dim=2):
+    """Generates a performance of (dt, x) pairs, up to a step_limit.
+    Time limit is not presently implemented.
+    """
+    time = 0
+    steps = 0
+    prev_sample = first_sample
+    print(prev_sample)
+    performance = [prev_sample.reshape((out_dim,))]
+    while (steps < steps_limit):  # and time < time_limit
+        params = model.predict(prev_sample.reshape(1, 1, out_dim) * empi_mdrnn.SCALE_FACTOR)
+        prev_sample = mdn.sample_from_output(params[0], out_dim, n_mixtures,
+                                             temp=pi_temp,
+                                             sigma_temp=sigma_temp)
+        prev_sample = prev_sample / empi_mdrnn.SCALE_FACTOR
+        output_touch = prev_sample.reshape(out_dim,)
+        output_touch = proc_generated_touch(output_touch)
+        performance.append(output_touch.reshape((out_dim,)))
+        steps += 1
+        time += output_touch[0]
+    return np.array(performance)
+
+
+class PredictiveMusicMDRNN(object):
+    """EMPI MDRNN object for convenience in the run script."""
+
+    def __init__(self, mode=NET_MODE_TRAIN, dimension=2, n_hidden_units=128, n_mixtures=5, batch_size=100, sequence_length=120, layers=2, voices=1):
+        """Initialise the MDRNN model. Use mode='run' for evaluation graph and
+        mode='train' for training graph. In run mode, voices sets how many
+        independent sequences (each with its own LSTM state) are stepped together."""
+        # network parameters
+        self.dimension = dimension
+        self.mode = mode
+        self.n_hidden_units = n_hidden_units
+        self.n_rnn_layers = layers
+        self.n_mixtures = n_mixtures  # number of mixtures
+        self.voices = voices
+        # Training parameters
+        self.batch_size = batch_size
+        self.sequence_length = sequence_length
+        self.val_split = 0.10
+        # Sampling hyperparameters
+        self.pi_temp = 1.5
+        self.sigma_temp = 0.01
+        self.sampler = MDNSampler(dimension, n_mixtures, rows=voices)
+
+        if self.mode is NET_MODE_TRAIN:
+            self.model = build_model(seq_len=self.sequence_length,
+                                     hidden_units=self.n_hidden_units,
+                                     num_mixtures=self.n_mixtures,
+                                     layers=self.n_rnn_layers,
+                                     out_dim=self.dimension,
+                                     time_dist=True,
+                                     inference=False,
+                                     compile_model=True,
+                                     print_summary=True)
+        else:
+            self.model = build_model(seq_len=1,
+                                     hidden_units=self.n_hidden_units,
+                                     num_mixtures=self.n_mixtures,
+                                     layers=self.n_rnn_layers,
+                                     out_dim=self.dimension,
+                                     time_dist=False,
+                                     inference=True,
+                                     compile_model=False,
+                                     print_summary=False,
+                                     inference_batch_size=self.voices)
+
+        self.run_name = self.get_run_name()
+
+    def model_name(self):
+        """Returns the name of the present model for saving to disk"""
+        return "musicMDRNN" + "-dim" + str(self.dimension) + "-layers" + str(self.n_rnn_layers) + "-units" + str(self.n_hidden_units) + "-mixtures" + str(self.n_mixtures) + "-scale" + str(empi_mdrnn.SCALE_FACTOR)
+
+    def load_model(self, model_file=None):
+        if model_file is None:
+            model_file = empi_mdrnn.MODEL_DIR + self.model_name() + ".h5"
+        try:
+            self.model.load_weights(model_file)
+        except OSError as err:
+            print("OS error: {0}".format(err))
+            print("MDRNN could not be loaded from file:", model_file)
+            print("MDRNN is untrained.")
+
+    def get_run_name(self):
+        out = self.model_name() + "-"
+        out += time.strftime("%Y%m%d-%H%M%S")
+        return out
+
+    def train(self, X, y=None, num_epochs=10, saving=True, tensorboard=True):
+        """Train the network for the a number of epochs, either on a WindowedCorpus X (its batches
+        are sliced, scaled and shuffled as they are needed) or on arrays of examples X and targets y.
+        tensorboard=False leaves out the TensorBoard logs (and their weight histograms every 2 epochs)."""
+        # Setup callbacks
+        filepath = empi_mdrnn.MODEL_DIR + self.model_name() + "-E{epoch:02d}-VL{val_loss:.2f}.hdf5"
+        checkpoint = tf.keras.callbacks.ModelCheckpoint(filepath, monitor='val_loss', verbose=1, save_best_only=True, mode='min')
+        terminateOnNaN = tf.keras.callbacks.TerminateOnNaN()
+        tboard = tf.keras.callbacks.TensorBoard(log_dir=empi_mdrnn.LOG_PATH+self.run_name, histogram_freq=2, batch_size=32, write_graph=True, update_freq='epoch')
+        callbacks = [terminateOnNaN]
+        if tensorboard:
+            callbacks.append(tboard)
+        if saving:
+            callbacks.append(checkpoint)
+
+        if isinstance(X, WindowedCorpus):
+            if X.sequence_length != self.sequence_length:
+                raise ValueError(f"Corpus windows have sequence length {X.sequence_length}, the model needs {self.sequence_length}.")
+            train_windows, val_windows = X.split(self.val_split)
+            print("Training corpus has", len(train_windows), "training and", len(val_windows), "validation windows of shape",
+                  (self.sequence_length, self.dimension))
+            history = self.model.fit(train_windows.batches(self.batch_size),
+                                     steps_per_epoch=train_windows.n_batches(self.batch_size),
+                                     epochs=num_epochs,
+                                     validation_data=val_windows.batches(self.batch_size, shuffle=False),
+                                     validation_steps=val_windows.n_batches(self.batch_size),
+                                     callbacks=callbacks)
+            return history
+
+        # Do the data scaling in here.
+        X = np.array(X) * empi_mdrnn.SCALE_FACTOR
+        y = np.array(y) * empi_mdrnn.SCALE_FACTOR
+        print("Training corpus has shape:")
+        print("X:", X.shape)
+        print("y:", y.shape)
+
+        # Train
+        history = self.model.fit(X, y, batch_size=self.batch_size,
+                                 epochs=num_epochs,
+                                 validation_split=self.val_split,
+                                 callbacks=callbacks)
+        return history
+
+    def prepare_model_for_running(self):
+        """Reset RNN state."""
+        self.model.reset_states()  # reset LSTM state.
+
+    def generate_touch(self, prev_sample):
+        params = self.model.predict(prev_sample.reshape(1, 1, self.dimension) * empi_mdrnn.SCALE_FACTOR)
+        return self.sampler.sample(params, pi_temp=self.pi_temp, sigma_temp=self.sigma_temp)[0] / empi_mdrnn.SCALE_FACTOR
+
+    def generate_touches(self, prev_samples):
+        """Generates the next sample for every voice, prev_samples has shape (voices, dimension)."""
+        params = self.model.predict(prev_samples.reshape(-1, 1, self.dimension) * empi_mdrnn.SCALE_FACTOR, batch_size=len(prev_samples))
+        return self.sampler.sample(params, pi_temp=self.pi_temp, sigma_temp=self.sigma_temp) / empi_mdrnn.SCALE_FACTOR
+
+    def generate_touch_candidates(self, prev_sample, candidates):
+        """Steps the model once and returns several independent samples of the next touch,
+        shape (candidates, dimension), so a caller can choose between them without another step."""
+        params = self.model.predict(prev_sample.reshape(1, 1, self.dimension) * empi_mdrnn.SCALE_FACTOR)
+        return self.sampler.sample_candidates(params, candidates, pi_temp=self.pi_temp, sigma_temp=self.sigma_temp)[0] / empi_mdrnn.SCALE_FACTOR
+
+    def generate_performance(self, first_sample, number):
+        return generate_performance(self.model, self.n_mixtures,
+                                    first_sample, time_limit=None,
+                                    steps_limit=number, pi_temp=self.pi_temp,
+                                    sigma_temp=self.sigma_temp,
+                                    out_dim=self.dimension)
+
+
+class KerasMDRNN(PredictiveMusicMDRNN):
+    """Keras inference backend: a run mode PredictiveMusicMDRNN with its own graph and
+    session, which it enters for each call so callers don't have to."""
+
+    def __init__(self, dimension=2, n_hidden_units=128, n_mixtures=5, layers=2, voices=1):
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.session = tf.Session()
+        with self.session_scope():
+            super().__init__(mode=empi_mdrnn.NET_MODE_RUN, dimension=dimension, n_hidden_units=n_hidden_units,
+                             n_mixtures=n_mixtures, layers=layers, voices=voices)
+
+    def session_scope(self):
+        """Makes this model's session current, returns its graph's context manager."""
+        tf.keras.backend.set_session(self.session)
+        return self.graph.as_default()
+
+    def load_model(self, model_file=None):
+        with self.session_scope():
+            super().load_model(model_file)
+            self.lstm_weights = self.model.get_weights()[:3 * self.n_rnn_layers] # kernel, recurrent kernel, bias of each LSTM layer.
+        self.set_state(self.get_state()) # adds the state ops to the graph now rather than at the first warm-up.
+
+    def prepare_model_for_running(self):
+        with self.session_scope():
+            super().prepare_model_for_running()
+
+    def generate_touch(self, prev_sample):
+        with self.session_scope():
+            return super().generate_touch(prev_sample)
+
+    def generate_touches(self, prev_samples):
+        with self.session_scope():
+            return super().generate_touches(prev_samples)
+
+    def generate_touch_candidates(self, prev_sample, candidates):
+        with self.session_scope():
+            return super().generate_touch_candidates(prev_sample, candidates)
+
+    def lstm_states(self):
+        """Returns the state variables [h, c, h, c, ...] of the model's LSTM layers."""
+        return [s for layer in self.model.layers if isinstance(layer, tf.keras.layers.LSTM) for s in layer.states]
+
+    def get_state(self):
+        """Returns a copy of the LSTM state (h, c), each with shape (layers, voices, units)."""
+        with self.session_scope():
+            states = tf.keras.backend.batch_get_value(self.lstm_states())
+        return np.array(states[0::2]), np.array(states[1::2])
+
+    def set_state(self, state):
+        """Restores a state from get_state."""
+        values = [v for h, c in zip(*state) for v in (h, c)]
+        with self.session_scope():
+            tf.keras.backend.batch_set_value(list(zip(self.lstm_states(), values)))
+
+    def warm_up(self, samples):
+        """Runs a sequence of samples (shape (steps, dimension) or (steps, voices, dimension)) through the LSTM
+        in one call, leaving it in the state it would have after stepping each, without generating anything.
+        The model takes one step at a time, so this does the same maths with NumPy and sets the state."""
+        from empi_mdrnn.numpy_mdrnn import lstm_sequence, warm_up_inputs
+        if not len(samples):
+            return
+        h, c = self.get_state()
+        kernels, recurrent_kernels, biases = self.lstm_weights[0::3], self.lstm_weights[1::3], self.lstm_weights[2::3]
+        lstm_sequence(warm_up_inputs(samples, self.voices, self.dimension), kernels, recurrent_kernels, biases, h, c)
+        self.set_state((h, c))
+
+    def close(self):
+        """Frees the session, e.g., when the model registry drops this model."""
+        self.session.close()
+
+    def load_weights_for_swap(self, model_file):
+        """Reads new weights (e.g., from fine-tuning) for swap_weights, on any thread as it may be slow."""
+        from empi_mdrnn.numpy_mdrnn import read_finite_weights
+        return [w for weights in read_finite_weights(model_file) for w in weights]
+
+    def swap_weights(self, weights):
+        """Replaces the weights between steps, keeping the LSTM state."""
+        with self.session_scope():
+            self.model.set_weights(weights)
+        self.lstm_weights = weights[:3 * self.n_rnn_layers]
@@ -0,0 +1,78 @@
+"""
+Vectorised sampling from the EMPI MDRNN's mixture density outputs.
+Replaces calling keras_mdn_layer.sample_from_output once per row: the mixture choice and
+Gaussian draw for every row (and optionally several candidates per row) are done in a few
+NumPy calls into buffers allocated once, with a seedable numpy.random.Generator.
+"""
+import numpy as np
+
+
+class MDNSampler(object):
+    """Samples MDN parameters laid out as [mus | sigmas | pi logits] (as MDN.call outputs them)
+    for a fixed dimension and number of mixtures, up to `rows` rows (e.g., voices) at a time.
+    Returned arrays are reused by the next call."""
+
+    def __init__(self, dimension, n_mixtures, rows=1, candidates=1, seed=None, dtype=np.float32):
+        self.dimension = dimension
+        self.n_mixtures = n_mixtures
+        self.rng = np.random.default_rng(seed)
+        self.allocate(rows, candidates, dtype)
+
+    def seed(self, seed):
+        """Restarts the random generator from a seed."""
+        self.rng = np.random.default_rng(seed)
+
+    def allocate(self, rows, candidates, dtype):
+        """(Re)allocates the buffers for up to rows x candidates samples from params of a dtype."""
+        self.rows = rows
+        self.candidates = candidates
+        self.dtype = np.dtype(dtype)
+        m = self.n_mixtures
+        n = rows * candidates
+        # flat buffers, viewed with the shape of each call so the views stay contiguous.
+        self._logits = np.zeros(rows * m, dtype=dtype)
+        self._gumbel = np.zeros(n * m, dtype=dtype)
+        self._choice = np.zeros(n, dtype=np.intp)
+        self._row_offsets = (np.arange(rows) * m)[:, np.newaxis]
+        self._noise = np.zeros(n * self.dimension, dtype=dtype)
+        self._mus = np.zeros(n * self.dimension, dtype=dtype)
+        self._sigs = np.zeros(n * self.dimension, dtype=dtype)
+
+    def sample_candidates(self, params, candidates, pi_temp=1.0, sigma_temp=1.0):
+        """Returns `candidates` independent samples for each row of params (shape (rows, n_params)),
+        with shape (rows, candidates, dimension)."""
+        params = np.asarray(params)
+        rows = len(params)
+        if rows > self.rows or candidates > self.candidates or params.dtype != self.dtype:
+            self.allocate(max(rows, self.rows), max(candidates, self.candidates), params.dtype)
+        d = self.dimension
+        m = self.n_mixtures
+        md = m * d
+        n = rows * candidates
+        # Mixture choice from softmax(logits / pi_temp) with the Gumbel-max trick:
+        # argmax(logits / pi_temp - log(E)), E ~ Exp(1), needs no softmax or cumulative sum.
+        logits = self._logits[:rows * m].reshape(rows, 1, m)
+        np.divide(params[:, np.newaxis, 2 * md:], pi_temp, out=logits)
+        gumbel = self._gumbel[:n * m].reshape(rows, candidates, m)
+        self.rng.standard_exponential(dtype=self.dtype, out=gumbel)
+        np.log(gumbel, out=gumbel)
+        np.subtract(logits, gumbel, out=gumbel)
+        choice = self._choice[:n].reshape(rows, candidates)
+        np.argmax(gumbel, axis=2, out=choice)
+        choice += self._row_offsets[:rows]
+        # Gaussian draw from the chosen component: mu + sigma * sqrt(sigma_temp) * N(0, 1).
+        mus = self._mus[:n * d].reshape(n, d)
+        sigs = self._sigs[:n * d].reshape(n, d)
+        np.take(params[:, :md].reshape(rows * m, d), choice.reshape(n), axis=0, out=mus)
+        np.take(params[:, md:2 * md].reshape(rows * m, d), choice.reshape(n), axis=0, out=sigs)
+        noise = self._noise[:n * d].reshape(n, d)
+        self.rng.standard_normal(dtype=self.dtype, out=noise)
+        if sigma_temp != 1.0:
+            noise *= np.sqrt(sigma_temp)
+        noise *= sigs
+        noise += mus
+        return noise.reshape(rows, candidates, d)
+
+    def sample(self, params, pi_temp=1.0, sigma_temp=1.0):
+        """Returns one sample for each row of params, with shape (rows, dimension)."""
+        return self.sample_candidates(params, 1, pi_temp=pi_temp, sigma_temp=sigma_temp)[:, 0]
@@ -0,0 +1,278 @@
+"""
+Pure-NumPy inference engine for the EMPI MDRNN.
+Runs a single stateful LSTM step and the MDN head without going through
+Keras' model.predict, which costs far more per call than the maths itself.
+Doesn't import TensorFlow (or keras_mdn_layer) at all, so it also starts quickly.
+"""
+import os
+import numpy as np
+import empi_mdrnn
+from empi_mdrnn.mdn_sampler import MDNSampler
+
+KERAS_EPSILON = 1e-7  # keras.backend.epsilon(), used in the MDN sigma activation.
+
+
+def read_h5_weights(model_file):
+    """Returns the weight arrays of a Keras .h5 file as a list of lists,
+    one list per layer in the order Keras saved (and loads) them."""
+    import h5py  # only needed when there is no weights cache.
+    layer_weights = []
+    with h5py.File(model_file, "r") as f:
+        if "model_weights" in f:
+            f = f["model_weights"]  # whole-model save rather than save_weights.
+        for layer_name in f.attrs["layer_names"]:
+            group = f[layer_name]
+            weights = [np.array(group[w], dtype=np.float32) for w in group.attrs["weight_names"]]
+            if weights:
+                layer_weights.append(weights)
+    return layer_weights
+
+
+def weights_cache_file(model_file):
+    """Returns the name of the .npz cache for a .h5 weights file."""
+    return os.path.splitext(model_file)[0] + ".npz"
+
+
+def read_weights(model_file):
+    """Returns the weight arrays of a Keras .h5 file (as read_h5_weights), from its .npz cache
+    if that is up to date. Otherwise the cache is (re)written for next time, if possible."""
+    cache_file = weights_cache_file(model_file)
+    if os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(model_file):
+        with np.load(cache_file) as cache:
+            return [[cache[f"{i}_{j}"] for j in range(cache[f"{i}_n"])] for i in range(cache["layers"])]
+    layer_weights = read_h5_weights(model_file)
+    arrays = {"layers": len(layer_weights)}
+    for i, weights in enumerate(layer_weights):
+        arrays[f"{i}_n"] = len(weights)
+        arrays.update({f"{i}_{j}": w for j, w in enumerate(weights)})
+    try:
+        np.savez(cache_file, **arrays)
+    except OSError as err:
+        print("Could not write weights cache:", err)
+    return layer_weights
+
+
+def read_finite_weights(model_file):
+    """Returns the weights of a file (as read_weights), raising ValueError if any are NaN or infinite."""
+    layer_weights = read_weights(model_file)
+    if not all(np.isfinite(w).all() for weights in layer_weights for w in weights):
+        raise ValueError(f"{model_file} has NaN or infinite weights.")
+    return layer_weights
+
+
+def glorot_uniform(fan_in, fan_out):
+    """Random kernel in the same way as an untrained Keras layer."""
+    limit = np.sqrt(6.0 / (fan_in + fan_out))
+    return np.random.uniform(-limit, limit, size=(fan_in, fan_out)).astype(np.float32)
+
+
+def hard_sigmoid_(x):
+    """In-place hard sigmoid, the recurrent activation of the (v1) Keras LSTM
+    layers that build_model creates."""
+    x *= 0.2
+    x += 0.5
+    np.clip(x, 0.0, 1.0, out=x)
+    return x
+
+
+def lstm_sequence(xs, kernels, recurrent_kernels, biases, h, c):
+    """Runs (Keras v1) LSTM layers over a sequence of inputs xs with shape (steps, voices, dimension),
+    updating their state h and c (shape (layers, voices, units)) in place. Each layer's input weights are
+    applied to the whole sequence in one matmul, so only the recurrent part is done step by step."""
+    u = h.shape[-1]
+    inputs = xs
+    for i in range(len(kernels)):
+        z_inputs = np.matmul(inputs, kernels[i]) # (steps, voices, 4 * units)
+        z_inputs += biases[i]
+        outputs = np.empty(inputs.shape[:2] + (u,), dtype=np.float32)
+        z = np.empty(z_inputs.shape[1:], dtype=np.float32)
+        tanh_c = np.empty(h.shape[1:], dtype=np.float32)
+        # views, so the loop doesn't make new ones every step. Keras gate order is i, f, c, o.
+        h_i, c_i, recurrent_kernel = h[i], c[i], recurrent_kernels[i]
+        z_if, z_i, z_f, z_c, z_o = z[:, :2 * u], z[:, :u], z[:, u:2 * u], z[:, 2 * u:3 * u], z[:, 3 * u:]
+        h_prev = h_i
+        for t in range(len(inputs)):
+            np.dot(h_prev, recurrent_kernel, out=z)
+            z += z_inputs[t]
+            hard_sigmoid_(z_if)
+            np.tanh(z_c, out=z_c)
+            hard_sigmoid_(z_o)
+            c_i *= z_f
+            z_c *= z_i
+            c_i += z_c
+            np.tanh(c_i, out=tanh_c)
+            h_prev = outputs[t]
+            np.multiply(z_o, tanh_c, out=h_prev)
+        h_i[:] = h_prev
+        inputs = outputs
+
+
+def warm_up_inputs(samples, voices, dimension):
+    """Returns scaled float32 inputs with shape (steps, voices, dimension) for warming up a network
+    from samples with shape (steps, dimension) (the same for every voice) or (steps, voices, dimension)."""
+    xs = np.asarray(samples, dtype=np.float32) * empi_mdrnn.SCALE_FACTOR
+    if xs.ndim == 2:
+        xs = xs[:, np.newaxis] # the same samples for every voice.
+    return np.broadcast_to(xs, (len(samples), voices, dimension))
+
+
+class NumpyMDRNN(object):
+    """Stateful EMPI MDRNN inference with plain NumPy matmuls.
+
+    Has the same running interface as PredictiveMusicMDRNN in NET_MODE_RUN
+    (load_model, prepare_model_for_running, generate_touch) and loads the
+    same .h5 weight files, but keeps the LSTM h/c state in preallocated
+    arrays and never touches TensorFlow for a step."""
+
+    def __init__(self, dimension=2, n_hidden_units=128, n_mixtures=5, layers=2, voices=1):
+        self.dimension = dimension
+        self.voices = voices  # independent sequences (each with its own state) stepped together.
+        self.n_hidden_units = n_hidden_units
+        self.n_rnn_layers = layers
+        self.n_mixtures = n_mixtures
+        self.n_params = n_mixtures + 2 * n_mixtures * dimension
+        # Sampling hyperparameters
+        self.pi_temp = 1.5
+        self.sigma_temp = 0.01
+        self.sampler = MDNSampler(dimension, n_mixtures, rows=voices)
+        # Untrained (random) weights until load_model is called, like the Keras model.
+        self.kernels = []
+        self.recurrent_kernels = []
+        self.biases = []
+        in_dim = dimension
+        for _ in range(layers):
+            self.kernels.append(glorot_uniform(in_dim, 4 * n_hidden_units))
+            self.recurrent_kernels.append(glorot_uniform(n_hidden_units, 4 * n_hidden_units))
+            self.biases.append(np.zeros(4 * n_hidden_units, dtype=np.float32))
+            in_dim = n_hidden_units
+        self.mdn_kernel = glorot_uniform(n_hidden_units, self.n_params)
+        self.mdn_bias = np.zeros(self.n_params, dtype=np.float32)
+        # Preallocated state and scratch buffers, one row per voice.
+        self.h = np.zeros((layers, voices, n_hidden_units), dtype=np.float32)
+        self.c = np.zeros((layers, voices, n_hidden_units), dtype=np.float32)
+        self._x = np.zeros((voices, dimension), dtype=np.float32)
+        self._z = np.zeros((voices, 4 * n_hidden_units), dtype=np.float32)
+        self._zr = np.zeros((voices, 4 * n_hidden_units), dtype=np.float32)
+        self._tanh_c = np.zeros((voices, n_hidden_units), dtype=np.float32)
+        self._params = np.zeros((voices, self.n_params), dtype=np.float32)
+        self._sig_tmp = np.zeros((voices, n_mixtures * dimension), dtype=np.float32)
+
+    def model_name(self):
+        """Returns the name of the present model for saving to disk"""
+        return "musicMDRNN" + "-dim" + str(self.dimension) + "-layers" + str(self.n_rnn_layers) + "-units" + str(self.n_hidden_units) + "-mixtures" + str(self.n_mixtures) + "-scale" + str(empi_mdrnn.SCALE_FACTOR)
+
+    def load_model(self, model_file=None):
+        if model_file is None:
+            model_file = empi_mdrnn.MODEL_DIR + self.model_name() + ".h5"
+        try:
+            layer_weights = read_weights(model_file)
+        except OSError as err:
+            print("OS error: {0}".format(err))
+            print("MDRNN could not be loaded from file:", model_file)
+            print("MDRNN is untrained.")
+            return
+        self.set_weights(layer_weights)
+
+    def set_weights(self, layer_weights):
+        """Sets weights from a per-layer list: [kernel, recurrent_kernel, bias]
+        for each LSTM layer then the six MDN arrays (mus, sigmas, pis)."""
+        lstm_weights = [w for w in layer_weights if len(w) == 3]
+        mdn_weights = [w for w in layer_weights if len(w) == 6]
+        if len(lstm_weights) != self.n_rnn_layers or len(mdn_weights) != 1:
+            raise ValueError(f"Weights have {len(lstm_weights)} LSTM layers, model {self.model_name()} needs {self.n_rnn_layers}.")
+        in_dim = self.dimension
+        for i, (kernel, recurrent_kernel, bias) in enumerate(lstm_weights):
+            if kernel.shape != (in_dim, 4 * self.n_hidden_units):
+                raise ValueError(f"LSTM layer {i} kernel has shape {kernel.shape}, model {self.model_name()} needs {(in_dim, 4 * self.n_hidden_units)}.")
+            self.kernels[i] = np.ascontiguousarray(kernel)
+            self.recurrent_kernels[i] = np.ascontiguousarray(recurrent_kernel)
+            self.biases[i] = np.ascontiguousarray(bias)
+            in_dim = self.n_hidden_units
+        mus_k, mus_b, sigs_k, sigs_b, pis_k, pis_b = mdn_weights[0]
+        # Fuse the three MDN dense layers into one matmul, same order as MDN.call.
+        self.mdn_kernel = np.ascontiguousarray(np.concatenate([mus_k, sigs_k, pis_k], axis=1))
+        self.mdn_bias = np.concatenate([mus_b, sigs_b, pis_b])
+        if self.mdn_kernel.shape != (self.n_hidden_units, self.n_params):
+            raise ValueError(f"MDN kernel has shape {self.mdn_kernel.shape}, model {self.model_name()} needs {(self.n_hidden_units, self.n_params)}.")
+
+    def load_weights_for_swap(self, model_file):
+        """Reads new weights (e.g., from fine-tuning) for swap_weights, on any thread as it may be slow."""
+        return read_finite_weights(model_file)
+
+    def swap_weights(self, weights):
+        """Replaces the weights between steps, keeping the LSTM state."""
+        self.set_weights(weights)
+
+    def prepare_model_for_running(self):
+        """Reset RNN state."""
+        self.h.fill(0)
+        self.c.fill(0)
+
+    def get_state(self):
+        """Returns a copy of the LSTM state (h, c), each with shape (layers, voices, units)."""
+        return self.h.copy(), self.c.copy()
+
+    def set_state(self, state):
+        """Restores a state from get_state."""
+        self.h[:] = state[0]
+        self.c[:] = state[1]
+
+    def warm_up(self, samples):
+        """Runs a sequence of samples (shape (steps, dimension) or (steps, voices, dimension)) through the LSTM
+        in one call, leaving it in the state it would have after stepping each, without generating anything."""
+        if len(samples):
+            lstm_sequence(warm_up_inputs(samples, self.voices, self.dimension), self.kernels, self.recurrent_kernels,
+                          self.biases, self.h, self.c)
+
+    def step(self, x):
+        """Runs one stateful forward step on (already scaled) inputs, shape (dimension,)
+        or (voices, dimension), returns the MDN parameters with shape (voices, n_params).
+        The returned array is reused on the next step."""
+        u = self.n_hidden_units
+        z = self._z
+        inp = self._x
+        inp[:] = x
+        for i in range(self.n_rnn_layers):
+            h = self.h[i]
+            c = self.c[i]
+            np.dot(inp, self.kernels[i], out=z)
+            np.dot(h, self.recurrent_kernels[i], out=self._zr)
+            z += self._zr
+            z += self.biases[i]
+            # Keras gate order is i, f, c, o.
+            hard_sigmoid_(z[:, :2 * u])
+            np.tanh(z[:, 2 * u:3 * u], out=z[:, 2 * u:3 * u])
+            hard_sigmoid_(z[:, 3 * u:])
+            c *= z[:, u:2 * u]
+            z[:, 2 * u:3 * u] *= z[:, :u]
+            c += z[:, 2 * u:3 * u]
+            np.tanh(c, out=self._tanh_c)
+            np.multiply(z[:, 3 * u:], self._tanh_c, out=h)
+            inp = h
+        params = self._params
+        np.dot(inp, self.mdn_kernel, out=params)
+        params += self.mdn_bias
+        # Sigma activation: elu(x) + 1 + epsilon == max(x, 0) + exp(min(x, 0)) + epsilon
+        md = self.n_mixtures * self.dimension
+        sigs = params[:, md:2 * md]
+        np.minimum(sigs, 0, out=self._sig_tmp)
+        np.exp(self._sig_tmp, out=self._sig_tmp)
+        np.maximum(sigs, 0, out=sigs)
+        sigs += self._sig_tmp
+        sigs += KERAS_EPSILON
+        return params
+
+    def generate_touch(self, prev_sample):
+        params = self.step(prev_sample * empi_mdrnn.SCALE_FACTOR)
+        return self.sampler.sample(params[:1], pi_temp=self.pi_temp, sigma_temp=self.sigma_temp)[0] / empi_mdrnn.SCALE_FACTOR
+
+    def generate_touches(self, prev_samples):
+        """Generates the next sample for every voice, prev_samples has shape (voices, dimension)."""
+        params = self.step(prev_samples * empi_mdrnn.SCALE_FACTOR)
+        return self.sampler.sample(params, pi_temp=self.pi_temp, sigma_temp=self.sigma_temp) / empi_mdrnn.SCALE_FACTOR
+
+    def generate_touch_candidates(self, prev_sample, candidates):
+        """Steps the model once and returns several independent samples of the next touch,
+        shape (candidates, dimension), so a caller can choose between them without another step."""
+        params = self.step(prev_sample * empi_mdrnn.SCALE_FACTOR)
+        return self.sampler.sample_candidates(params[:1], candidates, pi_temp=self.pi_temp, sigma_temp=self.sigma_temp)[0] / empi_mdrnn.SCALE_FACTOR
@@ -1,57 +1,18 @@
 """Manages Training Data for the Musical MDN and can generate fake datsets for testing."""
 import numpy as np
 import pandas as pd
-import random
+# The slicing functions used to be duplicated here, they are imported for existing callers.
+from empi_mdrnn import slice_sequence_examples, seq_to_overlapping_format, seq_to_singleton_format  # noqa: F401
+from empi_mdrnn import WindowedCorpus
 
 
 def batch_generator(seq_len, batch_size, dim, corpus):
     """Returns a generator to cut up datasets into
     batches of features and labels."""
     # generator = batch_generator(SEQ_LEN, BATCH_SIZE, 3, corpus)
-    batch_X = np.zeros((batch_size, seq_len, dim))
-    batch_y = np.zeros((batch_size, dim))
-    while True:
-        for i in range(batch_size):
-            # choose random example
-            l = random.choice(corpus)
-            last_index = len(l) - seq_len - 1
-            start_index = np.random.randint(0, high=last_index)
-            batch_X[i] = l[start_index:start_index+seq_len]
-            batch_y[i] = l[start_index+1:start_index+seq_len+1]  # .reshape(1,dim)
-        yield batch_X, batch_y
-
-
-# Functions for slicing up data
-def slice_sequence_examples(sequence, num_steps, step_size=1):
-    """ Slices a sequence into examples of length
-        num_steps with step size step_size."""
-    xs = []
-    for i in range((len(sequence) - num_steps) // step_size + 1):
-        example = sequence[(i * step_size): (i * step_size) + num_steps]
-        xs.append(example)
-    return xs
-
-
-def seq_to_overlapping_format(examples):
-    """Takes sequences of seq_len+1 and returns overlapping
-    sequences of seq_len."""
-    xs = []
-    ys = []
-    for ex in examples:
-        xs.append(ex[:-1])
-        ys.append(ex[1:])
-    return (xs, ys)
-
-
-def seq_to_singleton_format(examples):
-    """Return the examples in seq to singleton format.
-    """
-    xs = []
-    ys = []
-    for ex in examples:
-        xs.append(ex[:-1])
-        ys.append(ex[-1])
-    return (xs, ys)
+    # corpus is a list of performances with shape (length, dim), labels overlap the features one step later.
+    windows = WindowedCorpus.from_sequences(corpus, seq_len, scale=1)
+    return windows.batches(batch_size)
 
 
 def generate_data():
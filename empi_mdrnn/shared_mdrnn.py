@@ -0,0 +1,176 @@
+"""
+MDRNNs that share their weights and batch their steps, for several instruments in one process (see genai_host.py).
+Each user gets a slot that runs like a NumpyMDRNN with its own LSTM state and sampler. Slots loading the
+same weights file share one copy of the weights, and steps asked for at the same time (e.g., by each
+instrument's interaction thread) are done as one batched step: the thread that gets to step first also
+steps the slots waiting behind it, so a slot never waits for others that aren't stepping.
+"""
+import os
+from threading import Lock
+import numpy as np
+import empi_mdrnn
+from empi_mdrnn.mdn_sampler import MDNSampler
+from empi_mdrnn.numpy_mdrnn import NumpyMDRNN, lstm_sequence, read_finite_weights, warm_up_inputs
+
+
+class SharedMDRNN(object):
+    """One model's weights, used by any number of slots. Slots waiting to step are stepped together."""
+
+    def __init__(self, dimension, n_hidden_units, n_mixtures, layers, model_file=None):
+        self.net = NumpyMDRNN(dimension=dimension, n_hidden_units=n_hidden_units, n_mixtures=n_mixtures, layers=layers)
+        if model_file is not None:
+            self.net.load_model(model_file)
+        self.model_file = model_file
+        self.batch_nets = {1: self.net} # NumpyMDRNNs sharing the weights, with buffers for each number of voices.
+        self.step_lock = Lock()
+        self.waiting_lock = Lock()
+        self.waiting = [] # steps to do: [slot, inputs, MDN parameters once stepped].
+        self.steps = 0
+        self.batched_steps = 0 # steps done for more than one slot.
+
+    def batch_net(self, voices):
+        """Returns a NumpyMDRNN with the shared weights that steps this many voices."""
+        if voices not in self.batch_nets:
+            net = NumpyMDRNN(dimension=self.net.dimension, n_hidden_units=self.net.n_hidden_units,
+                             n_mixtures=self.net.n_mixtures, layers=self.net.n_rnn_layers, voices=voices)
+            net.kernels, net.recurrent_kernels, net.biases = self.net.kernels, self.net.recurrent_kernels, self.net.biases
+            net.mdn_kernel, net.mdn_bias = self.net.mdn_kernel, self.net.mdn_bias
+            self.batch_nets[voices] = net
+        return self.batch_nets[voices]
+
+    def step(self, slot, x):
+        """Steps a slot on (scaled) inputs of shape (slot.voices, dimension), along with any others
+        waiting, and returns its MDN parameters with shape (slot.voices, n_params)."""
+        request = [slot, x, None]
+        with self.waiting_lock:
+            self.waiting.append(request)
+        with self.step_lock:
+            if request[2] is None: # not stepped already by another slot's thread.
+                with self.waiting_lock:
+                    batch, self.waiting = self.waiting, []
+                self.step_batch(batch)
+        return request[2]
+
+    def step_batch(self, batch):
+        net = self.batch_net(sum(slot.voices for slot, _, _ in batch))
+        start = 0
+        for slot, _, _ in batch:
+            net.h[:, start:start + slot.voices] = slot.h
+            net.c[:, start:start + slot.voices] = slot.c
+            start += slot.voices
+        params = net.step(np.concatenate([x for _, x, _ in batch]))
+        start = 0
+        for request in batch:
+            slot = request[0]
+            slot.h[:] = net.h[:, start:start + slot.voices]
+            slot.c[:] = net.c[:, start:start + slot.voices]
+            request[2] = params[start:start + slot.voices].copy()
+            start += slot.voices
+        self.steps += 1
+        if len(batch) > 1:
+            self.batched_steps += 1
+
+
+class MDRNNSlot(object):
+    """A user of a SharedMDRNN with the NumpyMDRNN running interface, its own LSTM state and sampler.
+    Swapping in new weights (e.g., from fine-tuning) gives the slot its own copy, the others keep the shared ones."""
+
+    def __init__(self, pool, dimension=2, n_hidden_units=128, n_mixtures=5, layers=2, voices=1):
+        self.pool = pool
+        self.dimension = dimension
+        self.voices = voices
+        self.n_hidden_units = n_hidden_units
+        self.n_rnn_layers = layers
+        self.n_mixtures = n_mixtures
+        self.pi_temp = 1.5
+        self.sigma_temp = 0.01
+        self.sampler = MDNSampler(dimension, n_mixtures, rows=voices)
+        self.h = np.zeros((layers, voices, n_hidden_units), dtype=np.float32)
+        self.c = np.zeros((layers, voices, n_hidden_units), dtype=np.float32)
+        self.shared = pool.shared(self, None) # untrained until load_model is called.
+        self.own_net = None # a NumpyMDRNN with this slot's own weights, once they have been swapped.
+
+    def model_name(self):
+        return self.shared.net.model_name()
+
+    def load_model(self, model_file=None):
+        if model_file is None:
+            model_file = empi_mdrnn.MODEL_DIR + self.model_name() + ".h5"
+        self.shared = self.pool.shared(self, model_file)
+        self.own_net = None
+
+    def load_weights_for_swap(self, model_file):
+        """Reads new weights (e.g., from fine-tuning) for swap_weights, on any thread as it may be slow."""
+        return read_finite_weights(model_file)
+
+    def swap_weights(self, weights):
+        """Replaces this slot's weights between steps, keeping the LSTM state."""
+        if self.own_net is None:
+            self.own_net = NumpyMDRNN(dimension=self.dimension, n_hidden_units=self.n_hidden_units,
+                                      n_mixtures=self.n_mixtures, layers=self.n_rnn_layers, voices=self.voices)
+            self.own_net.h, self.own_net.c = self.h, self.c
+        self.own_net.set_weights(weights)
+
+    def prepare_model_for_running(self):
+        """Reset RNN state."""
+        self.h.fill(0)
+        self.c.fill(0)
+
+    def get_state(self):
+        return self.h.copy(), self.c.copy()
+
+    def set_state(self, state):
+        self.h[:] = state[0]
+        self.c[:] = state[1]
+
+    def warm_up(self, samples):
+        """Runs a sequence of samples through the LSTM in one call (as NumpyMDRNN.warm_up), with this slot's weights."""
+        net = self.own_net if self.own_net is not None else self.shared.net
+        if len(samples):
+            lstm_sequence(warm_up_inputs(samples, self.voices, self.dimension), net.kernels, net.recurrent_kernels,
+                          net.biases, self.h, self.c)
+
+    def step(self, x):
+        """Runs one stateful forward step (as NumpyMDRNN.step)."""
+        if self.own_net is not None:
+            return self.own_net.step(x)
+        return self.shared.step(self, np.broadcast_to(x, (self.voices, self.dimension)))
+
+    def generate_touch(self, prev_sample):
+        params = self.step(prev_sample * empi_mdrnn.SCALE_FACTOR)
+        return self.sampler.sample(params[:1], pi_temp=self.pi_temp, sigma_temp=self.sigma_temp)[0] / empi_mdrnn.SCALE_FACTOR
+
+    def generate_touches(self, prev_samples):
+        """Generates the next sample for every voice, prev_samples has shape (voices, dimension)."""
+        params = self.step(prev_samples * empi_mdrnn.SCALE_FACTOR)
+        return self.sampler.sample(params, pi_temp=self.pi_temp, sigma_temp=self.sigma_temp) / empi_mdrnn.SCALE_FACTOR
+
+    def generate_touch_candidates(self, prev_sample, candidates):
+        """Steps the model once and returns several independent samples of the next touch, shape (candidates, dimension)."""
+        params = self.step(prev_sample * empi_mdrnn.SCALE_FACTOR)
+        return self.sampler.sample_candidates(params[:1], candidates, pi_temp=self.pi_temp, sigma_temp=self.sigma_temp)[0] / empi_mdrnn.SCALE_FACTOR
+
+
+class SharedMDRNNPool(object):
+    """SharedMDRNNs by model shape and weights file, handing out slots that use them."""
+
+    def __init__(self):
+        self.models = {}
+        self.lock = Lock()
+
+    def slot(self, dimension=2, n_hidden_units=128, n_mixtures=5, layers=2, voices=1):
+        """Returns a new slot, which shares the weights of any others once it loads a model."""
+        return MDRNNSlot(self, dimension=dimension, n_hidden_units=n_hidden_units, n_mixtures=n_mixtures, layers=layers, voices=voices)
+
+    def shared(self, slot, model_file):
+        """Returns the SharedMDRNN for a slot's shape and weights file, loading it if it's new."""
+        key = (slot.dimension, slot.n_hidden_units, slot.n_mixtures, slot.n_rnn_layers, model_file and os.path.abspath(model_file))
+        with self.lock:
+            if key not in self.models:
+                self.models[key] = SharedMDRNN(slot.dimension, slot.n_hidden_units, slot.n_mixtures, slot.n_rnn_layers, model_file)
+            return self.models[key]
+
+    def summary(self):
+        """Returns a line for each shared model that has been stepped."""
+        return [f"{model.net.model_name()} ({model.model_file}): {model.steps} steps, {model.batched_steps} batched"
+                for model in self.models.values() if model.steps]
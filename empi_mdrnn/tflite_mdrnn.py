@@ -0,0 +1,149 @@
+"""
+TensorFlow Lite inference backend for the EMPI MDRNN.
+The .tflite model is a single stateless step: it takes the input and the LSTM h/c state
+of every layer and returns the MDN parameters and the new state, which TFLiteMDRNN keeps
+between steps. Uses tflite_runtime if it is installed, otherwise TensorFlow's interpreter.
+
+Convert .h5 models (the hyperparameters are read from the file names) with:
+    python -m empi_mdrnn.tflite_mdrnn models/*.h5
+"""
+import os
+import re
+import tempfile
+import click
+import numpy as np
+import empi_mdrnn
+from empi_mdrnn.numpy_mdrnn import NumpyMDRNN, KERAS_EPSILON, warm_up_inputs
+
+
+def tflite_file_for(model_file):
+    """Returns the name of the .tflite version of a .h5 weights file."""
+    return os.path.splitext(model_file)[0] + ".tflite"
+
+
+def convert_to_tflite(net, tflite_file):
+    """Writes a .tflite step model with the weights of a NumpyMDRNN. Imports TensorFlow."""
+    import tensorflow as tf
+    units = net.n_hidden_units
+    md = net.n_mixtures * net.dimension
+    kernels = [tf.constant(k) for k in net.kernels]
+    recurrent_kernels = [tf.constant(k) for k in net.recurrent_kernels]
+    biases = [tf.constant(b) for b in net.biases]
+    mdn_kernel = tf.constant(net.mdn_kernel)
+    mdn_bias = tf.constant(net.mdn_bias)
+
+    def hard_sigmoid(x):
+        return tf.clip_by_value(0.2 * x + 0.5, 0.0, 1.0)
+
+    @tf.function(input_signature=[tf.TensorSpec([None, net.dimension], tf.float32, name="x"),
+                                  tf.TensorSpec([net.n_rnn_layers, None, units], tf.float32, name="h"),
+                                  tf.TensorSpec([net.n_rnn_layers, None, units], tf.float32, name="c")])
+    def step(x, h, c):
+        # The same maths as NumpyMDRNN.step (Keras v1 LSTM gates i, f, c, o with hard sigmoid).
+        new_h = []
+        new_c = []
+        inp = x
+        for i in range(net.n_rnn_layers):
+            z = tf.matmul(inp, kernels[i]) + tf.matmul(h[i], recurrent_kernels[i]) + biases[i]
+            c_i = hard_sigmoid(z[:, units:2 * units]) * c[i] + hard_sigmoid(z[:, :units]) * tf.tanh(z[:, 2 * units:3 * units])
+            inp = hard_sigmoid(z[:, 3 * units:]) * tf.tanh(c_i)
+            new_h.append(inp)
+            new_c.append(c_i)
+        params = tf.matmul(inp, mdn_kernel) + mdn_bias
+        sigs = tf.nn.elu(params[:, md:2 * md]) + 1 + KERAS_EPSILON
+        params = tf.concat([params[:, :md], sigs, params[:, 2 * md:]], axis=1)
+        return {"params": params, "h": tf.stack(new_h), "c": tf.stack(new_c)}
+
+    module = tf.Module()
+    module.step = step # the converter needs a trackable object to save the step's signature.
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([step.get_concrete_function()], module)
+    with open(tflite_file, "wb") as f:
+        f.write(converter.convert())
+
+
+def tflite_file_is_current(tflite_file, model_file):
+    """True if a .tflite file exists and is at least as new as the .h5 weights it was converted from (if any)."""
+    if not os.path.exists(tflite_file):
+        return False
+    return not os.path.exists(model_file) or os.path.getmtime(tflite_file) >= os.path.getmtime(model_file)
+
+
+def tflite_interpreter(tflite_file):
+    """Returns an allocated interpreter for a .tflite file."""
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+    interpreter = Interpreter(model_path=tflite_file, num_threads=1)
+    interpreter.allocate_tensors()
+    return interpreter
+
+
+class TFLiteMDRNN(NumpyMDRNN):
+    """Stateful EMPI MDRNN inference with a TensorFlow Lite step model.
+
+    Has the same running interface as the other backends. load_model takes the .h5 weights
+    file as usual and uses the .tflite file next to it, converting it first if it is missing
+    or older than the .h5 (e.g., after retraining). The LSTM state is kept in the same arrays as NumpyMDRNN, so
+    prepare_model_for_running resets it in the same way."""
+
+    def __init__(self, dimension=2, n_hidden_units=128, n_mixtures=5, layers=2, voices=1):
+        super().__init__(dimension=dimension, n_hidden_units=n_hidden_units, n_mixtures=n_mixtures,
+                         layers=layers, voices=voices)
+        self.runner = None
+
+    def load_model(self, model_file=None):
+        if model_file is None:
+            model_file = empi_mdrnn.MODEL_DIR + self.model_name() + ".h5"
+        tflite_file = tflite_file_for(model_file)
+        if not tflite_file_is_current(tflite_file, model_file):
+            super().load_model(model_file) # weights from the .h5 (or untrained).
+            if not os.path.exists(model_file):
+                tflite_file = os.path.join(tempfile.mkdtemp(), self.model_name() + ".tflite") # don't save untrained models.
+            print("Converting MDRNN to TFLite:", tflite_file)
+            convert_to_tflite(self, tflite_file)
+        self.runner = tflite_interpreter(tflite_file).get_signature_runner()
+
+    def load_weights_for_swap(self, model_file):
+        """Returns a runner for the .tflite next to new weights, which must already have been converted."""
+        return tflite_interpreter(tflite_file_for(model_file)).get_signature_runner()
+
+    def swap_weights(self, runner):
+        self.runner = runner
+
+    def warm_up(self, samples):
+        """Runs a sequence of samples through the LSTM without generating anything. The .tflite model is a
+        single step (and the NumPy weights aren't loaded), so this steps it for each sample."""
+        for x in warm_up_inputs(samples, self.voices, self.dimension):
+            self.step(x)
+
+    def step(self, x):
+        """Runs one stateful forward step on (already scaled) inputs, shape (dimension,)
+        or (voices, dimension), returns the MDN parameters with shape (voices, n_params)."""
+        self._x[:] = x
+        outputs = self.runner(x=self._x, h=self.h, c=self.c)
+        self.h[:] = outputs["h"]
+        self.c[:] = outputs["c"]
+        return outputs["params"]
+
+
+@click.command()
+@click.argument('model_files', nargs=-1)
+def convert(model_files):
+    """Converts .h5 MDRNN weights (named like musicMDRNN-dim9-layers2-units64-mixtures5-...) to .tflite alongside them."""
+    for model_file in model_files:
+        match = re.search(r"dim(\d+)-layers(\d+)-units(\d+)-mixtures(\d+)", os.path.basename(model_file))
+        if match is None:
+            click.secho(f"{model_file}: can't read the model hyperparameters from the file name.", fg="red")
+            continue
+        dimension, layers, units, mixtures = map(int, match.groups())
+        net = NumpyMDRNN(dimension=dimension, n_hidden_units=units, n_mixtures=mixtures, layers=layers)
+        net.set_weights(empi_mdrnn.numpy_mdrnn.read_h5_weights(model_file))
+        tflite_file = tflite_file_for(model_file)
+        convert_to_tflite(net, tflite_file)
+        click.secho(f"{model_file} -> {tflite_file}", fg="green")
+
+
+if __name__ == '__main__':
+    convert()
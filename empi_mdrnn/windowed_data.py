@@ -0,0 +1,85 @@
+"""
+Training windows for the EMPI MDRNN as strided views into a corpus.
+The overlapping sequence_length + 1 windows of a performance corpus are never all
+materialised: a window is just a start index into the corpus array (which can be a
+np.memmap larger than RAM), and batches are gathered, scaled and shuffled as they are needed.
+"""
+import copy
+import numpy as np
+import empi_mdrnn
+
+
+def sequence_windows(sequence, length, step_size=1):
+    """Returns the windows of `length` rows of a sequence, shape (n_windows, length, dim),
+    as a read-only view into the sequence rather than a copy."""
+    sequence = np.asarray(sequence)
+    n_windows = max(len(sequence) - length + 1, 0)
+    windows = np.lib.stride_tricks.as_strided(sequence, shape=(n_windows, length) + sequence.shape[1:],
+                                              strides=(sequence.strides[0],) + sequence.strides,
+                                              writeable=False)
+    return windows[::step_size]
+
+
+class WindowedCorpus(object):
+    """Overlapping training examples (inputs and the same window one step later as targets)
+    from a corpus of performances stored end to end in one array of shape (rows, dimension).
+
+    boundaries gives the first row of each performance (session) so that no window spans two.
+    Only the start row of each window is stored, batches are sliced from the corpus when they
+    are requested and multiplied by scale (default empi_mdrnn.SCALE_FACTOR)."""
+
+    def __init__(self, data, sequence_length, boundaries=None, step_size=1, scale=None, seed=None):
+        self.data = data
+        self.sequence_length = sequence_length
+        self.scale = empi_mdrnn.SCALE_FACTOR if scale is None else scale
+        self.rng = np.random.default_rng(seed)
+        self.windows = sequence_windows(data, sequence_length + 1) # inputs and targets overlap by all but one row.
+        if boundaries is None:
+            boundaries = [0]
+        ends = list(boundaries[1:]) + [len(data)]
+        self.starts = np.concatenate([np.arange(start, end - sequence_length, step_size, dtype=np.int64)
+                                      for start, end in zip(boundaries, ends)] + [np.zeros(0, dtype=np.int64)])
+
+    @classmethod
+    def from_sequences(cls, sequences, sequence_length, **kwargs):
+        """Returns a WindowedCorpus of a list of performances, each of shape (length, dimension).
+        They are concatenated once, which is still much less than copying every window."""
+        lengths = [len(s) for s in sequences]
+        boundaries = np.cumsum([0] + lengths[:-1])
+        return cls(np.concatenate(sequences).astype(np.float32), sequence_length, boundaries=boundaries, **kwargs)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def subset(self, starts):
+        """Returns a WindowedCorpus of some of the windows (given by start row), sharing the data."""
+        subset = copy.copy(self)
+        subset.starts = starts
+        return subset
+
+    def split(self, val_split):
+        """Returns training and validation corpora, the validation windows are the last
+        val_split of them (as in Keras' validation_split)."""
+        n_train = int(len(self) * (1 - val_split))
+        return self.subset(self.starts[:n_train]), self.subset(self.starts[n_train:])
+
+    def n_batches(self, batch_size):
+        return -(-len(self) // batch_size)
+
+    def batch(self, indices):
+        """Returns scaled (X, y) arrays of shape (len(indices), sequence_length, dimension) for some windows."""
+        # sorted start rows read a memory-mapped corpus in order, the order within a batch doesn't matter.
+        windows = self.windows[np.sort(self.starts[indices])]
+        X = np.multiply(windows[:, :-1], self.scale, dtype=np.float32)
+        y = np.multiply(windows[:, 1:], self.scale, dtype=np.float32)
+        return X, y
+
+    def batches(self, batch_size, shuffle=True, epochs=None):
+        """Yields (X, y) batches covering every window once per epoch, in a new random order
+        each epoch if shuffle is set, for a number of epochs (forever if None, as Keras expects)."""
+        epoch = 0
+        while epochs is None or epoch < epochs:
+            order = self.rng.permutation(len(self)) if shuffle else np.arange(len(self))
+            for i in range(0, len(self), batch_size):
+                yield self.batch(order[i:i + batch_size])
+            epoch += 1
@@ -0,0 +1,207 @@
+"""
+Background fine-tuning of the MDRNN on the performer's playing.
+Recent user inputs are kept in a rolling buffer and, every so often, sent to a worker process
+that fine-tunes a training copy of the network at low priority (one thread, lowest nice
+level) so inference is never starved. A round is only kept if its validation loss on the recent
+inputs is finite and not worse than before. Accepted weights are written to a new version
+directory, which appears in one rename, then read on a background thread and swapped
+into the running network between steps by the interaction loop, keeping its LSTM state.
+"""
+import multiprocessing
+import os
+import queue
+import shutil
+import signal
+import time
+from threading import Thread, Lock
+import click
+import numpy as np
+
+BUFFER_SIZE = 4000 # most recent user inputs kept for fine-tuning.
+INTERVAL = 30.0 # seconds between fine-tuning rounds.
+EPOCHS = 2
+SEQUENCE_LENGTH = 30
+BATCH_SIZE = 32
+TOLERANCE = 0.05 # reject a round if the validation loss gets this much (relative) worse.
+VAL_SPLIT = 0.2
+KEEP_VERSIONS = 2 # fine-tuned versions kept on disk.
+
+
+def publish_weights(net, model_file, tflite):
+    """Writes a training network's weights as a Keras .h5 file, its NumPy weights cache and (if tflite) a .tflite model."""
+    from empi_mdrnn.numpy_mdrnn import NumpyMDRNN, read_weights
+    from empi_mdrnn.tflite_mdrnn import convert_to_tflite, tflite_file_for
+    net.model.save_weights(model_file)
+    layer_weights = read_weights(model_file) # also writes the .npz cache used by the NumPy backend.
+    if tflite:
+        step_net = NumpyMDRNN(dimension=net.dimension, n_hidden_units=net.n_hidden_units,
+                              n_mixtures=net.n_mixtures, layers=net.n_rnn_layers)
+        step_net.set_weights(layer_weights)
+        convert_to_tflite(step_net, tflite_file_for(model_file))
+
+
+def finetune_worker(jobs, results, base_model_file, dimension, units, mixtures, layers, publish_dir, tflite):
+    """Fine-tunes a training copy of the network on each buffer of recent inputs from jobs,
+    and puts the result of each round on results. Runs in its own process."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl-C is for the main process, which stops this one.
+    if hasattr(os, "nice"):
+        os.nice(19)
+    for variable in ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "TF_NUM_INTRAOP_THREADS", "TF_NUM_INTEROP_THREADS"]:
+        os.environ[variable] = "1"
+    import tensorflow as tf
+    import empi_mdrnn
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    net = empi_mdrnn.PredictiveMusicMDRNN(mode=empi_mdrnn.NET_MODE_TRAIN, dimension=dimension, n_hidden_units=units,
+                                          n_mixtures=mixtures, layers=layers, batch_size=BATCH_SIZE,
+                                          sequence_length=SEQUENCE_LENGTH)
+    if os.path.exists(base_model_file):
+        net.model.load_weights(base_model_file)
+    version = 0
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        rows, epochs, tolerance = job
+        train_windows, val_windows = empi_mdrnn.WindowedCorpus(rows, SEQUENCE_LENGTH).split(VAL_SPLIT)
+        if not len(train_windows) or not len(val_windows):
+            continue
+        start = time.monotonic()
+        X_val, y_val = val_windows.batch(np.arange(len(val_windows)))
+        loss_before = net.model.evaluate(X_val, y_val, batch_size=BATCH_SIZE, verbose=0)
+        previous_weights = net.model.get_weights()
+        net.model.fit(train_windows.batches(BATCH_SIZE), steps_per_epoch=train_windows.n_batches(BATCH_SIZE),
+                      epochs=epochs, verbose=0)
+        loss_after = net.model.evaluate(X_val, y_val, batch_size=BATCH_SIZE, verbose=0)
+        result = {"loss_before": float(loss_before), "loss_after": float(loss_after), "rows": len(rows),
+                  "train_time": time.monotonic() - start, "model_file": None}
+        weights_finite = all(np.isfinite(w).all() for w in net.model.get_weights())
+        if not weights_finite or not np.isfinite(loss_after) or loss_after > loss_before + tolerance * abs(loss_before):
+            net.model.set_weights(previous_weights) # throw away the round.
+            results.put(result)
+            continue
+        version += 1
+        # write everything into a temporary directory, then rename it so readers never see part of a version.
+        version_dir = os.path.join(publish_dir, f"v{version:04d}")
+        temp_dir = version_dir + ".tmp"
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        os.makedirs(temp_dir)
+        model_name = os.path.basename(base_model_file)
+        publish_weights(net, os.path.join(temp_dir, model_name), tflite)
+        os.replace(temp_dir, version_dir)
+        shutil.rmtree(os.path.join(publish_dir, f"v{version - KEEP_VERSIONS:04d}"), ignore_errors=True)
+        result.update(version=version, model_file=os.path.join(version_dir, model_name))
+        results.put(result)
+
+
+class FineTuner(object):
+    """Fine-tunes a copy of a running network on recent user inputs in a background process,
+    and swaps the new weights into the running network when apply_update is called."""
+
+    def __init__(self, net, base_model_file, publish_dir, metrics=None, ready_callback=None, buffer_size=BUFFER_SIZE,
+                 interval=INTERVAL, epochs=EPOCHS, tolerance=TOLERANCE):
+        from empi_mdrnn.tflite_mdrnn import TFLiteMDRNN # doesn't load TensorFlow.
+        self.net = net
+        self.metrics = metrics
+        self.ready_callback = ready_callback # called when new weights are ready to swap in.
+        self.interval = interval
+        self.epochs = epochs
+        self.tolerance = tolerance
+        self.buffer = np.zeros((buffer_size, net.dimension), dtype=np.float32)
+        self.added = 0 # inputs added in total, the next goes in buffer[added % buffer_size].
+        self.submitted = 0 # value of added at the last fine-tuning round.
+        self.lock = Lock()
+        self.pending = None # (result, weights) ready to swap in.
+        self.rounds = 0
+        self.rejected = 0
+        self.swap_times = []
+        os.makedirs(publish_dir, exist_ok=True)
+        context = multiprocessing.get_context("spawn") # TensorFlow isn't safe to fork.
+        self.jobs = context.Queue(maxsize=1)
+        self.results = context.Queue()
+        self.process = context.Process(target=finetune_worker, name="finetune_worker", daemon=True,
+                                       args=(self.jobs, self.results, base_model_file, net.dimension, net.n_hidden_units,
+                                             net.n_mixtures, net.n_rnn_layers, publish_dir, isinstance(net, TFLiteMDRNN)))
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.process.start()
+        Thread(target=self.submit_loop, name="finetune_submit_thread", daemon=True).start()
+        Thread(target=self.receive_loop, name="finetune_receive_thread", daemon=True).start()
+
+    def add(self, row):
+        """Adds one user input (dt, x_1, ..., x_n) to the buffer. Cheap enough for the input threads."""
+        with self.lock:
+            self.buffer[self.added % len(self.buffer)] = row
+            self.added += 1
+
+    def recent_rows(self):
+        """Returns a copy of the buffered inputs, oldest first."""
+        with self.lock:
+            if self.added <= len(self.buffer):
+                return self.buffer[:self.added].copy()
+            return np.roll(self.buffer, -(self.added % len(self.buffer)), axis=0)
+
+    def submit_loop(self):
+        """Starts a fine-tuning round every interval if there has been enough new input and the worker is free."""
+        while self.running:
+            time.sleep(self.interval)
+            if self.added - self.submitted < SEQUENCE_LENGTH + 1:
+                continue
+            rows = self.recent_rows()
+            rows = rows[np.isfinite(rows).all(axis=1)]
+            try:
+                self.jobs.put_nowait((rows, self.epochs, self.tolerance))
+                self.submitted = self.added
+            except queue.Full:
+                pass # still working on the last round.
+
+    def receive_loop(self):
+        """Reads the weights of each accepted round ready to be swapped in."""
+        while True:
+            result = self.results.get()
+            if result is None:
+                break
+            self.rounds += 1
+            if result["model_file"] is None:
+                self.rejected += 1
+                click.secho(f"Fine-tuning: rejected round (loss {result['loss_before']:.3f} -> {result['loss_after']:.3f}).", fg="red")
+                continue
+            try:
+                weights = self.net.load_weights_for_swap(result["model_file"])
+            except (OSError, ValueError) as err:
+                self.rejected += 1
+                click.secho(f"Fine-tuning: could not read version {result['version']}: {err}", fg="red")
+                continue
+            with self.lock:
+                self.pending = (result, weights)
+            if self.ready_callback is not None:
+                self.ready_callback()
+
+    def apply_update(self):
+        """Swaps in the latest accepted weights, if there are any. Call between steps on the thread stepping the network."""
+        if self.pending is None:
+            return
+        with self.lock:
+            result, weights = self.pending
+            self.pending = None
+        start = time.perf_counter()
+        self.net.swap_weights(weights)
+        swap_time = time.perf_counter() - start
+        self.swap_times.append(swap_time)
+        if self.metrics is not None:
+            self.metrics.record("weight_swap", swap_time)
+        click.secho(f"Fine-tuning: swapped in version {result['version']} (loss {result['loss_before']:.3f} -> {result['loss_after']:.3f}, "
+                    f"{result['rows']} inputs, trained in {result['train_time']:.1f}s) in {1000 * swap_time:.2f}ms.", fg="green")
+
+    def stop(self, timeout=1.0):
+        """Stops the worker, a round in progress is abandoned."""
+        self.running = False
+        self.process.terminate()
+        self.process.join(timeout=timeout)
+        self.results.put(None)
+
+    def summary(self):
+        swaps = f", swaps took up to {1000 * max(self.swap_times):.2f}ms" if self.swap_times else ""
+        return f"{self.rounds} rounds, {len(self.swap_times)} swapped in, {self.rejected} rejected{swaps}"
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Runs several GenAI MIDI module setups in one process, e.g., an OP-1 into a Volca FM next to a MicroFreak:
+    python genai_host.py configs/op1-volca-fm.toml configs/microfreak.toml
+
+Each config gets its own instance: a separate copy of genai_midi_module, loaded with GENAI_CONFIG
+set to the config, with its own queues, MIDI ports, interaction state and threads. The instances
+share one Python, NumPy and (if any use Keras) TensorFlow runtime rather than starting one each.
+Instances using the numpy backend share the weights of the same model file and batch steps that
+happen at the same time (see empi_mdrnn/shared_mdrnn.py).
+
+Instances that have the same websocket (or OSC) port get the next free one, and only the first instance
+that uses the serial port (all do unless [serial] enabled = false) opens it.
+"""
+import importlib.util
+import os
+import time
+from threading import Thread
+import click
+from empi_mdrnn.shared_mdrnn import SharedMDRNNPool
+
+MODULE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "genai_midi_module.py")
+
+
+def load_instance(name, config_file, shared_mdrnns):
+    """Loads a separate copy of genai_midi_module using a config file, and returns it."""
+    spec = importlib.util.spec_from_file_location(f"genai_instance_{name}", MODULE_FILE)
+    instance = importlib.util.module_from_spec(spec)
+    previous_config = os.environ.get("GENAI_CONFIG")
+    os.environ["GENAI_CONFIG"] = config_file
+    try:
+        spec.loader.exec_module(instance) # reads the config and sets up the instance's state.
+    finally:
+        if previous_config is None:
+            del os.environ["GENAI_CONFIG"]
+        else:
+            os.environ["GENAI_CONFIG"] = previous_config
+    instance.instance_name = name
+    instance.shared_mdrnns = shared_mdrnns
+    return instance
+
+
+@click.command()
+@click.argument('config_files', nargs=-1, required=True)
+def host(config_files):
+    """Runs an instance of the GenAI MIDI module for each of CONFIG_FILES in this process."""
+    shared_mdrnns = SharedMDRNNPool()
+    instances = {}
+    ports = set()
+    serial_taken = False
+    for config_file in config_files:
+        name = os.path.splitext(os.path.basename(config_file))[0]
+        if name in instances:
+            name = f"{name}-{len(instances)}"
+        click.secho(f"Host: loading {name} from {config_file}", fg="blue")
+        instance = load_instance(name, config_file, shared_mdrnns)
+        websocket = instance.config["websocket"]
+        if websocket["server_port"] in ports:
+            port = websocket["server_port"]
+            while port in ports:
+                port += 1
+            click.secho(f"Host: {name} websocket port {websocket['server_port']} is taken, using {port}.", fg="red")
+            websocket["server_port"] = port
+        ports.add(websocket["server_port"])
+        osc = instance.config.get("osc", {})
+        if osc.get("enabled", False):
+            port = osc.get("server_port", 5002)
+            while port in ports:
+                port += 1
+            if port != osc.get("server_port", 5002):
+                click.secho(f"Host: {name} OSC port {osc.get('server_port', 5002)} is taken, using {port}.", fg="red")
+            osc["server_port"] = port
+            ports.add(port)
+        serial_settings = instance.config.setdefault("serial", {})
+        if serial_taken:
+            serial_settings["enabled"] = False
+        serial_taken = serial_taken or serial_settings.get("enabled", True)
+        instances[name] = instance
+
+    threads = [Thread(target=instance.start_genai_midi_module, name=f"{name}_thread") for name, instance in instances.items()]
+    for thread in threads:
+        thread.start()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(0.2) # the main thread has to be free to receive Ctrl-C.
+    except KeyboardInterrupt:
+        click.secho("\nHost: Ctrl-C received, stopping instances.", fg="red")
+        for instance in instances.values():
+            instance.stop()
+        for thread in threads:
+            thread.join()
+    for line in shared_mdrnns.summary():
+        click.secho(f"Host: shared MDRNN {line}", fg="blue")
+
+
+if __name__ == '__main__':
+    host()
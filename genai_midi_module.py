@@ -1,16 +1,31 @@
 #!/usr/bin/env python
 
-import logging
 import time
+startup_start = time.monotonic()
+import contextlib
+import os
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+import json
 import numpy as np
 import queue
+import collections
 import serial
 import tomllib
-from threading import Thread
+from threading import Thread, Event, Lock, RLock
 import mido
 import click
-from websockets.sync.server import serve
+import asyncio
+import websockets
+import midi_routing
+import output_sinks
+import performance_log
+import latency_metrics
+import finetuning
+import input_queue
+import model_registry
+import osc_transport
+import empi_mdrnn # doesn't load TensorFlow, only the Keras backend does that when it's used.
 
 
 def match_midi_port_to_list(port, port_list):
@@ -24,53 +39,34 @@ def match_midi_port_to_list(port, port_list):
         return contains_list[0]
     
 
-click.secho("Opening configuration.", fg="yellow")
-with open("config.toml", "rb") as f:
+CONFIG_FILE = os.environ.get("GENAI_CONFIG", "config.toml") # e.g., GENAI_CONFIG=configs/microfreak.toml, genai_host.py sets it for each instance.
+click.secho(f"Opening configuration: {CONFIG_FILE}", fg="yellow")
+with open(CONFIG_FILE, "rb") as f:
     config = tomllib.load(f)
 
 ## Load global variables from the config file.
 VERBOSE = config["verbose"]
 dimension = config["model"]["dimension"] # retrieve dimension from the config file.
 
-# TODO: some storage for all the output channels.
-OUTPUT_CHANNELS = {}
-WS_CLIENTS = set() # storage for potential ws clients.
-
-# MIDI port opening
-click.secho("Opening MIDI port for input/output.", fg='yellow')
-try:
-    desired_input_port = match_midi_port_to_list(config["midi"]["in_device"], mido.get_input_names())
-    midi_in_port = mido.open_input(desired_input_port)
-    click.secho(f"MIDI: in port is: {midi_in_port.name}", fg='green')
-except: 
-    midi_in_port = None
-    desired_port = config["midi"]["in_device"]
-    click.secho(f"Could not open MIDI input: {desired_port}", fg='red')
-    click.secho(f"MIDI Input: {mido.get_input_names()}", fg = 'blue')
-try:
-    desired_output_port = match_midi_port_to_list(config["midi"]["out_device"], mido.get_output_names())
-    midi_out_port = mido.open_output(desired_output_port)
-    click.secho(f"MIDI: out port is: {midi_out_port.name}", fg='green')
-except:
-    midi_out_port = None
-    desired_port = config["midi"]["out_device"]
-    click.secho(f"Could not open MIDI output: {desired_port}", fg='red')
-    click.secho(f"MIDI Output: {mido.get_output_names()}", fg = 'blue')
-
-# Serial port opening
-try:
-    click.secho("Opening Serial Port for MIDI in/out.", fg='yellow')
-    ser = serial.Serial('/dev/ttyAMA0', baudrate=31250)
-except:
-    ser = None
-    click.secho("Could not open serial port, might be in development mode.", fg='red')
-
-# Import Keras and tensorflow, doing this later to make CLI more responsive.
-click.secho("Importing MDRNN.", fg='yellow')
-start_import = time.time()
-import empi_mdrnn
-import tensorflow.compat.v1 as tf
-click.secho(f"Done. That took {time.time() - start_import} seconds.", fg='yellow')
+WS_CLIENTS = {} # storage for potential ws clients: websocket -> queue of messages to send.
+WS_CLIENT_QUEUE_SIZE = config['websocket'].get('client_queue_size', 256) # messages waiting for a slow client before the oldest are dropped.
+ws_loop = None # the websocket thread's event loop, once it is running.
+ws_dropped_messages = 0 # messages dropped for slow websocket clients.
+
+# MIDI mappings compiled into lookup tables.
+MIDI_INPUT_INDEX = midi_routing.compile_midi_input(config["midi"]["input"])
+midi_output_encoder = midi_routing.MidiOutputEncoder(config["midi"]["output"])
+
+# backend = "auto" times a few steps of each of these backends (unless the config lists them) at startup and uses the fastest.
+AUTO_BACKENDS = ["numpy", "tflite"]
+AUTO_BENCHMARK_STEPS = 20
+
+# Devices are opened by open_devices() at startup.
+midi_in_port = None
+midi_out_port = None
+ser = None
+osc_receiver = None # only if [osc] is enabled.
+osc_sender = None
 
 # Interaction Loop Parameters
 # All set to false before setting is chosen.
@@ -79,10 +75,12 @@ rnn_to_rnn = False
 rnn_to_sound = False
 
 # Interactive Mapping
+# With warm-up, the RNN doesn't step each input in call mode, the user's call is run through it in one go at handover.
+CALL_WARMUP = config["interaction"]["mode"] == "callresponse" and config["interaction"].get("warmup", False)
 if config["interaction"]["mode"] == "callresponse":
     click.secho("Config: call and response mode.", fg='blue')
     # set initial conditions.
-    user_to_rnn = True
+    user_to_rnn = not CALL_WARMUP
     rnn_to_rnn = False
     rnn_to_sound = False
 elif config["interaction"]["mode"] == "polyphony":
@@ -102,289 +100,625 @@ elif config["interaction"]["mode"] == "useronly":
     rnn_to_sound = False
 
 
-def build_network(sess, compute_graph, size, dimension):
-    """Build the MDRNN, uses a high-level size parameter and dimension."""
+def open_devices():
+    """Opens the MIDI ports and serial port, and sets up an output sink for each output."""
+    global midi_in_port, midi_out_port, ser, osc_receiver, osc_sender, OUTPUT_SINKS
+    # MIDI port opening
+    click.secho("Opening MIDI port for input/output.", fg='yellow')
+    try:
+        desired_input_port = match_midi_port_to_list(config["midi"]["in_device"], mido.get_input_names())
+        midi_in_port = mido.open_input(desired_input_port)
+        click.secho(f"MIDI: in port is: {midi_in_port.name}", fg='green')
+    except:
+        midi_in_port = None
+        desired_port = config["midi"]["in_device"]
+        click.secho(f"Could not open MIDI input: {desired_port}", fg='red')
+        click.secho(f"MIDI Input: {mido.get_input_names()}", fg = 'blue')
+    try:
+        desired_output_port = match_midi_port_to_list(config["midi"]["out_device"], mido.get_output_names())
+        midi_out_port = mido.open_output(desired_output_port)
+        click.secho(f"MIDI: out port is: {midi_out_port.name}", fg='green')
+    except:
+        midi_out_port = None
+        desired_port = config["midi"]["out_device"]
+        click.secho(f"Could not open MIDI output: {desired_port}", fg='red')
+        click.secho(f"MIDI Output: {mido.get_output_names()}", fg = 'blue')
+
+    # Serial port opening
+    if not config.get("serial", {}).get("enabled", True):
+        ser = None # e.g., another instance in the same genai_host.py process has the serial port.
+    else:
+        try:
+            click.secho("Opening Serial Port for MIDI in/out.", fg='yellow')
+            ser = serial.Serial('/dev/ttyAMA0', baudrate=31250)
+        except:
+            ser = None
+            click.secho("Could not open serial port, might be in development mode.", fg='red')
+
+    # OSC over UDP
+    osc_settings = config.get("osc", {})
+    if osc_settings.get("enabled", False):
+        try:
+            osc_receiver = osc_transport.OSCReceiver(osc_settings.get("server_ip", "0.0.0.0"), osc_settings.get("server_port", 5002), handle_osc_message)
+            osc_sender = osc_transport.OSCSender(osc_settings.get("client_ip", "127.0.0.1"), osc_settings.get("client_port", 5003))
+            click.secho(f"OSC: listening on port {osc_settings.get('server_port', 5002)}, sending to {osc_sender.address[0]}:{osc_sender.address[1]}", fg='green')
+        except OSError as err:
+            osc_receiver = None
+            osc_sender = None
+            click.secho(f"Could not open OSC port: {err}", fg='red')
+
+    # Output sinks, each output gets a worker thread so slow ones don't hold up the rest.
+    OUTPUT_SINKS = []
+    if midi_out_port is not None:
+        OUTPUT_SINKS.append(output_sinks.OutputSink("midi", midi_port_send_midi, metrics))
+    if ser is not None:
+        OUTPUT_SINKS.append(output_sinks.OutputSink("serial", serial_send_midi, metrics))
+    OUTPUT_SINKS.append(output_sinks.OutputSink("websocket", websocket_send_midi, metrics))
+    if osc_sender is not None:
+        OUTPUT_SINKS.append(output_sinks.OutputSink("osc", osc_sender.send, metrics))
+
+
+def prepare_model(settings=None):
+    """Builds and loads the MDRNN (choosing the fastest backend if the config's backend is "auto")
+    and runs a warm-up step. Runs on its own thread at startup while the devices are opened.
+    settings are the [model] settings to use, by default the config's."""
+    if settings is None:
+        settings = config["model"]
+    backend = settings.get("backend", "keras")
+    voices = max(len(voice_encoders), 1)
+    if backend == "auto":
+        with startup_phase("choose backend"):
+            net = fastest_network(settings.get("auto_backends", AUTO_BACKENDS), settings["size"], settings["dimension"], voices, settings)
+    else:
+        with startup_phase("build MDRNN"):
+            net = build_network(settings["size"], settings["dimension"], voices, backend, settings)
+        with startup_phase("load weights"):
+            load_network(net, settings)
+    with startup_phase("warm up"):
+        # the first step is much slower (especially with Keras), so do it before any input.
+        time_network_step(net, steps=1)
+    click.secho(f"MDRNN Loaded: {net.model_name()}", fg="green")
+    return net
+
+
+@contextlib.contextmanager
+def startup_phase(name):
+    """Times a phase of startup."""
+    start = time.monotonic()
+    yield
+    startup_times[name] = time.monotonic() - start
+    click.secho(f"Startup: {name} took {startup_times[name]:.2f}s", fg="yellow")
+
+
+def build_network(size, dimension, voices=1, backend="keras", settings=None):
+    """Build the MDRNN, uses a high-level size parameter, dimension and inference backend.
+    voices > 1 builds a batched network stepping that many independent voices together.
+    The sampling settings come from settings (by default the config's [model])."""
+    if settings is None:
+        settings = config["model"]
     # Choose model parameters.
-    if size == 'xs':
-        click.secho("MDRNN: Using XS model.", fg="green")
-        mdrnn_units = 32
-        mdrnn_mixes = 5
-        mdrnn_layers = 2
-    elif size == 's':
-        click.secho("MDRNN: Using S model.", fg="green")
-        mdrnn_units = 64
-        mdrnn_mixes = 5
-        mdrnn_layers = 2
-    elif size == 'm':
-        click.secho("MDRNN: Using M model.", fg="green")
-        mdrnn_units = 128
-        mdrnn_mixes = 5
-        mdrnn_layers = 2
-    elif size == 'l':
-        click.secho("MDRNN: Using L model.", fg="green")
-        mdrnn_units = 256
-        mdrnn_mixes = 5
-        mdrnn_layers = 2
-    elif size == 'xl':
-        click.secho("MDRNN: Using XL model.", fg="green")
-        mdrnn_units = 512
-        mdrnn_mixes = 5
-        mdrnn_layers = 3
+    mdrnn_units, mdrnn_mixes, mdrnn_layers = empi_mdrnn.MODEL_SIZES[size]
+    click.secho(f"MDRNN: Using {size.upper()} model with the {backend} backend.", fg="green")
     # construct the model
     empi_mdrnn.MODEL_DIR = "./models/"
-    tf.keras.backend.set_session(sess)
-    with compute_graph.as_default():
-        net = empi_mdrnn.PredictiveMusicMDRNN(mode=empi_mdrnn.NET_MODE_RUN,
-                                              dimension=dimension,
-                                              n_hidden_units=mdrnn_units,
-                                              n_mixtures=mdrnn_mixes,
-                                              layers=mdrnn_layers)
-        net.pi_temp = config["model"]["pitemp"]
-        net.sigma_temp = config["model"]["sigmatemp"]
-    click.secho(f"MDRNN Loaded: {net.model_name()}", fg="green")
+    if backend == "numpy" and shared_mdrnns is not None:
+        # weights shared with (and steps batched with) other instances in this process.
+        net = shared_mdrnns.slot(dimension=dimension, n_hidden_units=mdrnn_units, n_mixtures=mdrnn_mixes,
+                                 layers=mdrnn_layers, voices=voices)
+    else:
+        net = empi_mdrnn.build_inference_model(backend,
+                                               dimension=dimension,
+                                               n_hidden_units=mdrnn_units,
+                                               n_mixtures=mdrnn_mixes,
+                                               layers=mdrnn_layers,
+                                               voices=voices)
+    apply_sampling_settings(net, settings)
     return net
 
 
-def make_prediction(sess, compute_graph, neural_net):
+def apply_sampling_settings(net, settings):
+    """Sets the MDRNN's sampling temperatures (and seed, if any) from [model] settings."""
+    net.pi_temp = settings["pitemp"]
+    net.sigma_temp = settings["sigmatemp"]
+    if "seed" in settings:
+        net.sampler.seed(settings["seed"]) # repeatable sampling, e.g., for benchmarks.
+
+
+def load_network(net, settings=None):
+    """Loads the MDRNN's weights from the config's model file, or the default file for its size."""
+    if settings is None:
+        settings = config["model"]
+    if settings["file"] != "":
+        net.load_model(model_file=settings["file"]) # load custom model.
+    else:
+        net.load_model()  # try loading from default file location.
+
+
+def network_model_file(net, settings=None):
+    """Returns the weights file the MDRNN is loaded from."""
+    if settings is None:
+        settings = config["model"]
+    if settings["file"] != "":
+        return settings["file"]
+    return empi_mdrnn.MODEL_DIR + net.model_name() + ".h5"
+
+
+def time_network_step(net, steps=AUTO_BENCHMARK_STEPS):
+    """Returns the median time (s) the MDRNN takes to generate a step, then resets its state."""
+    times = np.zeros(steps)
+    for i in range(steps):
+        start = time.perf_counter()
+        if voice_encoders:
+            net.generate_touches(voice_inputs)
+        else:
+            net.generate_touch(empi_mdrnn.random_sample(out_dim=net.dimension))
+        times[i] = time.perf_counter() - start
+    net.prepare_model_for_running()
+    return np.median(times)
+
+
+def close_network(net):
+    """Frees a network that won't be used, e.g., a Keras model's session."""
+    if net is not None and hasattr(net, "close"):
+        net.close()
+
+
+def fastest_network(backends, size, dimension, voices=1, settings=None):
+    """Builds and loads the MDRNN with each backend and returns the one that steps fastest on this machine."""
+    fastest = None
+    for backend in backends:
+        net = None
+        try:
+            net = build_network(size, dimension, voices, backend, settings)
+            load_network(net, settings)
+            time_network_step(net, steps=1) # warm up.
+            step_time = time_network_step(net)
+        except Exception as err:
+            click.secho(f"MDRNN: {backend} backend isn't available: {err}", fg="red")
+            close_network(net)
+            continue
+        click.secho(f"MDRNN: {backend} backend takes {step_time * 1000:.3f}ms per step.", fg="blue")
+        if fastest is None or step_time < fastest[0]:
+            if fastest is not None:
+                close_network(fastest[2])
+            fastest = (step_time, backend, net)
+        else:
+            close_network(net)
+    if fastest is None:
+        raise RuntimeError(f"None of the MDRNN backends {backends} could be used.")
+    click.secho(f"MDRNN: Using the {fastest[1]} backend.", fg="green")
+    return fastest[2]
+
+
+def make_prediction(neural_net):
     """Part of the interaction loop: reads input, makes predictions, outputs results"""
+    global response_steps
 
     # First deal with user --> MDRNN prediction
     if user_to_rnn and not interface_input_queue.empty():
-        item = interface_input_queue.get(block=True, timeout=None)
-        tf.keras.backend.set_session(sess)
-        with compute_graph.as_default():
-            rnn_output = neural_net.generate_touch(item)
+        received_time, queued_time, item = interface_input_queue.get(block=True, timeout=None)
+        start_time = time.monotonic()
+        rnn_output = neural_net.generate_touch(item)
+        end_time = time.monotonic()
+        metrics.record("input_queue", start_time - queued_time)
+        metrics.record("generate", end_time - start_time)
+        metrics.record("input_to_prediction", end_time - received_time)
         if rnn_to_sound:
-            rnn_output_buffer.put_nowait(rnn_output)
+            rnn_output_buffer.put_nowait((profile_generation, rnn_output))
         interface_input_queue.task_done()
 
-    # Now deal with MDRNN --> MDRNN prediction.
-    if rnn_to_rnn and rnn_output_buffer.empty() and not rnn_prediction_queue.empty():
+    # Several MDRNN voices --> themselves, all advanced with one batched step.
+    if voice_output_buffers:
+        if rnn_needs_step():
+            start_time = time.monotonic()
+            rnn_outputs = neural_net.generate_touches(voice_inputs)
+            metrics.record("generate", time.monotonic() - start_time)
+            for voice, rnn_output in enumerate(rnn_outputs):
+                voice_output_buffers[voice].put_nowait((profile_generation, rnn_output))
+                dt, x_pred = process_rnn_output(rnn_output)
+                voice_inputs[voice, 0] = dt
+                voice_inputs[voice, 1:] = x_pred
+        return
+
+    # Now deal with MDRNN --> MDRNN prediction, generating up to PLAYBACK_LOOKAHEAD steps ahead of playback.
+    if rnn_needs_step():
         item = rnn_prediction_queue.get(block=True, timeout=None)
-        tf.keras.backend.set_session(sess)
-        with compute_graph.as_default():
-            rnn_output = neural_net.generate_touch(item)
-        rnn_output_buffer.put_nowait(rnn_output)  # put it in the playback queue.
+        start_time = time.monotonic()
+        rnn_output = neural_net.generate_touch(item)
+        metrics.record("generate", time.monotonic() - start_time)
+        if CALL_WARMUP:
+            response_steps += 1
+            response_states.append((response_steps, neural_net.get_state()))
+        rnn_output_buffer.put_nowait((profile_generation, rnn_output))  # put it in the playback queue.
+        # feed the output straight back in as the next input, as it will be played.
+        dt, x_pred = process_rnn_output(rnn_output)
+        rnn_prediction_queue.put_nowait(np.concatenate([np.array([dt]), x_pred]))
         rnn_prediction_queue.task_done()
 
 
-def send_sound_command_midi(command_args):
-    """Sends sound commands via MIDI"""
+def rnn_needs_step():
+    """True when the RNN should generate its next step(s) for playback."""
+    if not rnn_to_rnn:
+        return False
+    if voice_output_buffers:
+        # step when any voice is running low, unless a slower voice already has plenty buffered.
+        depths = [q.qsize() for q in voice_output_buffers]
+        return min(depths) < PLAYBACK_LOOKAHEAD and max(depths) < VOICE_BUFFER_LIMIT
+    return rnn_output_buffer.qsize() < PLAYBACK_LOOKAHEAD and not rnn_prediction_queue.empty()
+
+
+def send_sound_command_midi(command_args, encoder=None):
+    """Sends sound commands via MIDI, using the main output mapping unless a voice's encoder is given."""
     assert len(command_args)+1 == dimension, "Dimension not same as prediction size." # Todo more useful error.
-    start_time = datetime.datetime.now()
-    outconf = config["midi"]["output"]
-    values = list(map(int, (np.ceil(command_args * 127))))
+    if encoder is None:
+        encoder = midi_output_encoder
+    midi_bytes = encoder.encode(command_args, last_midi_notes)
     if VERBOSE:
-        click.secho(f'out: {values}', fg='green')
-
-    for i in range(dimension-1):
-        if outconf[i][0] == "note_on":
-            send_midi_note_on(outconf[i][1]-1, values[i], 127) # note decremented channel (0-15)
-        if outconf[i][0] == "control_change":
-            send_control_change(outconf[i][1]-1, outconf[i][2], values[i]) # note decrement channel (0-15)
-    duration_time = (datetime.datetime.now() - start_time).total_seconds()
-    if duration_time > 0.02:
-        click.secho(f"Sound command sending took a long time: {(duration_time):.3f}s", fg="red")
-    # TODO: is it a good idea to have all this indexing? easy to screw up.
+        click.secho(f'out: {encoder.values.tolist()}', fg='green')
+    send_midi_bytes(midi_bytes) # slow outputs are warned about by their sink.
 
 
-last_midi_notes = {} # dict to store last played notes via midi
+last_midi_notes = {} # last note played on each channel (0-15), updated by MidiOutputEncoder.encode.
 
-def send_midi_note_on(channel, pitch, velocity):
-    """Send a MIDI note on (and implicitly handle note_off)"""
+def send_midi_note_offs():
+    """Sends note offs on any MIDI channels that have been used for notes."""
     global last_midi_notes
-    # stop the previous note
-    try:
-        midi_msg = mido.Message('note_off', channel=channel, note=last_midi_notes[channel], velocity=0)
+    note_channels = set(midi_output_encoder.note_channels).union(*[e.note_channels for e in voice_encoders])
+    for channel in note_channels:
+        note = last_midi_notes.pop(channel, None) # forget the note so it isn't turned off twice.
+        if note is None:
+            continue # nothing playing on this channel.
+        midi_msg = mido.Message('note_off', channel=channel, note=note, velocity=0)
         send_midi_message(midi_msg)
-        # click.secho(f"MIDI: note_off: {last_midi_notes[channel]}: msg: {midi_msg.bin()}", fg="blue")
-        # do this by whatever other channels necessary
-    except KeyError:
-        click.secho("Something wrong with turning MIDI notes off!!", fg="red")
-        pass
+        # click.secho(f"MIDI: note_off: {note}: msg: {midi_msg.bin()}", fg="blue")
+    serial_midi_encoder.reset() # send everything in full after a pause (only ever causes extra bytes).
 
-    # play the present note
-    midi_msg = mido.Message('note_on', channel=channel, note=pitch, velocity=velocity)
-    send_midi_message(midi_msg)
-    # click.secho(f"MIDI: note_on: {pitch}: msg: {midi_msg.bin()}", fg="blue")
-    last_midi_notes[channel] = pitch
 
+def send_midi_message(msg):
+    """Send a MIDI message across all required outputs"""
+    send_midi_bytes(msg.bin())
 
-def send_midi_note_offs():
-    """Sends note offs on any MIDI channels that have been used for notes."""
-    global last_midi_notes
-    outconf = config["midi"]["output"]
-    out_channels = [x[1] for x in outconf if x[0] == "note_on"]
-    for i in out_channels:
-        try:
-            midi_msg = mido.Message('note_off', channel=i-1, note=last_midi_notes[i-1], velocity=0)
-            send_midi_message(midi_msg)
-            # click.secho(f"MIDI: note_off: {last_midi_notes[i-1]}: msg: {midi_msg.bin()}", fg="blue")
-        except KeyError:
-            click.secho("Something wrong with all MIDI Note off!", fg="red")
-            pass
 
+def send_midi_bytes(data):
+    """Send a buffer of 3-byte MIDI channel messages across all required outputs.
+    Never blocks: each output has its own worker thread and queue."""
+    for sink in OUTPUT_SINKS:
+        sink.send(data)
 
-def send_control_change(channel, control, value):
-    """Send a MIDI control change message"""
-    midi_msg = mido.Message('control_change', channel=channel, control=control, value=value)
-    send_midi_message(midi_msg)
 
+def midi_port_send_midi(data):
+    """Sends MIDI bytes via the mido output port."""
+    for i in range(0, len(data), 3):
+        midi_out_port.send(mido.Message.from_bytes(data[i:i+3]))
 
-def send_midi_message(msg):
-    """Send a MIDI message across all required outputs"""
-    # TODO: this is where we can have laggy performance, careful.
-    if midi_out_port is not None:
-        midi_out_port.send(msg)
-    serial_send_midi(msg)
-    websocket_send_midi(msg)
 
+def serial_send_midi(data):
+    """Sends MIDI bytes via the very basic serial output on Raspberry Pi GPIO, in one write per buffer
+    using running status and skipping repeated CCs to save bandwidth."""
+    ser.write(serial_midi_encoder.encode(data))
 
-def serial_send_midi(message):
-    """Sends a mido MIDI message via the very basic serial output on Raspberry Pi GPIO."""
-    try:
-        ser.write(message.bin())
-    except: 
+
+def sleep_until(deadline):
+    """Sleep until a time.monotonic() deadline, spinning for the last moment for sub-ms accuracy."""
+    spin_start = deadline - PLAYBACK_SPIN_TIME
+    remaining = spin_start - time.monotonic()
+    if remaining > 0:
+        time.sleep(remaining)
+    while time.monotonic() < deadline:
         pass
 
 
-def playback_rnn_loop():
-    """Plays back RNN notes from its buffer queue. This loop blocks and should run in a separate thread."""
+def process_rnn_output(item):
+    """Returns (dt, x_pred) for an RNN output: dt positive and timescaled, x_pred clipped to [0, 1]."""
+    # click.secho(f"Raw dt: {item[0]}", fg="blue")
+    x_pred = np.minimum(np.maximum(item[1:], 0), 1)
+    dt = max(item[0], 0.001)  # stop accidental minus and zero dt.
+    dt = dt * config["model"]["timescale"] # timescale modification!
+    return dt, x_pred
+
+
+def playback_rnn_loop(output_buffer=None, encoder=None):
+    """Plays back RNN notes from its buffer queue. This loop blocks and should run in a separate thread.
+    Each buffered note is scheduled on an absolute deadline (previous deadline + dt) so time spent
+    predicting and sending doesn't accumulate as drift. A note that arrives after the previous one's
+    deadline (e.g., a response to user input) is scheduled dt after it arrives.
+    In battle mode with several voices each voice has its own thread, buffer and output encoder."""
+    global playback_underruns, played_steps
+    if output_buffer is None:
+        output_buffer = rnn_output_buffer
+    deadline = 0.0 # far in the past, so the clock starts with the first note.
     while True:
-        item = rnn_output_buffer.get(block=True, timeout=None)  # Blocks until next item is available.
-        dt = item[0]
-        # click.secho(f"Raw dt: {dt}", fg="blue")
-        x_pred = np.minimum(np.maximum(item[1:], 0), 1)
-        dt = max(dt, 0.001)  # stop accidental minus and zero dt.
-        dt = dt * config["model"]["timescale"] # timescale modification!
+        depth = output_buffer.qsize()
+        playback_depths.append(depth)
+        if depth == 0 and rnn_to_rnn and time.monotonic() - deadline < PLAYBACK_RESYNC_TIME:
+            playback_underruns += 1 # the RNN didn't keep ahead of playback.
+        generation, item = output_buffer.get(block=True, timeout=None)  # Blocks until next item is available.
+        interaction_event.set() # wake up the interaction loop to refill the buffer.
+        dt, x_pred = process_rnn_output(item)
         # click.secho(f"Sleeping for dt: {dt}", fg="blue")
 
-        time.sleep(dt)  # wait until time to play the sound
-        # put last played in queue for prediction.
-        rnn_prediction_queue.put_nowait(np.concatenate([np.array([dt]), x_pred]))
-        if rnn_to_sound:
-            # send_sound_command(x_pred)
-            send_sound_command_midi(x_pred)
-            if config["log_predictions"]:
-                logging.info("{1},rnn,{0}".format(','.join(map(str, x_pred)),
-                            datetime.datetime.now().isoformat()))
-        rnn_output_buffer.task_done()
+        now = time.monotonic()
+        if depth == 0:
+            deadline = max(deadline, now) # arrived while idle: dt counts from when it arrived, if that's after the last note.
+        elif now - deadline > PLAYBACK_RESYNC_TIME:
+            deadline = now # far behind with notes waiting, restart the clock rather than rushing.
+        deadline += dt
+        sleep_until(deadline)  # wait until time to play the sound
+        lateness = time.monotonic() - deadline
+        metrics.record("playback_lateness", lateness)
+        if lateness > PLAYBACK_LATE_WARNING:
+            click.secho(f"Playback was late: {lateness:.3f}s", fg="red")
+        with output_lock: # rnn_to_sound is checked under the lock so a handover sees every step played.
+            if rnn_to_sound and generation == profile_generation: # drop notes generated before a profile switch.
+                # send_sound_command(x_pred)
+                send_sound_command_midi(x_pred, encoder)
+                played_steps += 1
+                if config["log_predictions"]:
+                    log_performance("rnn", x_pred)
+        output_buffer.task_done()
+
+
+def print_playback_stats():
+    """Prints a summary of how full the lookahead buffer was (lateness is in the latency metrics)."""
+    if not playback_depths:
+        return
+    click.secho(f"Playback buffer depth: mean {np.mean(playback_depths):.2f} (lookahead {PLAYBACK_LOOKAHEAD}), underruns: {playback_underruns}", fg="blue")
 
 
-def construct_input_list(index, value):
+def construct_input_list(index, value, received_time=None, key=None):
     """constructs a dense input list from a sparse format (e.g., when receiving MIDI)
     """
-    global last_user_interaction_time
-    global last_user_interaction_data
     # set up dense interaction list
-    int_input = last_user_interaction_data[1:]
+    int_input = last_user_interaction_data[1:].copy()
     int_input[index] = value
+    construct_input_vector(int_input, received_time, key)
+
+
+def construct_input_vector(int_input, received_time=None, key=None):
+    """Handles a dense user input vector (without dt): logs it, queues it for the RNN and sends it thru.
+    received_time is the time.monotonic() when the input arrived, for the latency metrics.
+    key is the controller of a control change, which can be merged with others waiting for the RNN."""
+    global last_user_interaction_time
+    global last_user_interaction_data
     # log
-    values = list(map(int, (np.ceil(int_input * 127))))
     if VERBOSE:
+        values = list(map(int, (np.ceil(int_input * 127))))
         click.secho(f"in: {values}", fg='yellow')
-    logging.info("{1},interface,{0}".format(','.join(map(str, int_input)),
-                 datetime.datetime.now().isoformat()))
+    log_performance("interface", int_input)
     # put it in the queue
     dt = time.time() - last_user_interaction_time
     last_user_interaction_time = time.time()
     last_user_interaction_data = np.array([dt, *int_input])
     assert len(last_user_interaction_data) == dimension, "Input is incorrect dimension, set dimension to %r" % len(last_user_interaction_data)
     # These values are accessed by the RNN in the interaction loop function.
-    interface_input_queue.put_nowait(last_user_interaction_data)
+    queued_time = time.monotonic()
+    if received_time is None:
+        received_time = queued_time
+    metrics.record("input", queued_time - received_time)
+    if CALL_WARMUP:
+        user_history.append(last_user_interaction_data) # run through the RNN at handover.
+    else:
+        interface_input_queue.put_nowait((received_time, queued_time, last_user_interaction_data), key=key)
+    if fine_tuner is not None:
+        fine_tuner.add(last_user_interaction_data)
+    interaction_event.set() # wake up the interaction loop.
     # Send values to output if in config
     if config["interaction"]["input_thru"]:
+        with output_lock: # playback uses the same encoder and last notes.
             send_sound_command_midi(np.minimum(np.maximum(last_user_interaction_data[1:], 0), 1))
 
 
-def handle_midi_input():
-    """Handle MIDI input messages that might come from mido"""
-    if midi_in_port is None:
-        return # fail early if MIDI not open.
-    for message in midi_in_port.iter_pending():
-        if message.type == "note_on":
-            try:
-                index = config["midi"]["input"].index(["note_on", message.channel+1])
-                value = message.note / 127.0
-                construct_input_list(index,value)
-            except ValueError:
-                pass
-
-        if message.type == "control_change":
-            try:
-                index = config["midi"]["input"].index(["control_change", message.channel+1, message.control])
-                value = message.value / 127.0
-                construct_input_list(index,value)
-            except ValueError:
-                pass
-
-
-def websocket_send_midi(message):
-    """Sends a mido MIDI message via websockets if available."""
-    global ws_client
+def handle_midi_input(message):
+    with input_lock: # the mapping and dimension don't change while an input is handled.
+        handle_midi_message(message)
+
 
+def handle_midi_message(message):
+    """Handle a MIDI input message from mido, this is the input port callback so runs on mido's thread."""
+    received_time = time.monotonic()
     if message.type == "note_on":
-        ws_msg = f"/channel/{message.channel}/noteon/{message.note}/{message.velocity}"
-    elif message.type == "note_off":
-        ws_msg = f"/channel/{message.channel}/noteoff/{message.note}/{message.velocity}"
-    elif message.type == "control_change":
-        ws_msg = f"/channel/{message.channel}/cc/{message.control}/{message.value}"
+        index = MIDI_INPUT_INDEX.get(("note_on", message.channel+1))
+        if index is not None:
+            construct_input_list(index, message.note / 127.0, received_time)
+
+    if message.type == "control_change":
+        index = MIDI_INPUT_INDEX.get(("control_change", message.channel+1, message.control))
+        if index is not None:
+            construct_input_list(index, message.value / 127.0, received_time, key=index)
+
+
+WS_MESSAGE_TYPES = {midi_routing.NOTE_ON: "noteon", midi_routing.NOTE_OFF: "noteoff", midi_routing.CONTROL_CHANGE: "cc"}
+# Binary websocket protocol, used by clients that ask for this subprotocol when connecting.
+# Each frame starts with one type byte: b"M" then any number of 3-byte MIDI messages,
+# or (client to server only) b"V" then the whole input vector as little-endian float32 values in [0, 1].
+WS_BINARY_SUBPROTOCOL = "genai-midi-binary"
+WS_FRAME_MIDI = b"M"
+WS_FRAME_VECTOR = b"V"
+WS_METRICS_REQUEST = "/metrics" # any client can send this text message to get the latency metrics back as JSON.
+WS_PROFILE_REQUEST = "/profile" # "/profile" gets the profiles and loaded models as JSON, "/profile <name>" switches to a profile.
+
+def websocket_send_midi(data):
+    """Sends MIDI bytes (3-byte channel messages) via websockets if available.
+    Never blocks: the bytes are handed to the websocket thread's event loop."""
+    if not WS_CLIENTS or ws_loop is None:
+        return # nobody listening.
+    ws_loop.call_soon_threadsafe(websocket_broadcast, data)
+
+
+def websocket_text_messages(data):
+    """Returns the text protocol messages (e.g., /channel/0/cc/42/100) for some MIDI bytes."""
+    ws_msgs = []
+    for i in range(0, len(data), 3):
+        status, data_1, data_2 = data[i:i+3]
+        msg_type = WS_MESSAGE_TYPES.get(status & 0xF0)
+        if msg_type is None:
+            continue
+        ws_msgs.append(f"/channel/{status & 0x0F}/{msg_type}/{data_1}/{data_2}")
+    return ws_msgs
+
+
+def websocket_broadcast(data):
+    """Adds MIDI bytes to every client's send queue in its protocol, dropping the oldest messages
+    if a client has fallen behind. Each protocol is encoded at most once. Runs on the event loop."""
+    global ws_dropped_messages
+    text_msgs = None
+    binary_msgs = None
+    for websocket, client_queue in WS_CLIENTS.items():
+        if websocket.subprotocol == WS_BINARY_SUBPROTOCOL:
+            if binary_msgs is None:
+                binary_msgs = [WS_FRAME_MIDI + data] # the whole step in one frame.
+            ws_msgs = binary_msgs
+        else:
+            if text_msgs is None:
+                text_msgs = websocket_text_messages(data)
+                # click.secho(f"WS out: {text_msgs}")
+            ws_msgs = text_msgs
+        for ws_msg in ws_msgs:
+            if client_queue.full():
+                client_queue.get_nowait() # drop the oldest message.
+                ws_dropped_messages += 1
+            client_queue.put_nowait(ws_msg)
+
+
+def handle_websocket_text(message, received_time=None):
+    """Handle a text protocol websocket message, e.g., /channel/11/cc/1/64"""
+    if VERBOSE:
+        click.secho(f"WS: {message}", fg="red")
+    m = message.split('/')[1:]
+    msg_type = m[2]
+    chan = int(m[1]) # TODO: should this be chan+1 or -1 or something.
+    note = int(m[3])
+    vel = int(m[4])
+    if not handle_channel_message(msg_type, chan, note, vel, received_time):
+        click.secho(f"WS in: exception with message {message}", fg="red")
+
+
+def handle_channel_message(msg_type, chan, data_1, data_2, received_time=None):
+    """Handle a "noteon" or "cc" message of the text (and OSC) protocol on a channel (1-16, as in the config).
+    Returns False if it isn't mapped to an input."""
+    if msg_type == "noteon":
+        index = MIDI_INPUT_INDEX.get(("note_on", chan))
+        if index is None:
+            return False
+        construct_input_list(index, data_1 / 127.0, received_time)
+    elif msg_type == "cc":
+        index = MIDI_INPUT_INDEX.get(("control_change", chan, data_1))
+        if index is None:
+            return False
+        construct_input_list(index, data_2 / 127.0, received_time, key=index)
+    return True
+
+
+def handle_osc_message(msg_type, chan, data_1, data_2, received_time=None):
+    """Handle a /channel message from the OSC receiver's thread, e.g., /channel/11/cc 1 64"""
+    if VERBOSE:
+        click.secho(f"OSC: /channel/{chan}/{msg_type} {data_1} {data_2}", fg="red")
+    with input_lock:
+        if not handle_channel_message(msg_type, chan, data_1, data_2, received_time):
+            click.secho(f"OSC in: no input for /channel/{chan}/{msg_type} {data_1} {data_2}", fg="red")
+
+
+def handle_websocket_binary(frame, received_time=None):
+    """Handle a binary protocol websocket frame: a whole input vector (clipped to [0, 1], rejected if not finite),
+    or MIDI bytes (channels 0-15, mapped like MIDI input) which are merged into one input."""
+    frame_type, payload = frame[:1], frame[1:]
+    if frame_type == WS_FRAME_VECTOR:
+        if len(payload) != 4 * (dimension - 1):
+            click.secho(f"WS in: input vector has {len(payload) / 4} values, should be {dimension - 1}", fg="red")
+            return
+        int_input = np.frombuffer(payload, dtype="<f4").astype(np.float64)
+        if not np.isfinite(int_input).all():
+            click.secho("WS in: input vector has NaN or infinite values", fg="red")
+            return # would stay in the LSTM state.
+        construct_input_vector(np.clip(int_input, 0.0, 1.0), received_time)
+    elif frame_type == WS_FRAME_MIDI:
+        int_input = last_user_interaction_data[1:].copy()
+        changed = False
+        for i in range(0, len(payload) - 2, 3):
+            status, data_1, data_2 = payload[i:i+3]
+            if status & 0xF0 == midi_routing.NOTE_ON:
+                index = MIDI_INPUT_INDEX.get(("note_on", (status & 0x0F)+1))
+                value = data_1 / 127.0
+            elif status & 0xF0 == midi_routing.CONTROL_CHANGE:
+                index = MIDI_INPUT_INDEX.get(("control_change", (status & 0x0F)+1, data_1))
+                value = data_2 / 127.0
+            else:
+                continue
+            if index is not None:
+                int_input[index] = value
+                changed = True
+        if changed:
+            construct_input_vector(int_input, received_time)
     else:
-        return
-    # click.secho(f"WS out: {ws_msg}")
-    # Broadcast the ws_msg to all clients (sync version can't use websockets.broadcast function so doing this naively)
-    for ws_client in WS_CLIENTS.copy():
-        try:
-            ws_client.send(ws_msg)
-        except:
-            WS_CLIENTS.remove(ws_client)
+        click.secho(f"WS in: unknown binary frame type {frame_type}", fg="red")
 
 
-def websocket_handler(websocket):
+async def websocket_client_sender(websocket, client_queue):
+    """Sends queued messages to one client, so a slow client only holds up itself."""
+    while True:
+        ws_msg = await client_queue.get()
+        await websocket.send(ws_msg)
+
+
+def handle_websocket_input(message, received_time=None):
+    """Handles a websocket input message (text or binary) on the websocket input thread."""
+    with input_lock:
+        if isinstance(message, bytes):
+            handle_websocket_binary(message, received_time)
+        else:
+            handle_websocket_text(message, received_time)
+
+
+async def websocket_handler(websocket):
     """Handle websocket input messages that might arrive"""
-    global WS_CLIENTS
-    WS_CLIENTS.add(websocket) # add websocket to the client list.
+    client_queue = asyncio.Queue(maxsize=WS_CLIENT_QUEUE_SIZE)
+    WS_CLIENTS[websocket] = client_queue # add websocket to the client list.
+    sender = asyncio.create_task(websocket_client_sender(websocket, client_queue))
     # do the actual handling
-    for message in websocket:
-        click.secho(f"WS: {message}", fg="red") # TODO: fine for debug, but should be removed really.
-        m = message.split('/')[1:]
-        msg_type = m[2]
-        chan = int(m[1]) # TODO: should this be chan+1 or -1 or something.
-        note = int(m[3])
-        vel = int(m[4])
-        if msg_type == "noteon":
-            # note_on
-            try:
-                index = config["midi"]["input"].index(["note_on", chan])
-                value = note / 127.0
-                construct_input_list(index,value)
-            except ValueError:
-                click.secho(f"WS in: exception with message {message}", fg="red")
-                pass
-        elif msg_type == "cc":
-            # cc
-            try:
-                index = config["midi"]["input"].index(["control_change", chan, note])
-                value = vel / 127.0
-                construct_input_list(index,value)
-            except ValueError:
-                click.secho(f"WS in: exception with message {message}", fg="red")
-                pass
-        # global websocket
-        # ws_msg = f"/channel/{message.channel}/noteon/{message.note}/{message.velocity}"
-        # ws_msg = f"/channel/{message.channel}/noteoff/{message.note}/{message.velocity}"
-        # ws_msg = f"/channel/{message.channel}/cc/{message.control}/{message.value}"
+    try:
+        async for message in websocket:
+            received_time = time.monotonic()
+            if message == WS_METRICS_REQUEST:
+                await websocket.send(metrics.to_json()) # live latency metrics as JSON.
+            elif isinstance(message, str) and message.split(" ")[0] == WS_PROFILE_REQUEST:
+                await websocket.send(json.dumps(handle_profile_request(message)))
+            else:
+                # input_lock can be held for a while (e.g., by a profile switch), so it's taken off the event loop.
+                await asyncio.get_running_loop().run_in_executor(ws_input_executor, handle_websocket_input, message, received_time)
+    except websockets.ConnectionClosed:
+        pass
+    finally:
+        del WS_CLIENTS[websocket]
+        sender.cancel()
 
 
-def websocket_serve_loop():
-    """Threading websockets server following https://websockets.readthedocs.io/en/stable/reference/sync/server.html"""
+async def websocket_server():
+    """Runs the websocket server forever on this thread's event loop."""
+    global ws_loop
     hostname = config['websocket']['server_ip']
     port = config['websocket']['server_port']
-    with serve(websocket_handler, hostname, port) as server:
-        server.serve_forever()
+    async with websockets.serve(websocket_handler, hostname, port, subprotocols=[WS_BINARY_SUBPROTOCOL]):
+        ws_loop = asyncio.get_running_loop()
+        await asyncio.Future() # serve forever.
 
 
-def monitor_user_action():
+def websocket_serve_loop():
+    """Asyncio websockets server following https://websockets.readthedocs.io/en/stable/reference/asyncio/server.html
+    This loop blocks and should run in a separate thread."""
+    asyncio.run(websocket_server())
+
+
+def empty_queue(q):
+    """Removes everything from a queue without blocking (another thread may also be taking items)."""
+    while True:
+        try:
+            q.get_nowait()
+        except queue.Empty:
+            return
+        q.task_done()
+
+
+def monitor_user_action(neural_net):
     """Handles changing responsibility in Call-Response mode."""
     global call_response_mode
     global user_to_rnn
@@ -400,97 +734,378 @@ def monitor_user_action():
         if call_response_mode == 'call':
             click.secho("switching to response.", bg='red', fg='black')
             call_response_mode = 'response'
-            while not rnn_prediction_queue.empty():
-                # Make sure there's no inputs waiting to be predicted.
-                rnn_prediction_queue.get()
-                rnn_prediction_queue.task_done()
+            empty_queue(rnn_prediction_queue) # Make sure there's no inputs waiting to be predicted.
+            if CALL_WARMUP:
+                warm_up_network(neural_net)
             rnn_prediction_queue.put_nowait(last_user_interaction_data)  # prime the RNN queue
     else:
         # switch to call mode.
-        user_to_rnn = True
+        user_to_rnn = not CALL_WARMUP
         rnn_to_rnn = False
         rnn_to_sound = False
         if call_response_mode == 'response':
             click.secho("switching to call.", bg='blue', fg='black')
             call_response_mode = 'call'
-            # Empty the RNN queues.
-            while not rnn_output_buffer.empty():
-                # Make sure there's no actions waiting to be synthesised.
-                rnn_output_buffer.get()
-                rnn_output_buffer.task_done()
+            if CALL_WARMUP:
+                restore_played_state(neural_net)
+            # Empty the RNN queues: no actions waiting to be synthesised, or lookahead inputs waiting to be predicted.
+            empty_queue(rnn_output_buffer)
+            empty_queue(rnn_prediction_queue)
             # close sound control over MIDI
-            send_midi_note_offs()
+            with output_lock:
+                send_midi_note_offs()
+
+
+def warm_up_network(neural_net):
+    """At handover to the RNN, runs the user's call (all but the last input, which primes the RNN queue)
+    through the LSTM in one sequence call, so it responds straight away with the call in its state."""
+    global response_steps, played_steps
+    call = [user_history.popleft() for _ in range(len(user_history))]
+    start_time = time.perf_counter()
+    neural_net.warm_up(np.array(call[:-1]).reshape(-1, dimension))
+    metrics.record("warm_up", time.perf_counter() - start_time)
+    response_steps = 0
+    with output_lock:
+        played_steps = 0
+    response_states.clear()
+    response_states.append((0, neural_net.get_state()))
+
 
+def restore_played_state(neural_net):
+    """When the user takes over, rewinds the LSTM state to just after the last step taken for playback,
+    forgetting lookahead steps that won't be played. The next response carries on from there.
+    Call after rnn_to_sound is turned off, so no more steps are played."""
+    with output_lock: # a step being sent is counted first.
+        played = played_steps
+    for step, state in response_states:
+        if step == played:
+            neural_net.set_state(state)
+            break
+    response_states.clear()
 
-def setup_logging(dimension, location = "logs/"):
-    """Setup a log file and logging, requires a dimension parameter"""
-    log_file = datetime.datetime.now().isoformat().replace(":", "-")[:19] + "-" + str(dimension) + "d" +  "-mdrnn.log"  # Log file name.
+
+def interaction_loop_timeout():
+    """Returns how long the interaction loop can sleep before something needs doing."""
+    if (user_to_rnn and not interface_input_queue.empty()) or rnn_needs_step():
+        return 0 # more work waiting already.
+    if config["interaction"]["mode"] == "callresponse" and call_response_mode == 'call':
+        # wake up when the call/response threshold expires.
+        dt = last_user_interaction_time + config["interaction"]["threshold"] - time.time()
+        return min(max(dt, 0), MAX_INTERACTION_WAIT)
+    return MAX_INTERACTION_WAIT
+
+
+def interaction_step(neural_net):
+    """One pass of the interaction loop. Returns the MDRNN to use for the next pass,
+    which is a different one after switching profiles."""
+    # Sleep until there is input, an output has been played, or the call/response threshold passes.
+    interaction_event.wait(timeout=interaction_loop_timeout())
+    interaction_event.clear()
+    if pending_switch is not None:
+        neural_net = switch_profile(neural_net) # between steps, so nothing is half generated.
+    if fine_tuner is not None:
+        fine_tuner.apply_update() # new weights go in between steps.
+    make_prediction(neural_net)
+    if config["interaction"]["mode"] == "callresponse":
+        # TODO: handle other kinds of input here?
+        monitor_user_action(neural_net)
+    return neural_net
+
+
+def profile_settings(name):
+    """Returns the [model] and [midi] settings of a profile: the config's own for the default
+    profile, otherwise [profiles.<name>] on top of them ("input" and "output" are MIDI settings)."""
+    model_settings = dict(BASE_MODEL_SETTINGS)
+    midi_settings = dict(BASE_MIDI_SETTINGS)
+    if name != DEFAULT_PROFILE:
+        for key, value in config["profiles"][name].items():
+            (midi_settings if key in ("input", "output") else model_settings)[key] = value
+    return model_settings, midi_settings
+
+
+def request_profile(name):
+    """Gets a profile's MDRNN from the registry (building it on a background thread if it isn't loaded),
+    then the interaction loop switches to it. Returns an error message if it can't."""
+    if name != DEFAULT_PROFILE and name not in config.get("profiles", {}):
+        return f"unknown profile {name!r}"
+    model_settings, midi_settings = profile_settings(name)
+    if voice_encoders and model_settings["dimension"] != dimension:
+        return "battle mode voices can't switch to a profile with a different dimension"
+    if model_settings["file"] != "" and not os.path.exists(model_settings["file"]):
+        return f"model file {model_settings['file']} not found" # don't switch to an untrained MDRNN.
+
+    def load_profile():
+        global pending_switch
+        try:
+            net = registry.get(model_settings)
+        except Exception as err:
+            click.secho(f"Profile {name}: could not load the MDRNN: {err}", fg="red")
+            return
+        pending_switch = (name, model_settings, midi_settings, net)
+        interaction_event.set()
+
+    profile_executor.submit(load_profile)
+    return None
+
+
+def switch_profile(neural_net):
+    """Switches to the profile loaded by request_profile. Runs on the interaction thread between steps.
+    Playing notes are turned off and outputs generated or inputs received for the old profile are dropped."""
+    global pending_switch, active_profile, dimension, MIDI_INPUT_INDEX, midi_output_encoder, last_user_interaction_data, profile_generation
+    name, model_settings, midi_settings, net = pending_switch
+    pending_switch = None
+    start = time.perf_counter()
+    with input_lock, output_lock: # no inputs handled or notes played during the switch.
+        profile_generation += 1
+        for q in [interface_input_queue, rnn_output_buffer] + voice_output_buffers:
+            empty_queue(q)
+        primed = not rnn_prediction_queue.empty()
+        empty_queue(rnn_prediction_queue)
+        send_midi_note_offs() # with the old mapping's note channels.
+        config["model"] = model_settings
+        config["midi"] = midi_settings
+        MIDI_INPUT_INDEX = midi_routing.compile_midi_input(midi_settings["input"])
+        midi_output_encoder = midi_routing.MidiOutputEncoder(midi_settings["output"])
+        if model_settings["dimension"] != dimension:
+            dimension = model_settings["dimension"]
+            last_user_interaction_data = empi_mdrnn.random_sample(out_dim=dimension)
+            if performance_logger is not None:
+                performance_logger.close(timeout=0) # its writer thread finishes the old file.
+                setup_logging(dimension, binary=performance_logger.binary) # log values have a new length.
+        net.prepare_model_for_running()
+        apply_sampling_settings(net, model_settings) # profiles with the same model share the network.
+        response_states.clear() # the old MDRNN's states.
+        user_history.clear()
+        if primed:
+            rnn_prediction_queue.put_nowait(last_user_interaction_data)
+    active_profile = name
+    if fine_tuner is not None:
+        # stopping the old tuner's process can take up to a second, so it's done in the background.
+        Thread(target=fine_tuner.stop, name="finetune_stop_thread", daemon=True).start()
+        setup_finetuning(net)
+    registry.set_active(model_settings) # the old MDRNN may be evicted now that nothing uses it.
+    switch_time = time.perf_counter() - start
+    metrics.record("profile_switch", switch_time)
+    click.secho(f"Profile: switched to {name} ({net.model_name()}) in {1000 * switch_time:.2f}ms.", fg="green")
+    return net
+
+
+def handle_profile_request(message):
+    """Handles a websocket profile request, returns the reply."""
+    parts = message.split(" ", 1)
+    if len(parts) > 1:
+        error = request_profile(parts[1].strip())
+        if error is not None:
+            return {"error": error}
+        return {"switching": parts[1].strip()}
+    return {"active": active_profile, "profiles": [DEFAULT_PROFILE] + list(config.get("profiles", {})),
+            "loaded": registry.summary(), "memory_budget_mb": registry.memory_budget / 2**20}
+
+
+def setup_logging(dimension, location = "logs/", binary = False):
+    """Setup a log file and logging, requires a dimension parameter.
+    The log is written by its own thread, as text or (if binary) compact binary records."""
+    global performance_logger
+    extension = ".bin" if binary else ".log"
+    log_file = datetime.datetime.now().isoformat().replace(":", "-")[:19] + instance_suffix() + "-" + str(dimension) + "d" +  "-mdrnn" + extension  # Log file name.
     log_file = location + log_file
-    log_format = '%(message)s'
-    logging.basicConfig(filename=log_file,
-                        level=logging.INFO,
-                        format=log_format)
+    performance_logger = performance_log.PerformanceLogger(log_file, dimension - 1, binary=binary)
     click.secho(f'Logging enabled: {log_file}', fg='green')
 
 
+def setup_finetuning(net, location="models/finetuned/"):
+    """Starts fine-tuning a copy of the MDRNN on the user's inputs in the background."""
+    global fine_tuner
+    settings = config.get("finetune", {})
+    publish_dir = location + datetime.datetime.now().isoformat().replace(":", "-")[:19]
+    fine_tuner = finetuning.FineTuner(net, network_model_file(net), publish_dir, metrics=metrics, ready_callback=interaction_event.set,
+                                      buffer_size=settings.get("buffer", finetuning.BUFFER_SIZE),
+                                      interval=settings.get("interval", finetuning.INTERVAL),
+                                      epochs=settings.get("epochs", finetuning.EPOCHS),
+                                      tolerance=settings.get("tolerance", finetuning.TOLERANCE))
+    fine_tuner.start()
+    click.secho(f"Fine-tuning enabled: {publish_dir}", fg="green")
+
+
+def interaction_mode_name():
+    """Returns the current interaction mode for the latency metrics, including call or response in callresponse mode."""
+    if config["interaction"]["mode"] == "callresponse":
+        return f"callresponse/{call_response_mode}"
+    return config["interaction"]["mode"]
+
+
+def instance_suffix():
+    """Returns the instance's name for file names, so instances in one genai_host.py process don't write over each other."""
+    return "-" + instance_name if instance_name else ""
+
+
+def dump_latency_metrics(location="logs/"):
+    """Prints the latency metrics and saves them as JSON."""
+    metrics.print_summary()
+    metrics_file = location + datetime.datetime.now().isoformat().replace(":", "-")[:19] + instance_suffix() + "-latency.json"
+    try:
+        metrics.dump(metrics_file)
+        click.secho(f"Latency metrics saved: {metrics_file}", fg="green")
+    except OSError as err:
+        click.secho(f"Could not save latency metrics: {err}", fg="red")
+
+
+def log_performance(source, values):
+    """Log an interface or rnn event, if logging is enabled. Only queues the event, the writing happens on another thread."""
+    if performance_logger is not None:
+        performance_logger.log(source, values, time.time())
+
+
 # Set up runtime variables.
-interface_input_queue = queue.Queue()
+# user inputs waiting for the RNN, control changes from the same controller are merged so bursts can't build up latency.
+interface_input_queue = input_queue.CoalescingInputQueue(mode=config.get("input", {}).get("coalesce", "controller"),
+                                                         window=config.get("input", {}).get("window", input_queue.COALESCE_WINDOW),
+                                                         max_depth=config.get("input", {}).get("max_queue", input_queue.MAX_DEPTH))
 rnn_prediction_queue = queue.Queue()
 rnn_output_buffer = queue.Queue()
-writing_queue = queue.Queue()
 last_user_interaction_time = time.time()
 last_user_interaction_data = empi_mdrnn.random_sample(out_dim=dimension)
 rnn_prediction_queue.put_nowait(empi_mdrnn.random_sample(out_dim=dimension))
 call_response_mode = 'call'
+user_history = collections.deque(maxlen=config["interaction"].get("warmup_history", 64)) # the user's call, with warm-up.
+response_states = collections.deque(maxlen=config.get("playback", {}).get("lookahead", 1) + 2) # (step, LSTM state after it) for recent response steps.
+response_steps = 0 # response steps generated since the handover to the RNN.
+played_steps = 0 # RNN steps played since the handover (counted by playback after sending).
+performance_logger = None # set up by setup_logging.
+fine_tuner = None # set up by setup_finetuning.
+# Profiles: the config's own [model] and [midi] settings, and others in [profiles.<name>] that can be switched to.
+DEFAULT_PROFILE = "default"
+BASE_MODEL_SETTINGS = dict(config["model"])
+BASE_MIDI_SETTINGS = dict(config["midi"])
+active_profile = DEFAULT_PROFILE
+pending_switch = None # (profile, model settings, midi settings, MDRNN) waiting for the interaction loop.
+profile_generation = 0 # outputs are tagged with this, which goes up at each switch so old outputs aren't played.
+input_lock = RLock() # held while an input is handled and while switching profiles.
+output_lock = Lock() # held while playback or input thru sends a note and while switching profiles (after input_lock).
+registry = model_registry.ModelRegistry(prepare_model, config["model"].get("cache_mb", model_registry.MEMORY_BUDGET_MB) * 2**20)
+profile_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="profile_load_thread")
+ws_input_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ws_input_thread") # one thread keeps the inputs in order.
+# Set by genai_host.py when it runs this module as one of several instances in a process.
+instance_name = None
+shared_mdrnns = None # an empi_mdrnn.shared_mdrnn.SharedMDRNNPool that numpy backend MDRNNs come from.
+stop_event = Event() # set by stop() to end the interaction loop.
+interaction_event = Event() # set whenever the interaction loop has something to do.
+MAX_INTERACTION_WAIT = 1.0 # longest the interaction loop sleeps without any event (s).
+metrics = latency_metrics.LatencyMetrics(interaction_mode_name) # rolling timings of each pipeline stage per interaction mode.
+PLAYBACK_SPIN_TIME = config.get("playback", {}).get("spin_time", 0.001) # spin-wait this long before each deadline (s).
+PLAYBACK_RESYNC_TIME = config.get("playback", {}).get("resync_time", 0.1) # restart the playback clock if this far behind (s).
+PLAYBACK_LATE_WARNING = 0.02 # warn if a note is played this late (s).
+PLAYBACK_LOOKAHEAD = config.get("playback", {}).get("lookahead", 1) # RNN steps to generate ahead of playback.
+playback_depths = collections.deque(maxlen=1000) # lookahead buffer depth when each note was taken.
+playback_underruns = 0 # notes where playback had to wait for the RNN.
+VOICE_BUFFER_LIMIT = 4 * PLAYBACK_LOOKAHEAD # most steps a voice can have waiting before the others wait for it.
+
+serial_midi_encoder = midi_routing.SerialMidiEncoder(running_status=config.get("serial", {}).get("running_status", True),
+                                                     skip_repeated_cc=config.get("serial", {}).get("skip_repeated_cc", True))
+OUTPUT_SINKS = [] # set up by open_devices.
+startup_times = {} # how long each phase of startup took (s).
+STARTUP_BUDGET = 2.0 # warn if the MDRNN takes longer than this to be ready (s).
+
+# Battle mode voices: each has its own output mapping, playback buffer and (batched) LSTM state.
+if config["interaction"]["mode"] == "battle":
+    voice_encoders = [midi_routing.MidiOutputEncoder(out) for out in config["midi"].get("voice_outputs", [])]
+else:
+    voice_encoders = []
+voice_output_buffers = [queue.Queue() for _ in voice_encoders]
+voice_inputs = np.array([empi_mdrnn.random_sample(out_dim=dimension) for _ in voice_encoders])
 
 
 def start_genai_midi_module():
     """Startup function and run loop."""
     click.secho("GenAI: Running startup and main loop.", fg="blue")
-    # Build model
-    compute_graph = tf.Graph()
-    with compute_graph.as_default():
-        sess = tf.Session()
-    net = build_network(sess, compute_graph, config["model"]["size"], config["model"]["dimension"])
-
-    # Load model weights
+    # Prepare the MDRNN on another thread while devices open, so MIDI thru works as soon as possible.
     click.secho("Preparing MDRNN.", fg='yellow')
-    tf.keras.backend.set_session(sess)
-    with compute_graph.as_default():
-        if config["model"]["file"] != "":
-            net.load_model(model_file=config["model"]["file"]) # load custom model.
-        else:
-            net.load_model()  # try loading from default file location.
+    model_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model_init_thread")
+    model_future = model_executor.submit(registry.activate, config["model"])
+    with startup_phase("open devices"):
+        open_devices()
 
     # Threads
     click.secho("Preparing MDRNN thread.", fg='yellow')
-    rnn_thread = Thread(target=playback_rnn_loop, name="rnn_player_thread", daemon=True)
+    if voice_encoders:
+        click.secho(f"Battle mode with {len(voice_encoders)} voices.", fg='blue')
+        rnn_threads = [Thread(target=playback_rnn_loop, args=(voice_output_buffers[i], voice_encoders[i]), name=f"rnn_player_thread_{i}", daemon=True) for i in range(len(voice_encoders))]
+    else:
+        rnn_threads = [Thread(target=playback_rnn_loop, name="rnn_player_thread", daemon=True)]
     click.secho("Preparing websocket thread.", fg='yellow')
     ws_thread = Thread(target=websocket_serve_loop, name="ws_receiver_thread", daemon=True)
 
     # Logging
     if config["log"]:
-        setup_logging(dimension)
+        setup_logging(dimension, binary=(config.get("log_format", "text") == "binary"))
+
+    # MIDI input arrives by callback and wakes up the interaction loop.
+    if midi_in_port is not None and config["interaction"]["mode"] == "callresponse":
+        midi_in_port.callback = handle_midi_input
 
     # Start threads and run IO loop
     try:
-        rnn_thread.start()
+        for sink in OUTPUT_SINKS:
+            sink.start()
+        for rnn_thread in rnn_threads:
+            rnn_thread.start()
         ws_thread.start()
+        if osc_receiver is not None:
+            osc_receiver.start()
         click.secho("RNN Thread Started", fg="green")
-        while True:
-            make_prediction(sess, compute_graph, net)
-            if config["interaction"]["mode"] == "callresponse":
-                handle_midi_input() # handles incoming midi queue
-                # TODO: handle other kinds of input here?
-                monitor_user_action()
+        startup_times["outputs ready"] = time.monotonic() - startup_start
+        click.secho(f"Startup: inputs and outputs (and MIDI thru) ready after {startup_times['outputs ready']:.2f}s", fg="green")
+        net = model_future.result() # wait for the MDRNN.
+        model_executor.shutdown()
+        empty_queue(interface_input_queue) # inputs from before the MDRNN was ready have already gone thru.
+        startup_times["MDRNN ready"] = time.monotonic() - startup_start
+        click.secho(f"Startup: MDRNN ready after {startup_times['MDRNN ready']:.2f}s", fg="green" if startup_times["MDRNN ready"] <= STARTUP_BUDGET else "red")
+        if config.get("finetune", {}).get("enabled", False):
+            setup_finetuning(net)
+        for name in config["model"].get("preload", []):
+            profile_executor.submit(registry.get, profile_settings(name)[0]) # warm up other profiles in the background.
+        while not stop_event.is_set():
+            net = interaction_step(net)
+        shut_down(rnn_threads, ws_thread)
     except KeyboardInterrupt:
         click.secho("\nCtrl-C received... exiting.", fg='red')
-        rnn_thread.join(timeout=0.1)
-        ws_thread.join(timeout=0.1)
-        send_midi_note_offs() # stop all midi notes.
+        shut_down(rnn_threads, ws_thread)
     finally:
         click.secho("\nDone, shutting down.", fg='red')
 
 
+def stop():
+    """Stops the interaction loop, which then shuts down as for Ctrl-C. Ctrl-C only reaches the main thread,
+    so a host running this module on other threads calls this instead."""
+    stop_event.set()
+    interaction_event.set()
+
+
+def shut_down(rnn_threads, ws_thread):
+    """Turns off all notes, writes out logs and prints the run's statistics."""
+    for rnn_thread in rnn_threads:
+        rnn_thread.join(timeout=0.1)
+    ws_thread.join(timeout=0.1)
+    send_midi_note_offs() # stop all midi notes.
+    for sink in OUTPUT_SINKS:
+        sink.wait_until_sent()
+    if performance_logger is not None:
+        performance_logger.close() # write out anything still queued.
+    if fine_tuner is not None:
+        fine_tuner.stop()
+        click.secho(f"Fine-tuning: {fine_tuner.summary()}", fg="blue")
+    print_playback_stats()
+    click.secho(f"Input queue: {interface_input_queue.summary()}", fg="blue")
+    dump_latency_metrics()
+    for sink in OUTPUT_SINKS:
+        click.secho(f"Output {sink.summary()}", fg="blue")
+    if ser is not None:
+        click.secho(f"Serial MIDI: {serial_midi_encoder.summary()}", fg="blue")
+    if ws_dropped_messages:
+        click.secho(f"Websocket: dropped {ws_dropped_messages} messages for slow clients.", fg="blue")
+    if osc_receiver is not None:
+        click.secho(f"OSC: received {osc_receiver.received} messages, {osc_receiver.errors} errors.", fg="blue")
+
+
 if __name__ == '__main__':
     start_genai_midi_module()
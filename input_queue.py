@@ -0,0 +1,79 @@
+"""
+Input queue for the GenAI MIDI module.
+Turning a knob sends dozens of control changes, more than a big MDRNN can predict from one by one,
+so waiting control changes are coalesced: a new one replaces the newest waiting input if that came
+from the same controller (or, in "window" mode, from any controller within a short time window).
+Each input is a whole vector, so the newest one already holds every earlier change and nothing is lost
+but the steps in between. Notes and whole vectors are never merged. The queue also has a hard cap,
+beyond which the oldest waiting inputs are dropped, so the MDRNN can never fall far behind the player.
+"""
+import queue
+
+COALESCE_MODES = ["controller", "window", "none"]
+COALESCE_WINDOW = 0.02 # control changes this close together (s) are merged in "window" mode.
+MAX_DEPTH = 8 # most inputs waiting for the MDRNN.
+
+
+class CoalescingInputQueue(queue.Queue):
+    """Queue of (received_time, queued_time, input vector) items with dt first in the vector,
+    that merges control changes and drops the oldest inputs when full. put never blocks."""
+
+    def __init__(self, mode="controller", window=COALESCE_WINDOW, max_depth=MAX_DEPTH):
+        if mode not in COALESCE_MODES:
+            raise ValueError(f"Unknown input coalesce mode {mode!r}, should be one of {COALESCE_MODES}.")
+        super().__init__() # unbounded, put applies the cap itself.
+        self.mode = mode
+        self.window = window
+        self.max_depth = max_depth
+        self.tail_key = None # controller of the newest waiting input, None if it can't be merged into.
+        self.tail_time = 0.0 # queued time of the first input merged into the newest waiting input.
+        self.inputs = 0
+        self.merged = 0
+        self.dropped = 0
+        self.max_seen = 0
+
+    def can_merge(self, key, queued_time):
+        """True if an input from a controller (key) can be merged into the newest waiting input. Call with the mutex held."""
+        if not self.queue or key is None or self.tail_key is None or self.mode == "none":
+            return False
+        if self.mode == "controller":
+            return key == self.tail_key
+        return queued_time - self.tail_time <= self.window
+
+    def put(self, item, block=True, timeout=None, key=None):
+        """Adds an input, merging it into the newest waiting one if it's a control change that can be coalesced
+        (key is its controller, None for notes or vectors) or dropping the oldest if the queue is full."""
+        received_time, queued_time, vector = item
+        with self.not_empty:
+            self.inputs += 1
+            if self.can_merge(key, queued_time):
+                first_received, first_queued, waiting = self.queue[-1]
+                merged = vector.copy()
+                merged[0] += waiting[0] # one input at the time of the newest, after the one before the merged inputs.
+                self.queue[-1] = (first_received, first_queued, merged) # latency is measured from the oldest.
+                self.tail_key = key
+                self.merged += 1
+                return
+            if len(self.queue) >= self.max_depth:
+                _, _, oldest = self.queue.popleft()
+                self.unfinished_tasks -= 1
+                self.dropped += 1
+                if self.queue:
+                    self.queue[0] = self.queue[0][:2] + (self.queue[0][2].copy(),)
+                    self.queue[0][2][0] += oldest[0] # keep the time between inputs adding up.
+                else:
+                    vector = vector.copy()
+                    vector[0] += oldest[0]
+                    item = (received_time, queued_time, vector)
+            self.queue.append(item)
+            self.tail_key = key
+            self.tail_time = queued_time
+            self.max_seen = max(self.max_seen, len(self.queue))
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def put_nowait(self, item, key=None):
+        self.put(item, block=False, key=key)
+
+    def summary(self):
+        return f"{self.inputs} inputs, {self.merged} merged, {self.dropped} dropped, max {self.max_seen} waiting (limit {self.max_depth})"
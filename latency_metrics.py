@@ -0,0 +1,66 @@
+"""
+Latency metrics for the GenAI MIDI module.
+Keeps a rolling window of timings for each stage of the pipeline (input receipt, queueing,
+MDRNN generation, playback, output sinks) separately for each interaction mode, and
+summarises them as percentiles for the live metrics request, shutdown report and JSON dump.
+"""
+import collections
+import json
+from threading import Lock
+import click
+import numpy as np
+
+WINDOW = 2000 # timings kept for each stage and mode.
+
+
+class LatencyMetrics(object):
+    """Rolling latency timings per (interaction mode, stage)."""
+
+    def __init__(self, mode_function, window=WINDOW):
+        self.mode_function = mode_function # returns the current interaction mode's name.
+        self.window = window
+        self.timings = {}
+        self.totals = collections.Counter() # all timings recorded, not just those in the window.
+        self.lock = Lock() # held briefly by record, which may be called from any thread.
+
+    def record(self, stage, seconds):
+        """Record one timing for a stage in the current interaction mode. Safe from any thread."""
+        key = (self.mode_function(), stage)
+        with self.lock:
+            timings = self.timings.get(key)
+            if timings is None:
+                timings = self.timings[key] = collections.deque(maxlen=self.window)
+            timings.append(seconds)
+            self.totals[key] += 1
+
+    def summary(self):
+        """Returns {mode: {stage: {total, count, p50, p95, p99, max}}} with times in ms,
+        count is the number of recent timings the percentiles are over."""
+        summary = {}
+        with self.lock:
+            timings = {key: list(values) for key, values in self.timings.items()}
+            totals = dict(self.totals)
+        for (mode, stage), values in timings.items():
+            values = np.array(values) * 1000
+            if not len(values):
+                continue
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            summary.setdefault(mode, {})[stage] = {"total": totals[(mode, stage)], "count": len(values), "p50": round(p50, 3), "p95": round(p95, 3),
+                                                   "p99": round(p99, 3), "max": round(values.max(), 3)}
+        return summary
+
+    def to_json(self):
+        return json.dumps(self.summary())
+
+    def dump(self, file_name):
+        """Writes the summary to a JSON file."""
+        with open(file_name, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def print_summary(self):
+        """Prints a table of the summary."""
+        for mode, stages in sorted(self.summary().items()):
+            click.secho(f"Latency (ms) in {mode} mode:", fg="blue")
+            click.secho(f"  {'stage':<22} {'count':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}", fg="blue")
+            for stage, s in stages.items():
+                click.secho(f"  {stage:<22} {s['count']:>6} {s['p50']:>9.3f} {s['p95']:>9.3f} {s['p99']:>9.3f} {s['max']:>9.3f}", fg="blue")
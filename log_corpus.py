@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""
+Builds a training corpus from performance logs (text or binary, see performance_log.py).
+
+Each log becomes a session of rows (dt, x_1, ..., x_n), dt being the time since the previous
+event of the chosen source(s). Rows are appended to a float32 data file that is read back as a
+memory-mapped array, with an index (index.json) of the sessions and the logs already processed,
+so later runs only read new logs. Train on it with:
+    python log_corpus.py logs/ --dimension 9
+    windows = log_corpus.LogCorpus("datasets/corpus-9d-interface").windows(sequence_length=50)
+    net.train(windows)
+"""
+import glob
+import json
+import os
+import re
+import time
+import click
+import numpy as np
+import performance_log
+from empi_mdrnn import WindowedCorpus
+
+DATA_FILE = "data.f32"
+INDEX_FILE = "index.json"
+SOURCE_CHOICES = ["interface", "rnn", "all"]
+RECENT_LOG_TIME = 60 # logs changed more recently than this (s) may still be being written, they are left for a later run.
+
+
+def log_dimension(log_file):
+    """Returns the dimension in a log file's name (e.g., ...-9d-mdrnn.log), or None."""
+    match = re.search(r"-(\d+)d-mdrnn\.(log|bin)$", os.path.basename(log_file))
+    return int(match.group(1)) if match else None
+
+
+def read_log_events(log_file, source, n_values):
+    """Returns (times, values) of one source's events (or all) in a text or binary log,
+    skipping events that don't have n_values values."""
+    if log_file.endswith(".bin"):
+        records = performance_log.read_binary_log(log_file)
+        if records.dtype["values"].shape != (n_values,):
+            return np.zeros(0), np.zeros((0, n_values), dtype=np.float32)
+        if source != "all":
+            records = records[records["source"] == performance_log.SOURCES.index(source)]
+        return records["time"], records["values"]
+    times, values = [], []
+    with open(log_file) as f:
+        for line in f:
+            parts = line.rstrip("\n").split(",", 2)
+            if len(parts) < 3 or (source != "all" and parts[1] != source) or parts[2].count(",") != n_values - 1:
+                continue
+            times.append(parts[0])
+            values.append(parts[2])
+    if not times:
+        return np.zeros(0), np.zeros((0, n_values), dtype=np.float32)
+    # numpy parses the ISO timestamps and numbers in bulk, much faster than line by line.
+    times = np.array(times, dtype="datetime64[us]").astype(np.int64) / 1e6
+    values = np.array(",".join(values).split(","), dtype=np.float32).reshape(-1, n_values)
+    return times, values
+
+
+def log_to_rows(log_file, source, dimension):
+    """Returns the (dt, x_1, ..., x_n) rows of a log with shape (events - 1, dimension)."""
+    times, values = read_log_events(log_file, source, dimension - 1)
+    rows = np.zeros((max(len(times) - 1, 0), dimension), dtype=np.float32)
+    rows[:, 0] = np.diff(times) # the first event has no dt.
+    rows[:, 1:] = values[1:]
+    return rows
+
+
+class LogCorpus(object):
+    """A corpus of performance sessions stored in a directory: a float32 data file of rows
+    (dt, x_1, ..., x_n) and an index of each session's first row and its log, and of the logs already read."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.data_file = os.path.join(directory, DATA_FILE)
+        self.index_file = os.path.join(directory, INDEX_FILE)
+        self.index = {"dimension": None, "source": None, "rows": 0, "sessions": [], "logs": []}
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+
+    @property
+    def dimension(self):
+        return self.index["dimension"]
+
+    def __len__(self):
+        return self.index["rows"]
+
+    def processed_logs(self):
+        """Returns the names of the logs already read, including those without any events to use."""
+        return set(self.index["logs"])
+
+    def add_logs(self, log_files, source, dimension):
+        """Appends the sessions of logs that haven't been added before, returns the number of rows added."""
+        if self.index["dimension"] is None:
+            self.index["dimension"] = dimension
+            self.index["source"] = source
+        elif (self.index["dimension"], self.index["source"]) != (dimension, source):
+            raise ValueError(f"{self.directory} holds {self.index['source']} events with dimension {self.index['dimension']}.")
+        os.makedirs(self.directory, exist_ok=True)
+        processed = self.processed_logs()
+        added = 0
+        with open(self.data_file, "ab") as f:
+            f.truncate(self.index["rows"] * dimension * 4) # drop rows from an interrupted run that aren't in the index.
+            for log_file in sorted(log_files):
+                name = os.path.basename(log_file)
+                if name in processed or log_dimension(log_file) not in (None, dimension):
+                    continue
+                if time.time() - os.path.getmtime(log_file) < RECENT_LOG_TIME:
+                    continue
+                rows = log_to_rows(log_file, source, dimension)
+                self.index["logs"].append(name)
+                if not len(rows):
+                    continue
+                f.write(rows.tobytes())
+                self.index["sessions"].append({"log": name, "start": self.index["rows"], "rows": len(rows)})
+                self.index["rows"] += len(rows)
+                added += len(rows)
+        self.save_index()
+        return added
+
+    def save_index(self):
+        """Writes the index after the data, replacing the old one in one step."""
+        temp_file = self.index_file + ".tmp"
+        with open(temp_file, "w") as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(temp_file, self.index_file)
+
+    def data(self):
+        """Returns the rows as a read-only memory-mapped array of shape (rows, dimension)."""
+        if not len(self):
+            return np.zeros((0, self.dimension or 0), dtype=np.float32)
+        return np.memmap(self.data_file, dtype=np.float32, mode="r", shape=(len(self), self.dimension))
+
+    def session(self, i):
+        """Returns the rows of one session."""
+        session = self.index["sessions"][i]
+        return self.data()[session["start"]:session["start"] + session["rows"]]
+
+    def windows(self, sequence_length, **kwargs):
+        """Returns a WindowedCorpus of training windows over the sessions, none spanning two."""
+        return WindowedCorpus(self.data(), sequence_length,
+                              boundaries=[s["start"] for s in self.index["sessions"]], **kwargs)
+
+
+@click.command()
+@click.argument('log_dir', default="logs/")
+@click.option('--dimension', type=int, required=True, help="Model dimension (number of values + 1), logs with other dimensions are skipped.")
+@click.option('--source', type=click.Choice(SOURCE_CHOICES), default="interface", help="Events to use: the performer's, the MDRNN's or all.")
+@click.option('--output', default=None, help="Corpus directory, default: datasets/corpus-<dimension>d-<source>.")
+def build(log_dir, dimension, source, output):
+    """Adds new performance logs (.log and .bin) in LOG_DIR to a memory-mapped training corpus."""
+    if output is None:
+        output = os.path.join("datasets", f"corpus-{dimension}d-{source}")
+    corpus = LogCorpus(output)
+    log_files = glob.glob(os.path.join(log_dir, "*.log")) + glob.glob(os.path.join(log_dir, "*.bin"))
+    added = corpus.add_logs(log_files, source, dimension)
+    click.secho(f"{output}: added {added} rows, {len(corpus)} rows in {len(corpus.index['sessions'])} sessions.", fg="green")
+
+
+if __name__ == '__main__':
+    build()
@@ -0,0 +1,126 @@
+"""
+Compiled MIDI mappings for the GenAI MIDI module.
+Turns the [midi] input and output lists from the config into lookup tables once at
+startup, so handling an input message or encoding a prediction doesn't rescan the config.
+"""
+from threading import Lock
+import numpy as np
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+CONTROL_CHANGE = 0xB0
+
+
+def compile_midi_input(input_conf):
+    """Returns a dict from ("note_on", channel) or ("control_change", channel, control)
+    (channels 1-16 as in the config) to the index in the input vector."""
+    table = {}
+    for index, mapping in enumerate(input_conf):
+        key = tuple(mapping)
+        if key not in table:  # first mapping wins, same as list.index
+            table[key] = index
+    return table
+
+
+class MidiOutputEncoder(object):
+    """Compiled version of a config["midi"]["output"] list.
+
+    Encodes a prediction vector (values in [0, 1]) straight into a buffer of 3-byte MIDI
+    messages: for each note_on mapping a note_off for the previous note (if any) then
+    the new note_on, followed by one control change per control_change mapping."""
+
+    def __init__(self, output_conf):
+        self.size = len(output_conf)
+        notes = [(i, m[1] - 1) for i, m in enumerate(output_conf) if m[0] == "note_on"]
+        ccs = [(i, m[1] - 1, m[2]) for i, m in enumerate(output_conf) if m[0] == "control_change"]
+        self.note_mappings = notes  # (vector index, channel 0-15)
+        self.note_channels = [channel for _, channel in notes]
+        self.cc_index = np.array([i for i, _, _ in ccs], dtype=np.intp)
+        self.cc_bytes = np.zeros((len(ccs), 3), dtype=np.uint8)  # prefilled status and control, value filled per step.
+        self.cc_bytes[:, 0] = [CONTROL_CHANGE | channel for _, channel, _ in ccs]
+        self.cc_bytes[:, 1] = [control for _, _, control in ccs]
+        self._scaled = np.zeros(self.size)
+        self.values = np.zeros(self.size, dtype=np.int64)  # last encoded values.
+
+    def midi_values(self, command_args):
+        """Returns the 0-127 integer MIDI values for a prediction vector."""
+        np.multiply(command_args, 127, out=self._scaled)
+        np.ceil(self._scaled, out=self.values, casting='unsafe')
+        return self.values
+
+    def encode(self, command_args, last_notes):
+        """Returns a bytes buffer of MIDI messages for a prediction vector.
+        last_notes maps channel (0-15) to the last note played there and is updated."""
+        values = self.midi_values(command_args)
+        out = bytearray()
+        for index, channel in self.note_mappings:
+            last_note = last_notes.get(channel)
+            if last_note is not None:
+                out += bytes((NOTE_OFF | channel, last_note, 0))
+            pitch = int(values[index])
+            out += bytes((NOTE_ON | channel, pitch, 127))
+            last_notes[channel] = pitch
+        if len(self.cc_index):
+            self.cc_bytes[:, 2] = values[self.cc_index]
+            out += self.cc_bytes.tobytes()
+        return bytes(out)
+
+
+SERIAL_MIDI_BAUD = 31250
+SERIAL_BITS_PER_BYTE = 10 # start + 8 data + stop bits.
+
+
+class SerialMidiEncoder(object):
+    """Re-encodes 3-byte MIDI messages to use fewer bytes on a slow (31250 baud) DIN/serial wire.
+
+    With running_status the status byte is left out when it is the same as the last one sent,
+    and note offs are sent as note ons with velocity 0 so they share the note on status.
+    With skip_repeated_cc a control change is left out if that controller was last sent the same value.
+    State carries over between buffers, call reset() to send everything in full again
+    (from any thread, e.g., while the serial sink's thread is encoding)."""
+
+    def __init__(self, running_status=True, skip_repeated_cc=True):
+        self.lock = Lock() # guards the running status and last CC values.
+        self.running_status = running_status
+        self.skip_repeated_cc = skip_repeated_cc
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.buffers = 0
+        self.reset()
+
+    def reset(self):
+        """Forget the running status and last CC values."""
+        with self.lock:
+            self.last_status = None
+            self.cc_values = {} # (status, control) -> value
+
+    def encode(self, data):
+        """Returns the wire bytes for a buffer of 3-byte MIDI messages."""
+        out = bytearray()
+        with self.lock:
+            for i in range(0, len(data), 3):
+                status, data_1, data_2 = data[i:i+3]
+                if status & 0xF0 == CONTROL_CHANGE and self.skip_repeated_cc:
+                    if self.cc_values.get((status, data_1)) == data_2:
+                        continue
+                    self.cc_values[(status, data_1)] = data_2
+                if status & 0xF0 == NOTE_OFF and self.running_status:
+                    status = NOTE_ON | (status & 0x0F)
+                    data_2 = 0
+                if status != self.last_status or not self.running_status:
+                    out.append(status)
+                    self.last_status = status
+                out.append(data_1)
+                out.append(data_2)
+        self.bytes_in += len(data)
+        self.bytes_out += len(out)
+        self.buffers += 1
+        return bytes(out)
+
+    def summary(self):
+        """Returns a one-line summary of the bytes and wire time saved."""
+        if not self.buffers:
+            return "nothing sent."
+        saved = (self.bytes_in - self.bytes_out) / self.buffers
+        wire_time = saved * SERIAL_BITS_PER_BYTE / SERIAL_MIDI_BAUD
+        return f"sent {self.bytes_out} of {self.bytes_in} bytes, saved {saved:.1f} bytes ({wire_time * 1000:.2f}ms of wire time) per step"
@@ -0,0 +1,96 @@
+"""
+Registry of loaded MDRNNs for the GenAI MIDI module.
+Keeps networks that have been built, loaded and warmed up, keyed by their model settings, so
+switching back to one is instant. When their weights add up to more than the memory budget,
+the least recently used network (other than the active one) is dropped.
+"""
+from collections import OrderedDict
+from threading import Lock
+
+MEMORY_BUDGET_MB = 256
+KEY_SETTINGS = ["backend", "size", "dimension", "file"] # model settings that make a different network.
+# Memory each network of a backend takes beyond its weights (MB), and how many copies of the weights it keeps.
+# Measured as the RSS added by building one more model (TensorFlow itself is loaded once, so isn't counted):
+# about 27MB for a Keras model of size s and 36MB for size l, 1MB for TFLite.
+BACKEND_OVERHEAD_MB = {"KerasMDRNN": 26, "TFLiteMDRNN": 1}
+BACKEND_WEIGHT_COPIES = {"KerasMDRNN": 3, "TFLiteMDRNN": 2}
+
+
+def weights_memory(net):
+    """Returns the memory (bytes) of a network's float32 weights."""
+    units = net.n_hidden_units
+    lstm_weights = sum(4 * units * ((net.dimension if i == 0 else units) + units + 1) for i in range(net.n_rnn_layers))
+    mdn_weights = (units + 1) * (net.n_mixtures + 2 * net.n_mixtures * net.dimension)
+    return 4 * (lstm_weights + mdn_weights)
+
+
+def model_memory(net):
+    """Returns the approximate memory (bytes) of a network: its weights, plus its backend's
+    graph, session or interpreter."""
+    backend = type(net).__name__
+    return (BACKEND_WEIGHT_COPIES.get(backend, 1) * weights_memory(net)
+            + BACKEND_OVERHEAD_MB.get(backend, 0) * 2**20)
+
+
+def model_key(settings):
+    """Returns the registry key of some model settings."""
+    return tuple(settings.get(name, "") for name in KEY_SETTINGS)
+
+
+class ModelRegistry(object):
+    """LRU cache of networks built from model settings by build_function (e.g., a [model] section)."""
+
+    def __init__(self, build_function, memory_budget=MEMORY_BUDGET_MB * 2**20):
+        self.build_function = build_function
+        self.memory_budget = memory_budget
+        self.models = OrderedDict() # key -> network, least recently used first.
+        self.active_key = None # never evicted.
+        self.lock = Lock()
+
+    def get(self, settings):
+        """Returns the network for some model settings, building it if it isn't in the registry.
+        Building happens outside the lock and can take seconds, so call it from a background thread."""
+        key = model_key(settings)
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key]
+        net = self.build_function(settings)
+        with self.lock:
+            self.models[key] = net
+            self.models.move_to_end(key)
+            self.evict(keep=key) # not the network being returned.
+        return net
+
+    def activate(self, settings):
+        """Returns the network for some settings (as get) and marks it as the one in use."""
+        net = self.get(settings)
+        self.set_active(settings)
+        return net
+
+    def set_active(self, settings):
+        """Marks the network for some settings as the one in use, which lets the previous one be evicted."""
+        with self.lock:
+            self.active_key = model_key(settings)
+            self.evict()
+
+    def memory(self):
+        return sum(model_memory(net) for net in self.models.values())
+
+    def evict(self, keep=None):
+        """Drops least recently used networks (other than the active one and keep) until the rest fit
+        in the memory budget. Call with the lock held."""
+        for key in list(self.models):
+            if self.memory() <= self.memory_budget:
+                break
+            if key == self.active_key or key == keep:
+                continue
+            net = self.models.pop(key)
+            if hasattr(net, "close"):
+                net.close() # e.g., a Keras session.
+
+    def summary(self):
+        """Returns the networks in the registry, most recently used first."""
+        with self.lock:
+            return [{"model": net.model_name(), "backend": key[0], "active": key == self.active_key,
+                     "memory_mb": round(model_memory(net) / 2**20, 3)} for key, net in reversed(self.models.items())]
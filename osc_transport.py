@@ -0,0 +1,116 @@
+"""
+UDP/OSC transport for the GenAI MIDI module, for networked controllers where websockets' TCP
+head-of-line blocking adds jitter (e.g., on Wi-Fi).
+Uses the same addresses as the websocket text protocol with channels 1-16, either with the values as
+integer arguments (/channel/11/cc 1 64, as OSC software usually sends them) or in the address
+(/channel/11/cc/1/64). Outputs are sent with integer arguments, all the messages of a step in one bundle.
+"""
+import socket
+import time
+from threading import Thread
+import click
+from pythonosc.osc_bundle import OscBundle
+from pythonosc.osc_bundle_builder import OscBundleBuilder, IMMEDIATELY
+from pythonosc.osc_message import OscMessage
+from pythonosc.osc_message_builder import OscMessageBuilder
+
+OSC_MESSAGE_TYPES = {0x90: "noteon", 0x80: "noteoff", 0xB0: "cc"}
+MAX_DATAGRAM = 65536
+
+
+def osc_messages(dgram):
+    """Returns the OscMessages in a datagram, which may be a (nested) bundle."""
+    if OscBundle.dgram_is_bundle(dgram):
+        messages = []
+        for content in OscBundle(dgram):
+            messages.extend(osc_messages(content.dgram))
+        return messages
+    return [OscMessage(dgram)]
+
+
+def parse_channel_message(message):
+    """Returns (message type, channel, data 1, data 2) of a /channel/<n>/<type> message,
+    or None if it isn't one or its channel (1-16) or data bytes (0-127) are out of range."""
+    parts = message.address.split("/")[1:] + [str(p) for p in message.params]
+    if len(parts) != 5 or parts[0] != "channel":
+        return None
+    try:
+        chan, data_1, data_2 = int(parts[1]), int(float(parts[3])), int(float(parts[4]))
+    except (ValueError, OverflowError): # e.g., "inf".
+        return None
+    if not (1 <= chan <= 16 and 0 <= data_1 <= 127 and 0 <= data_2 <= 127):
+        return None
+    return parts[2], chan, data_1, data_2
+
+
+def encode_midi(data):
+    """Returns one datagram of OSC messages for a buffer of 3-byte MIDI channel messages (a bundle if more than one)."""
+    messages = []
+    for i in range(0, len(data), 3):
+        status, data_1, data_2 = data[i:i+3]
+        msg_type = OSC_MESSAGE_TYPES.get(status & 0xF0)
+        if msg_type is None:
+            continue
+        builder = OscMessageBuilder(address=f"/channel/{(status & 0x0F) + 1}/{msg_type}")
+        builder.add_arg(data_1)
+        builder.add_arg(data_2)
+        messages.append(builder.build())
+    if not messages:
+        return b""
+    if len(messages) == 1:
+        return messages[0].dgram
+    bundle = OscBundleBuilder(IMMEDIATELY)
+    for message in messages:
+        bundle.add_content(message)
+    return bundle.build().dgram
+
+
+class OSCReceiver(object):
+    """Receives OSC datagrams on a UDP port from a thread, calling handle(type, channel, data 1, data 2, received time)
+    for each /channel message. The thread only blocks waiting for datagrams, never the interaction loop."""
+
+    def __init__(self, ip, port, handle):
+        self.handle = handle
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((ip, port))
+        self.received = 0
+        self.errors = 0
+        self.thread = Thread(target=self.run, name="osc_receiver_thread", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while True:
+            dgram = self.socket.recv(MAX_DATAGRAM)
+            received_time = time.monotonic()
+            try:
+                messages = osc_messages(dgram)
+            except Exception as err:
+                self.errors += 1
+                click.secho(f"OSC in: could not parse datagram ({err})", fg="red")
+                continue
+            for message in messages:
+                self.received += 1
+                parsed = parse_channel_message(message)
+                if parsed is None:
+                    click.secho(f"OSC in: unknown or out of range message {message.address} {message.params}", fg="red")
+                    continue
+                try:
+                    self.handle(*parsed, received_time)
+                except Exception as err:
+                    self.errors += 1
+                    click.secho(f"OSC in: error handling {message.address} {message.params} ({err})", fg="red")
+
+
+class OSCSender(object):
+    """Sends MIDI bytes as OSC datagrams to one address, e.g., as the write function of an output sink."""
+
+    def __init__(self, ip, port):
+        self.address = (ip, port)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, data):
+        dgram = encode_midi(data)
+        if len(dgram):
+            self.socket.sendto(dgram, self.address)
@@ -0,0 +1,71 @@
+"""
+Output sinks for the GenAI MIDI module.
+Each output (USB MIDI, GPIO serial, websockets) gets its own worker thread and queue,
+so a slow output can't hold up the others or the interaction loop.
+"""
+import collections
+import queue
+import time
+from threading import Thread
+import click
+import numpy as np
+
+SLOW_SINK_WARNING = 0.02 # warn if bytes take longer than this to be written (s).
+
+
+class OutputSink(object):
+    """Writes MIDI byte buffers to one output from a worker thread and measures how long it takes."""
+
+    def __init__(self, name, write, metrics=None):
+        self.name = name
+        self.write = write # function taking a bytes buffer of MIDI messages.
+        self.metrics = metrics # optional LatencyMetrics, gets a sink_<name> timing for each buffer.
+        self.metrics_stage = f"sink_{name}"
+        self.queue = queue.Queue() # unbounded: MIDI outputs can't drop (e.g.) note offs.
+        self.latencies = collections.deque(maxlen=1000) # queued to written (s).
+        self.write_times = collections.deque(maxlen=1000) # time in write (s).
+        self.depths = collections.deque(maxlen=1000) # queue depth when each buffer was added.
+        self.errors = 0
+        self.thread = Thread(target=self.run, name=f"{name}_sink_thread", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def send(self, data):
+        """Queue MIDI bytes for this output, never blocks."""
+        self.depths.append(self.queue.qsize())
+        self.queue.put_nowait((time.monotonic(), data))
+
+    def run(self):
+        """Writes queued buffers in order. This loop blocks and should run in a separate thread."""
+        while True:
+            queued_time, data = self.queue.get(block=True, timeout=None)
+            start_time = time.monotonic()
+            try:
+                self.write(data)
+            except Exception as err:
+                self.errors += 1
+                if self.errors == 1:
+                    click.secho(f"Output {self.name}: could not write ({err}), further errors are counted.", fg="red")
+            end_time = time.monotonic()
+            self.write_times.append(end_time - start_time)
+            self.latencies.append(end_time - queued_time)
+            if self.metrics is not None:
+                self.metrics.record(self.metrics_stage, end_time - queued_time)
+            if end_time - queued_time > SLOW_SINK_WARNING:
+                click.secho(f"Sound command sending took a long time on {self.name}: {(end_time - queued_time):.3f}s (write {(end_time - start_time):.3f}s)", fg="red")
+            self.queue.task_done()
+
+    def wait_until_sent(self, timeout=0.5):
+        """Waits (up to timeout) for everything queued to be written, e.g., note offs at shutdown."""
+        end_time = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < end_time:
+            time.sleep(0.005)
+
+    def summary(self):
+        """Returns a one-line summary of latency and queue depth for this output."""
+        if not self.latencies:
+            return f"{self.name}: nothing sent."
+        latency = np.array(self.latencies) * 1000
+        p50, p95 = np.percentile(latency, [50, 95])
+        return f"{self.name}: latency p50 {p50:.3f}ms, p95 {p95:.3f}ms, max {latency.max():.3f}ms, write mean {np.mean(self.write_times) * 1000:.3f}ms, max queue {max(self.depths)}, errors {self.errors}"
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Performance logging for the GenAI MIDI module.
+Events are queued on the real-time threads and formatted/written by a separate thread,
+either as the usual text lines (<timestamp>,interface|rnn,<values>) or as compact binary records.
+
+Binary logs start with a header (MAGIC, version byte, uint16 number of values) followed by
+fixed-width little-endian records: float64 unix time, uint8 source, float32 values.
+Convert one to the text format with: python performance_log.py logs/<name>.bin
+"""
+import datetime
+import queue
+import struct
+from threading import Thread
+import click
+import numpy as np
+
+MAGIC = b"MDRNNLOG"
+VERSION = 1
+HEADER = struct.Struct("<8sBH")
+SOURCES = ["interface", "rnn"] # source names, stored by index in binary logs.
+
+
+def text_line(timestamp, source, values):
+    """Returns the text log line for one event."""
+    return "{1},{2},{0}\n".format(','.join(map(str, values)), datetime.datetime.fromtimestamp(timestamp).isoformat(), source)
+
+
+def record_dtype(n_values):
+    """Returns the numpy dtype of one binary log record."""
+    return np.dtype([("time", "<f8"), ("source", "u1"), ("values", "<f4", (n_values,))])
+
+
+class PerformanceLogger(object):
+    """Writes performance events from a worker thread so logging never holds up the caller."""
+
+    def __init__(self, log_file, n_values, binary=False):
+        self.log_file = log_file
+        self.n_values = n_values
+        self.binary = binary
+        self.queue = queue.SimpleQueue()
+        self.record = struct.Struct("<dB" + "f" * n_values)
+        if binary:
+            self.file = open(log_file, "ab")
+            if self.file.tell() == 0:
+                self.file.write(HEADER.pack(MAGIC, VERSION, n_values))
+        else:
+            self.file = open(log_file, "a")
+        self.thread = Thread(target=self.run, name="log_writer_thread", daemon=True)
+        self.thread.start()
+
+    def log(self, source, values, timestamp):
+        """Queue one event, values should not be changed afterwards. Cheap enough for the real-time threads."""
+        self.queue.put((timestamp, source, values))
+
+    def write_event(self, timestamp, source, values):
+        if self.binary:
+            self.file.write(self.record.pack(timestamp, SOURCES.index(source), *values))
+        else:
+            self.file.write(text_line(timestamp, source, values))
+
+    def run(self):
+        """Writes queued events, flushing whenever the queue is empty, until close. Runs on its own thread,
+        which also closes the file so it is never closed while being written."""
+        try:
+            while self.write_waiting():
+                self.file.flush()
+        finally:
+            self.file.close()
+
+    def write_waiting(self):
+        """Waits for events and writes them until the queue is empty, returns False once close has been called."""
+        event = self.queue.get()
+        while event is not None:
+            self.write_event(*event)
+            try:
+                event = self.queue.get_nowait() # write everything else waiting before flushing.
+            except queue.Empty:
+                return True
+        return False
+
+    def close(self, timeout=1.0):
+        """Writes everything queued and closes the file, waiting up to timeout (s) for the writer thread."""
+        self.queue.put(None)
+        self.thread.join(timeout=timeout)
+
+
+def read_binary_log(log_file):
+    """Returns the records in a binary log as a numpy structured array (time, source, values)."""
+    with open(log_file, "rb") as f:
+        magic, version, n_values = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{log_file} is not a version {VERSION} binary performance log.")
+        dtype = record_dtype(n_values)
+        data = f.read()
+    n_records = len(data) // dtype.itemsize # ignore a partly written last record.
+    return np.frombuffer(data, dtype=dtype, count=n_records)
+
+
+def convert_binary_log(log_file, text_file):
+    """Converts a binary log to the text format."""
+    records = read_binary_log(log_file)
+    with open(text_file, "w") as f:
+        for record in records:
+            f.write(text_line(record["time"], SOURCES[record["source"]], record["values"].tolist()))
+    return len(records)
+
+
+@click.command()
+@click.argument('log_files', nargs=-1)
+def convert(log_files):
+    """Converts binary performance logs (.bin) to the text format (.log) alongside them."""
+    for log_file in log_files:
+        text_file = log_file[:-len(".bin")] + ".log" if log_file.endswith(".bin") else log_file + ".log"
+        n_records = convert_binary_log(log_file, text_file)
+        click.secho(f"{log_file}: {n_records} events -> {text_file}", fg="green")
+
+
+if __name__ == '__main__':
+    convert()
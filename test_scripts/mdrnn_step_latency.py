@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Compares the MDRNN inference backends: checks that stateful steps (and a reset with
+prepare_model_for_running) give the same MDN parameters as Keras, and reports per-step
+latency for each model size.
+
+Run from the repository root, e.g.: python test_scripts/mdrnn_step_latency.py --dimension 9
+"""
+
+import os
+import sys
+import tempfile
+import time
+import click
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import empi_mdrnn
+
+
+def time_steps(step_function, inputs):
+    """Returns the outputs and per-step latency (seconds) of step_function over inputs."""
+    outputs = []
+    latencies = np.zeros(len(inputs))
+    for i, x in enumerate(inputs):
+        start = time.perf_counter()
+        outputs.append(np.array(step_function(x)).reshape(-1))
+        latencies[i] = time.perf_counter() - start
+    return np.array(outputs), latencies
+
+
+def backend_step_function(net):
+    """Returns a function running one stateful step of a backend and returning the MDN parameters."""
+    if isinstance(net, empi_mdrnn.KerasMDRNN):
+        def keras_step(x):
+            with net.session_scope():
+                return net.model.predict(x.reshape(1, 1, net.dimension), verbose=0)
+        return keras_step
+    return net.step
+
+
+def compare_size(size, dimension, steps, backends, model_file=None):
+    """Builds each backend for one model size and compares them with Keras.
+    Returns {backend: (latencies, max_error, equivalent)}."""
+    units, mixtures, layers = empi_mdrnn.MODEL_SIZES[size]
+    keras_net = empi_mdrnn.KerasMDRNN(dimension=dimension, n_hidden_units=units, n_mixtures=mixtures, layers=layers)
+    if model_file is not None:
+        keras_net.load_model(model_file=model_file)
+    else:
+        # untrained weights: save them so the other backends read the same file.
+        model_file = os.path.join(tempfile.mkdtemp(), keras_net.model_name() + ".h5")
+        with keras_net.session_scope():
+            keras_net.model.save_weights(model_file)
+
+    inputs = [empi_mdrnn.random_sample(out_dim=dimension) * empi_mdrnn.SCALE_FACTOR for _ in range(steps)]
+    reset_at = steps // 2 # reset the state half way through, then replay the same inputs.
+    inputs = inputs[:reset_at] + inputs[:steps - reset_at]
+
+    def run(net):
+        step_function = backend_step_function(net)
+        out_1, latency_1 = time_steps(step_function, inputs[:reset_at])
+        net.prepare_model_for_running()
+        out_2, latency_2 = time_steps(step_function, inputs[reset_at:])
+        return np.concatenate([out_1, out_2]), np.concatenate([latency_1, latency_2])
+
+    keras_out, keras_latency = run(keras_net)
+    results = {"keras": (keras_latency, 0.0, True)}
+    for backend in backends:
+        if backend == "keras":
+            continue
+        net = empi_mdrnn.build_inference_model(backend, dimension=dimension, n_hidden_units=units, n_mixtures=mixtures, layers=layers)
+        net.load_model(model_file=model_file)
+        out, latency = run(net)
+        max_error = np.max(np.abs(keras_out - out))
+        results[backend] = (latency, max_error, np.allclose(keras_out, out, rtol=1e-4, atol=1e-4))
+    return results
+
+
+@click.command()
+@click.option('--dimension', default=9, help="Model dimension (number of degrees of freedom + 1).")
+@click.option('--sizes', default="xs,s,m,l,xl", help="Comma separated model sizes to compare.")
+@click.option('--steps', default=200, help="Number of stateful steps to time.")
+@click.option('--backends', default="keras,numpy,tflite", help="Comma separated backends to compare with Keras.")
+@click.option('--model-file', default=None, help="Weights file to load (only sensible with a single size).")
+def main(dimension, sizes, steps, backends, model_file):
+    """Per-step latency comparison of the MDRNN inference backends."""
+    click.secho(f"{'size':>4} {'backend':>8} {'p50 ms':>9} {'p95 ms':>9} {'speedup':>8} {'max err':>9}", fg="blue")
+    for size in sizes.split(","):
+        results = compare_size(size, dimension, steps, backends.split(","), model_file)
+        keras_p50 = np.percentile(results["keras"][0][1:], 50)
+        for backend, (latency, max_error, equivalent) in results.items():
+            p50, p95 = np.percentile(latency[1:], [50, 95]) * 1000  # skip first (warm-up) step
+            colour = "green" if equivalent else "red"
+            click.secho(f"{size:>4} {backend:>8} {p50:9.3f} {p95:9.3f} {keras_p50 * 1000 / p50:7.1f}x {max_error:9.2e}", fg=colour)
+
+
+if __name__ == '__main__':
+    main()
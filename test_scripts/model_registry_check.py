@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Checks the model registry's memory budget with real networks: loads more models than the budget
+allows and checks the least recently used ones are evicted (and closed), and compares the registry's
+memory estimate of each network with the RSS it actually added. The models are untrained, so
+TFLite ones are converted as they load, which adds more memory than loading a converted model.
+
+Run from the repository root, e.g.: python test_scripts/model_registry_check.py --backend keras
+"""
+
+import os
+import sys
+import click
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import empi_mdrnn
+import model_registry
+
+
+def rss_mb():
+    """Returns this process's resident memory (MB), Linux only."""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def build_network(settings):
+    """Builds, loads and warms up an (untrained) network from registry settings."""
+    units, mixtures, layers = empi_mdrnn.MODEL_SIZES[settings["size"]]
+    net = empi_mdrnn.build_inference_model(settings["backend"], dimension=settings["dimension"],
+                                           n_hidden_units=units, n_mixtures=mixtures, layers=layers)
+    net.load_model(os.path.join("/nonexistent", "untrained.h5")) # untrained weights of the right shape.
+    net.prepare_model_for_running()
+    net.generate_touch(empi_mdrnn.random_sample(out_dim=settings["dimension"]))
+    return net
+
+
+@click.command()
+@click.option('--backend', default="numpy", help="Inference backend to load the models with.")
+@click.option('--size', default="s", help="Model size.")
+@click.option('--models', default=5, help="Number of different models to load.")
+@click.option('--fit', default=3, help="How many models the budget should hold, including the active one.")
+def check(backend, size, models, fit):
+    """Loads MODELS models into a registry with room for FIT of them and checks eviction."""
+    settings = [{"backend": backend, "size": size, "dimension": 2 + i, "file": ""} for i in range(models)]
+    build_network(settings[0]) # load the backend's runtime (e.g., TensorFlow) first, that's not a model's memory.
+    closed = []
+    sizes = []
+
+    def measured_build(model_settings):
+        before = rss_mb()
+        net = build_network(model_settings)
+        if hasattr(net, "close"):
+            close = net.close
+            net.close = lambda: (closed.append(model_registry.model_key(model_settings)), close())
+        sizes.append((rss_mb() - before, model_registry.model_memory(net) / 2**20))
+        return net
+
+    estimate = model_registry.model_memory(build_network(settings[-1])) # largest model.
+    registry = model_registry.ModelRegistry(measured_build, memory_budget=(fit + 0.5) * estimate)
+    registry.activate(settings[0])
+    for model_settings in settings[1:]:
+        registry.get(model_settings)
+    for added, estimated in sizes:
+        click.secho(f"Model added {added:.1f}MB RSS, estimated {estimated:.1f}MB", fg="blue")
+    keys = list(registry.models)
+    expected = [model_registry.model_key(settings[0])] + [model_registry.model_key(s) for s in settings[1 - fit:]]
+    assert len(keys) <= fit, f"{len(keys)} models loaded, the budget holds {fit}."
+    assert set(keys) == set(expected), f"Kept {keys}, expected the active model and the {fit - 1} most recently used."
+    if closed:
+        assert model_registry.model_key(settings[0]) not in closed, "The active model was closed."
+    click.secho(f"Registry kept {len(keys)} of {models} models (evicted {models - len(keys)}, closed {len(closed)}).", fg="green")
+
+
+if __name__ == '__main__':
+    check()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+Testing partner script: sends periodic OSC messages over UDP to the genai_midi_module (with [osc] enabled) and prints whatever is sent back.
+Use --address-values to send the values in the address (/channel/11/cc/1/64) instead of as arguments.
+"""
+
+import click
+import random
+import time
+from threading import Thread
+from pythonosc.dispatcher import Dispatcher
+from pythonosc.osc_server import BlockingOSCUDPServer
+from pythonosc.udp_client import SimpleUDPClient
+
+genai_server_ip = "127.0.0.1"
+genai_server_port = 5002 # the module's [osc] server_port.
+partner_port = 5003 # the module's [osc] client_port.
+
+
+def send_messages(client, address_values):
+  """Sends random control changes to the module."""
+  while True:
+    channel = 11
+    controller = random.randrange(8) + 1
+    value = random.randrange(127)
+    if address_values:
+      click.secho(f"Sending: /channel/{channel}/cc/{controller}/{value}", fg="blue")
+      client.send_message(f"/channel/{channel}/cc/{controller}/{value}", [])
+    else:
+      click.secho(f"Sending: /channel/{channel}/cc {controller} {value}", fg="blue")
+      client.send_message(f"/channel/{channel}/cc", [controller, value])
+    time.sleep(random.random() + 1)
+
+
+def print_message(address, *args):
+  click.secho(f"Received: {address} {' '.join(str(a) for a in args)}", fg="yellow")
+
+
+@click.command()
+@click.option('--address-values', is_flag=True, help="Send the values in the OSC address rather than as arguments.")
+def start_partner(address_values):
+  click.secho("Starting up OSC test partner..", fg="yellow")
+  dispatcher = Dispatcher()
+  dispatcher.set_default_handler(print_message)
+  server = BlockingOSCUDPServer(("127.0.0.1", partner_port), dispatcher)
+  Thread(target=server.serve_forever, name="osc_partner_server", daemon=True).start()
+  client = SimpleUDPClient(genai_server_ip, genai_server_port)
+  try:
+    send_messages(client, address_values)
+  except KeyboardInterrupt:
+    server.shutdown()
+  print("closing")
+
+
+if __name__ == '__main__':
+  start_partner()
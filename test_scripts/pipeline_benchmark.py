@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+"""
+Offline benchmark of the GenAI MIDI module's real prediction, playback and output path.
+
+Each case runs genai_midi_module in its own process with in-memory stand-ins for the MIDI
+ports, the serial port (optionally limited to the 31250 baud wire speed) and a websocket
+client, so no hardware is needed. Input is replayed from a performance log (text or binary)
+with the same dimension as the case, or generated at a fixed rate otherwise.
+
+Results (throughput, latency percentiles per stage and CPU use) for every case are written
+to a JSON file for regression tracking, e.g.:
+    python test_scripts/pipeline_benchmark.py sweep --sizes xs,s --modes polyphony,battle --output bench.json
+"""
+
+import glob
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from threading import Thread
+import click
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIZES = ["xs", "s", "m", "l", "xl"]
+SERIAL_MIDI_BAUD = 31250
+SERIAL_BITS_PER_BYTE = 10
+
+
+def model_dimensions():
+    """Returns the dimensions of the models in models/."""
+    dims = set()
+    for model_file in glob.glob(os.path.join(REPO_DIR, "models", "*.h5")):
+        match = re.search(r"dim(\d+)", os.path.basename(model_file))
+        if match:
+            dims.add(int(match.group(1)))
+    return sorted(dims)
+
+
+def model_file_for(size, dimension):
+    """Returns the trained weights in models/ for a size and dimension, or "" (untrained) if there aren't any."""
+    sys.path.append(REPO_DIR)
+    from empi_mdrnn import MODEL_SIZES
+    units, mixtures, layers = MODEL_SIZES[size]
+    name = f"musicMDRNN-dim{dimension}-layers{layers}-units{units}-mixtures{mixtures}-scale10"
+    matches = glob.glob(os.path.join(REPO_DIR, "models", name + "*.h5"))
+    return matches[0] if matches else ""
+
+
+def config_toml(case):
+    """Returns a config file for one benchmark case: CC inputs and a note plus CCs output."""
+    n_values = case["dimension"] - 1
+    inputs = ", ".join(f'["control_change", 1, {i + 1}]' for i in range(n_values))
+    outputs = ", ".join(['["note_on", 1]'] + [f'["control_change", 1, {i + 1}]' for i in range(n_values - 1)])
+    return f'''title = "Pipeline benchmark"
+log = false
+log_predictions = false
+verbose = false
+
+[interaction]
+mode = "{case["mode"]}"
+threshold = 0.1
+input_thru = true
+
+[model]
+dimension = {case["dimension"]}
+file = "{case["model_file"]}"
+size = "{case["size"]}"
+backend = "{case["backend"]}"
+sigmatemp = 0.01
+pitemp = 1
+timescale = 1
+
+[playback]
+lookahead = 4
+
+[midi]
+in_device = "benchmark in"
+out_device = "benchmark out"
+input = [{inputs}]
+output = [{outputs}]
+
+[websocket]
+server_ip = "127.0.0.1"
+server_port = {case["port"]}
+client_queue_size = 256
+'''
+
+
+def read_input_log(log_file):
+    """Returns (times, values) of the interface events in a text or binary performance log."""
+    sys.path.append(REPO_DIR)
+    import performance_log
+    if log_file.endswith(".bin"):
+        records = performance_log.read_binary_log(log_file)
+        records = records[records["source"] == performance_log.SOURCES.index("interface")]
+        return records["time"].astype(np.float64), records["values"].astype(np.float64)
+    times, values = [], []
+    with open(log_file) as f:
+        for line in f:
+            parts = line.strip().split(",")
+            if len(parts) < 3 or parts[1] != "interface":
+                continue
+            times.append(np.datetime64(parts[0]).astype("datetime64[us]").astype(np.float64) / 1e6)
+            values.append([float(v) for v in parts[2:]])
+    return np.array(times), np.array(values)
+
+
+class FakeMidiPort(object):
+    """In-memory stand-in for a mido port, counts the messages sent to it."""
+
+    def __init__(self, name):
+        self.name = name
+        self.callback = None
+        self.messages = 0
+
+    def send(self, msg):
+        self.messages += 1
+
+
+class FakeSerial(object):
+    """In-memory stand-in for the serial port, optionally taking as long as a real 31250 baud write."""
+    wire_speed = True
+
+    def __init__(self, *args, **kwargs):
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+        if FakeSerial.wire_speed:
+            time.sleep(len(data) * SERIAL_BITS_PER_BYTE / SERIAL_MIDI_BAUD)
+        return len(data)
+
+
+def install_fake_devices(serial_wire_speed):
+    """Replaces mido's ports and pyserial's Serial with in-memory stand-ins, returns the fake ports."""
+    import mido
+    import serial
+    ports = {"in": FakeMidiPort("benchmark in"), "out": FakeMidiPort("benchmark out")}
+    mido.get_input_names = lambda: [ports["in"].name]
+    mido.get_output_names = lambda: [ports["out"].name]
+    mido.open_input = lambda name: ports["in"]
+    mido.open_output = lambda name: ports["out"]
+    FakeSerial.wire_speed = serial_wire_speed
+    serial.Serial = FakeSerial
+    return ports
+
+
+def websocket_client(port, received):
+    """Connects to the module's websocket server and counts the messages it sends."""
+    from websockets.sync.client import connect
+    for _ in range(100): # wait for the server to start.
+        try:
+            ws = connect(f"ws://127.0.0.1:{port}")
+            break
+        except OSError:
+            time.sleep(0.05)
+    else:
+        return
+    with ws:
+        for _ in ws:
+            received[0] += 1
+
+
+def run_case(case):
+    """Runs one case in this process (called in a fresh process per case) and returns its results."""
+    ports = install_fake_devices(case["serial_wire_speed"])
+    sys.path.insert(0, REPO_DIR)
+    import genai_midi_module as gm
+
+    gm.open_devices()
+    net = gm.prepare_model() # includes a warm-up step.
+
+    if case["input_log"]:
+        times, inputs = read_input_log(case["input_log"])
+        offsets = (times - times[0]) / case["replay_speed"]
+    else:
+        inputs = np.random.rand(int(case["duration"] * case["input_rate"]) + 1, case["dimension"] - 1)
+        offsets = np.arange(len(inputs)) / case["input_rate"]
+
+    def replay_inputs():
+        start = time.monotonic()
+        for offset, int_input in zip(offsets, inputs):
+            if offset > case["duration"]:
+                break
+            gm.sleep_until(start + offset)
+            gm.construct_input_vector(np.clip(int_input, 0, 1), time.monotonic())
+
+    for sink in gm.OUTPUT_SINKS:
+        sink.start()
+    for i in range(max(len(gm.voice_encoders), 1)):
+        args = (gm.voice_output_buffers[i], gm.voice_encoders[i]) if gm.voice_encoders else ()
+        Thread(target=gm.playback_rnn_loop, args=args, daemon=True).start()
+    Thread(target=gm.websocket_serve_loop, daemon=True).start()
+    ws_received = [0]
+    Thread(target=websocket_client, args=(case["port"], ws_received), daemon=True).start()
+    if gm.config["interaction"]["mode"] != "battle":
+        Thread(target=replay_inputs, daemon=True).start()
+
+    start_time = time.monotonic()
+    start_cpu = time.process_time()
+    while time.monotonic() - start_time < case["duration"]:
+        gm.interaction_step(net)
+    wall_time = time.monotonic() - start_time
+    cpu_time = time.process_time() - start_cpu
+    gm.send_midi_note_offs()
+    for sink in gm.OUTPUT_SINKS:
+        sink.wait_until_sent()
+
+    latency = gm.metrics.summary()
+    steps = sum(stages.get("generate", {}).get("total", 0) for stages in latency.values())
+    return {
+        "wall_time": wall_time,
+        "cpu_percent": 100 * cpu_time / wall_time,
+        "steps_per_second": steps / wall_time,
+        "inputs": sum(stages.get("input", {}).get("total", 0) for stages in latency.values()),
+        "midi_messages": ports["out"].messages,
+        "serial_bytes": gm.ser.bytes,
+        "websocket_messages": ws_received[0],
+        "playback_underruns": gm.playback_underruns,
+        "latency_ms": latency,
+    }
+
+
+@click.group()
+def cli():
+    """Offline benchmark of the GenAI MIDI module pipeline."""
+
+
+@cli.command()
+@click.argument('case_file')
+@click.argument('result_file')
+def case(case_file, result_file):
+    """Runs one case (used by sweep, in a working directory holding its config.toml)."""
+    with open(case_file) as f:
+        case = json.load(f)
+    results = run_case(case)
+    with open(result_file, "w") as f:
+        json.dump(results, f)
+    os._exit(0) # don't wait for the device and server threads.
+
+
+@cli.command()
+@click.option('--sizes', default=",".join(SIZES), help="Comma separated model sizes.")
+@click.option('--dimensions', default=None, help="Comma separated dimensions, default: those in models/.")
+@click.option('--backends', default="keras,numpy,tflite", help="Comma separated inference backends (or auto).")
+@click.option('--modes', default="polyphony,battle", help="Comma separated interaction modes.")
+@click.option('--duration', default=10.0, help="Seconds to run each case.")
+@click.option('--input-log', default=None, help="Performance log (.log or .bin) to replay as input for cases with its dimension.")
+@click.option('--replay-speed', default=1.0, help="Speed up (>1) or slow down the input log replay.")
+@click.option('--input-rate', default=20.0, help="Inputs per second when not replaying a log.")
+@click.option('--serial-wire-speed/--no-serial-wire-speed', default=True, help="Make the fake serial port as slow as 31250 baud.")
+@click.option('--output', default="pipeline_benchmark.json", help="JSON file for the results.")
+def sweep(sizes, dimensions, backends, modes, duration, input_log, replay_speed, input_rate, serial_wire_speed, output):
+    """Runs every combination of size, dimension, backend and mode and saves the results."""
+    dims = [int(d) for d in dimensions.split(",")] if dimensions else model_dimensions()
+    log_dimension = None
+    if input_log:
+        log_dimension = read_input_log(input_log)[1].shape[1] + 1
+    results = []
+    click.secho(f"{'size':>4} {'dim':>4} {'backend':>7} {'mode':>12} {'steps/s':>8} {'cpu %':>6} {'gen p50':>8} {'gen p95':>8} {'in->pred p95':>12} {'late p95':>8}", fg="blue")
+    for size in sizes.split(","):
+        for dimension in dims:
+            for backend in backends.split(","):
+                for mode in modes.split(","):
+                    case = {"size": size, "dimension": dimension, "backend": backend, "mode": mode,
+                            "model_file": model_file_for(size, dimension), "duration": duration,
+                            "input_log": os.path.abspath(input_log) if dimension == log_dimension else None,
+                            "replay_speed": replay_speed, "input_rate": input_rate,
+                            "serial_wire_speed": serial_wire_speed, "port": 5101}
+                    with tempfile.TemporaryDirectory() as work_dir:
+                        with open(os.path.join(work_dir, "config.toml"), "w") as f:
+                            f.write(config_toml(case))
+                        case_file = os.path.join(work_dir, "case.json")
+                        result_file = os.path.join(work_dir, "result.json")
+                        with open(case_file, "w") as f:
+                            json.dump(case, f)
+                        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "case", case_file, result_file],
+                                              cwd=work_dir, capture_output=True, text=True)
+                        if proc.returncode != 0 or not os.path.exists(result_file):
+                            click.secho(f"{size} dim {dimension} {backend} {mode} failed:\n{proc.stdout[-2000:]}{proc.stderr[-2000:]}", fg="red")
+                            continue
+                        with open(result_file) as f:
+                            result = json.load(f)
+                    results.append({"case": case, "results": result})
+                    # the (sub-)mode that made the most predictions, e.g., callresponse/call.
+                    stages = max([v for k, v in result["latency_ms"].items() if k.split("/")[0] == mode] or [{}],
+                                 key=lambda v: v.get("generate", {}).get("total", 0))
+                    def p95(stage):
+                        return stages.get(stage, {}).get("p95", float("nan"))
+                    click.secho(f"{size:>4} {dimension:>4} {backend:>7} {mode:>12} {result['steps_per_second']:8.1f} {result['cpu_percent']:6.1f} "
+                                f"{stages.get('generate', {}).get('p50', float('nan')):8.3f} {p95('generate'):8.3f} {p95('input_to_prediction'):12.3f} {p95('playback_lateness'):8.3f}", fg="green")
+    with open(output, "w") as f:
+        json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0], "cases": results}, f, indent=2)
+    click.secho(f"Results saved: {output}", fg="green")
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 """
 Testing partner script: connects via websocket to the genai_midi_module, sends periodic messages and receives whatever is sent back.
+Use --binary to test the binary protocol (whole steps of raw MIDI bytes in one frame) instead of text messages.
 """
 
 import click
@@ -11,16 +12,21 @@ import websockets
 genai_server_ip = "127.0.0.1"
 genai_server_port = 5001
 genai_uri = f"ws://{genai_server_ip}:{genai_server_port}" # the URL for the websocket client to send to/receive from.
+binary_subprotocol = "genai-midi-binary"
+binary_frame_midi = b"M"
 
 
-async def send_client_messages(websocket):
+async def send_client_messages(websocket, binary):
   """Broadcast random MIDI messages to all connected clients."""
   while True:
     channel = 11
     note = random.randrange(8) + 1
     velocity = random.randrange(127)
-    # ws_msg = f"/channel/{channel}/noteon/{note}/{velocity}"
-    ws_msg = f"/channel/{channel}/cc/{note}/{velocity}"
+    if binary:
+      ws_msg = binary_frame_midi + bytes([0xB0 | (channel - 1), note, velocity]) # MIDI channels are 0-15 in bytes.
+    else:
+      # ws_msg = f"/channel/{channel}/noteon/{note}/{velocity}"
+      ws_msg = f"/channel/{channel}/cc/{note}/{velocity}"
     click.secho(f"Sending: {ws_msg}", fg="blue")
     await websocket.send(ws_msg)
     await asyncio.sleep(random.random() + 1)
@@ -29,20 +35,29 @@ async def send_client_messages(websocket):
 async def receive_client_messages(websocket):
   """Receives websocket messages asynchronously."""
   async for msg in websocket:
+    if isinstance(msg, bytes):
+      msg = f"{msg[:1]} " + " ".join(msg[i:i+3].hex() for i in range(1, len(msg), 3))
     click.secho(f"Received: {msg}", fg="yellow")
 
 
-async def main():
+async def main(binary):
   """Connect to the genAI_midi_module, send and receive messages."""
-  async for websocket in websockets.connect(genai_uri):
+  subprotocols = [binary_subprotocol] if binary else None
+  async for websocket in websockets.connect(genai_uri, subprotocols=subprotocols):
     try:
-        await asyncio.gather(send_client_messages(websocket), receive_client_messages(websocket))
+        await asyncio.gather(send_client_messages(websocket, binary), receive_client_messages(websocket))
     except websockets.ConnectionClosed:
         click.secho(f"Connection closed to {genai_uri}, will try to reconnect.", fg="red")
         continue
 
 
-if __name__ == '__main__':
+@click.command()
+@click.option('--binary', is_flag=True, help="Use the binary websocket protocol.")
+def start_partner(binary):
     click.secho("Starting up websocket test partner..", fg="yellow")
-    asyncio.run(main())
+    asyncio.run(main(binary))
     print("closing")
+
+
+if __name__ == '__main__':
+    start_partner()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Trains the EMPI MDRNN on one corpus for several model sizes and numbers of mixtures at once.
+
+Jobs run on a pool of worker processes, each pinned to its own CPU cores with TensorFlow and
+NumPy limited to that many threads, so workers don't oversubscribe the CPU. Every worker
+memory-maps the same corpus (see log_corpus.py) read-only, so the OS shares one copy of it.
+Each trained model is saved to the output directory and timed stepping with the NumPy backend,
+and a table of validation loss against training time and per-step inference cost is written, e.g.:
+    python training_sweep.py datasets/corpus-9d-interface --sizes xs,s,m --mixtures 5,10 --epochs 20
+"""
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import click
+import numpy as np
+
+THREAD_VARIABLES = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+                    "TF_NUM_INTRAOP_THREADS", "TF_NUM_INTEROP_THREADS"]
+INFERENCE_TIMING_STEPS = 200
+
+
+def init_worker(core_sets, threads):
+    """Pins a new worker to one of the core sets and limits its thread pools, before TensorFlow is imported."""
+    cores = core_sets.get()
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    for variable in THREAD_VARIABLES:
+        os.environ[variable] = str(threads)
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+
+
+def inference_step_time(model_file, dimension, units, mixtures, layers):
+    """Returns the median time (s) of a NumPy backend step with the trained weights."""
+    import empi_mdrnn
+    net = empi_mdrnn.NumpyMDRNN(dimension=dimension, n_hidden_units=units, n_mixtures=mixtures, layers=layers)
+    net.load_model(model_file)
+    sample = empi_mdrnn.random_sample(out_dim=dimension)
+    times = np.zeros(INFERENCE_TIMING_STEPS)
+    for i in range(INFERENCE_TIMING_STEPS):
+        start = time.perf_counter()
+        sample = net.generate_touch(sample)
+        times[i] = time.perf_counter() - start
+    return float(np.median(times))
+
+
+def train_job(job):
+    """Trains one model of the sweep (in a worker process) and returns its results."""
+    import tensorflow as tf
+    import empi_mdrnn
+    import log_corpus
+    threads = int(os.environ.get("TF_NUM_INTRAOP_THREADS", 0))
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    corpus = log_corpus.LogCorpus(job["corpus"])
+    windows = corpus.windows(job["sequence_length"], seed=job["seed"])
+    units, _, layers = empi_mdrnn.MODEL_SIZES[job["size"]]
+    net = empi_mdrnn.PredictiveMusicMDRNN(mode=empi_mdrnn.NET_MODE_TRAIN, dimension=corpus.dimension,
+                                          n_hidden_units=units, n_mixtures=job["mixtures"], layers=layers,
+                                          batch_size=job["batch_size"], sequence_length=job["sequence_length"])
+    start = time.monotonic()
+    history = net.train(windows, num_epochs=job["epochs"], saving=False, tensorboard=False)
+    train_time = time.monotonic() - start
+    model_file = os.path.join(job["output"], net.model_name() + ".h5")
+    net.model.save_weights(model_file)
+    val_losses = history.history["val_loss"]
+    return dict(job, model_file=model_file, parameters=int(net.model.count_params()),
+                best_val_loss=float(np.nanmin(val_losses)), best_epoch=int(np.nanargmin(val_losses)) + 1,
+                val_loss=[float(v) for v in val_losses], train_time=train_time,
+                step_ms=1000 * inference_step_time(model_file, corpus.dimension, units, job["mixtures"], layers))
+
+
+def core_sets(workers, threads):
+    """Splits the available cores into one set of `threads` cores for each worker."""
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    return [set(cores[(i * threads + j) % len(cores)] for j in range(threads)) for i in range(workers)]
+
+
+@click.command()
+@click.argument('corpus_dir')
+@click.option('--sizes', default="xs,s,m,l,xl", help="Comma separated model sizes.")
+@click.option('--mixtures', default="5", help="Comma separated numbers of mixtures.")
+@click.option('--epochs', default=10, help="Epochs to train each model.")
+@click.option('--sequence-length', default=50, help="Training sequence length.")
+@click.option('--batch-size', default=64, help="Training batch size.")
+@click.option('--threads', default=1, help="Threads (and cores) for each worker.")
+@click.option('--workers', default=None, type=int, help="Worker processes, default: as many as fit on the cores.")
+@click.option('--seed', default=0, help="Seed for shuffling the training windows.")
+@click.option('--output', default="models/sweep", help="Directory for the trained models and sweep.json.")
+def sweep(corpus_dir, sizes, mixtures, epochs, sequence_length, batch_size, threads, workers, seed, output):
+    """Trains every combination of size and mixtures on the corpus in CORPUS_DIR in parallel."""
+    import empi_mdrnn
+    os.makedirs(output, exist_ok=True)
+    jobs = [{"corpus": corpus_dir, "size": size, "mixtures": int(m), "epochs": epochs, "sequence_length": sequence_length,
+             "batch_size": batch_size, "seed": seed, "output": output}
+            for size in sizes.split(",") for m in mixtures.split(",")]
+    # biggest models first, so a long job isn't left running alone at the end.
+    jobs.sort(key=lambda job: -np.prod(empi_mdrnn.MODEL_SIZES[job["size"]]) * job["mixtures"])
+    if workers is None:
+        workers = max(len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count(), 1) // threads
+    workers = max(min(workers, len(jobs)), 1)
+    click.secho(f"Training {len(jobs)} models on {workers} workers with {threads} thread(s) each.", fg="blue")
+
+    context = multiprocessing.get_context("spawn") # TensorFlow isn't safe to fork.
+    cores = context.Queue()
+    for core_set in core_sets(workers, threads):
+        cores.put(core_set)
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker, initargs=(cores, threads)) as pool:
+        futures = {pool.submit(train_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                result = future.result()
+            except Exception as err:
+                click.secho(f"{job['size']} with {job['mixtures']} mixtures failed: {err}", fg="red")
+                continue
+            results.append(result)
+            click.secho(f"{job['size']} with {job['mixtures']} mixtures done in {result['train_time']:.1f}s.", fg="green")
+
+    results.sort(key=lambda result: result["best_val_loss"])
+    with open(os.path.join(output, "sweep.json"), "w") as f:
+        json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}, f, indent=2)
+    click.secho(f"{'size':>4} {'mix':>4} {'params':>8} {'val loss':>9} {'epoch':>5} {'train s':>8} {'step ms':>8}", fg="blue")
+    for r in results:
+        click.secho(f"{r['size']:>4} {r['mixtures']:>4} {r['parameters']:>8} {r['best_val_loss']:>9.3f} {r['best_epoch']:>5} "
+                    f"{r['train_time']:>8.1f} {r['step_ms']:>8.3f}", fg="green")
+    click.secho(f"Results saved: {os.path.join(output, 'sweep.json')}", fg="green")
+
+
+if __name__ == '__main__':
+    sweep()